@@ -0,0 +1,519 @@
+"""Versioned JSON API for Warbler (`/api/v1`).
+
+Read endpoints select only the columns they return and build responses
+straight from the row tuples, skipping ORM object construction. Lists are
+keyset-paginated: each page has a `next_cursor`, passed back as `before`
+(messages, newest first) or `after` (users, by id) for the next page.
+
+Follows and likes can be added or removed in batches: one request names up
+to `MAX_BATCH_SIZE` ids, all applied with one statement in one transaction,
+and the response gives the outcome for each id.
+
+Bodies are encoded with orjson when it is installed (else the standard
+json module), and compressed with brotli or gzip when the client accepts
+it and the body is big enough to be worth it.
+
+Requests are authenticated by the same session cookie as the site. Writes
+must send a JSON body, which browsers won't send cross-site without a CORS
+preflight, so the cookie can't be used to forge them.
+"""
+
+import gzip
+
+from flask import Blueprint, current_app, g, request
+from werkzeug.exceptions import (
+    BadRequest, Forbidden, HTTPException, NotFound, Unauthorized,
+    UnsupportedMediaType,
+)
+
+import timeline
+from models import db, Follow, LikedMessages, Message, User
+from pagination import (
+    decode_cursor, decode_id_cursor, encode_id_cursor, paginate,
+)
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+    import json
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# bodies smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+# most ids a batch follow/like request may name
+MAX_BATCH_SIZE = 500
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.like_count,
+    Message.user_id,
+    User.username,
+    User.image_url,
+)
+
+USER_LIST_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.bio,
+)
+
+PROFILE_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+    User.location,
+    User.messages_count,
+    User.following_count,
+    User.followers_count,
+    User.likes_count,
+)
+
+
+##############################################################################
+# Encoding
+
+
+def dumps(payload):
+    """Encode `payload` as JSON bytes (datetimes as ISO 8601)."""
+
+    if orjson is not None:
+        return orjson.dumps(payload)
+
+    return json.dumps(
+        payload,
+        separators=(",", ":"),
+        default=lambda value: value.isoformat(),
+    ).encode()
+
+
+def json_response(payload, status=200):
+    return current_app.response_class(
+        dumps(payload), status=status, mimetype='application/json')
+
+
+@api.after_request
+def compress(response):
+    """Brotli- or gzip-encode big enough bodies for clients that accept it."""
+
+    response.vary.add('Accept-Encoding')
+
+    if (response.direct_passthrough or
+            'Content-Encoding' in response.headers or
+            response.content_length is None or
+            response.content_length < MIN_COMPRESS_SIZE):
+        return response
+
+    accepted = request.accept_encodings
+
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(response.get_data()))
+        response.headers['Content-Encoding'] = 'br'
+
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+
+@api.errorhandler(HTTPException)
+def json_error(error):
+    response = json_response({"error": error.description}, error.code)
+
+    for name, value in error.get_headers():
+        if name.lower() != 'content-type':
+            response.headers[name] = value
+
+    return response
+
+
+##############################################################################
+# Rows to JSON
+
+
+def message_dict(row):
+    return {
+        "id": row.id,
+        "text": row.text,
+        "timestamp": row.timestamp,
+        "like_count": row.like_count,
+        "user": {
+            "id": row.user_id,
+            "username": row.username,
+            "image_url": row.image_url,
+        },
+    }
+
+
+def user_dict(row):
+    return {
+        "id": row.id,
+        "username": row.username,
+        "image_url": row.image_url,
+        "bio": row.bio,
+    }
+
+
+def messages_page(rows, next_cursor):
+    return json_response({
+        "messages": [message_dict(row) for row in rows],
+        "next_cursor": next_cursor,
+    })
+
+
+def message_rows():
+    """Column-only query for messages with their authors."""
+
+    return (db.session
+            .query(*MESSAGE_COLUMNS)
+            .select_from(Message)
+            .join(User, User.id == Message.user_id))
+
+
+def require_user():
+    """Raise Unauthorized unless someone is logged in."""
+
+    if not g.get('user'):
+        raise Unauthorized("Log in first.")
+
+
+def require_existing_user(user_id):
+    """Raise NotFound unless there's a user `user_id`."""
+
+    exists = db.session.query(
+        User.query.filter(User.id == user_id).exists()).scalar()
+
+    if not exists:
+        raise NotFound("No such user.")
+
+
+def json_body():
+    """The request's JSON object; UnsupportedMediaType if it hasn't one."""
+
+    if not request.is_json:
+        raise UnsupportedMediaType("Send a JSON body.")
+
+    body = request.get_json()
+
+    if not isinstance(body, dict):
+        raise BadRequest("Send a JSON object.")
+
+    return body
+
+
+def requested_ids(key):
+    """The list of ids under `key` in the JSON body, deduplicated in order."""
+
+    ids = json_body().get(key)
+
+    if (not isinstance(ids, list) or
+            not all(type(id) is int for id in ids) or
+            len(ids) > MAX_BATCH_SIZE):
+        raise BadRequest(
+            f"'{key}' must be a list of at most {MAX_BATCH_SIZE} ids.")
+
+    return list(dict.fromkeys(ids))
+
+
+def batch_results(ids, status_of):
+    return json_response({
+        "results": [{"id": id, "status": status_of(id)} for id in ids],
+    })
+
+
+def user_list(user_id_col, follows_filter):
+    """One page of users picked out of follows, by id."""
+
+    after = decode_id_cursor(request.args.get('after'))
+    per_page = current_app.config['USERS_PER_PAGE']
+
+    users = (db.session
+             .query(*USER_LIST_COLUMNS)
+             .join(Follow, user_id_col == User.id)
+             .filter(follows_filter))
+
+    if after is not None:
+        users = users.filter(User.id > after)
+
+    rows = users.order_by(User.id).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_id_cursor(rows[-1].id)
+
+    return json_response({
+        "users": [user_dict(row) for row in rows],
+        "next_cursor": next_cursor,
+    })
+
+
+##############################################################################
+# Endpoints
+
+
+@api.get('/timeline')
+def home_timeline():
+    """The logged-in user's home timeline, newest first."""
+
+    require_user()
+
+    rows, next_cursor = timeline.home_timeline(
+        g.user.id,
+        cursor=decode_cursor(request.args.get('before')),
+        per_page=current_app.config['MESSAGES_PER_PAGE'],
+        query=message_rows(),
+    )
+
+    return messages_page(rows, next_cursor)
+
+
+@api.get('/users/<int:user_id>')
+def profile(user_id):
+    """A user's public profile and counters."""
+
+    require_user()
+
+    row = (db.session
+           .query(*PROFILE_COLUMNS)
+           .filter(User.id == user_id)
+           .one_or_none())
+
+    if row is None:
+        raise NotFound("No such user.")
+
+    return json_response(row._asdict())
+
+
+@api.get('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    require_user()
+    require_existing_user(user_id)
+
+    rows, next_cursor = paginate(
+        message_rows().filter(Message.user_id == user_id),
+        Message.timestamp,
+        Message.id,
+        decode_cursor(request.args.get('before')),
+        current_app.config['MESSAGES_PER_PAGE'],
+    )
+
+    return messages_page(rows, next_cursor)
+
+
+@api.get('/users/<int:user_id>/following')
+def following(user_id):
+    """The users `user_id` follows, by id."""
+
+    require_user()
+    require_existing_user(user_id)
+
+    return user_list(
+        Follow.user_being_followed_id, Follow.user_following_id == user_id)
+
+
+@api.get('/users/<int:user_id>/followers')
+def followers(user_id):
+    """The users following `user_id`, by id."""
+
+    require_user()
+    require_existing_user(user_id)
+
+    return user_list(
+        Follow.user_following_id, Follow.user_being_followed_id == user_id)
+
+
+@api.get('/users/<int:user_id>/likes')
+def likes(user_id):
+    """Messages `user_id` has liked, most recently liked first."""
+
+    require_user()
+    require_existing_user(user_id)
+
+    rows, next_cursor = paginate(
+        message_rows()
+        .add_columns(LikedMessages.liked_at)
+        .join(LikedMessages, LikedMessages.message_id == Message.id)
+        .filter(LikedMessages.user_id == user_id),
+        LikedMessages.liked_at,
+        LikedMessages.message_id,
+        decode_cursor(request.args.get('before')),
+        current_app.config['MESSAGES_PER_PAGE'],
+        key=lambda row: (row.liked_at, row.id),
+    )
+
+    return messages_page(rows, next_cursor)
+
+
+@api.post('/messages')
+def create_message():
+    """Post a message from `{"text": ...}`; returns it with status 201."""
+
+    require_user()
+
+    text = (json_body().get("text") or "").strip()
+
+    if not text or len(text) > Message.text.type.length:
+        raise BadRequest(
+            f"Text must be 1 to {Message.text.type.length} characters.")
+
+    message = Message(text=text, user_id=g.user.id)
+    db.session.add(message)
+    db.session.flush()
+    timeline.add_message(message)
+    db.session.commit()
+    current_app.extensions['user_cache'].delete(g.user.id)
+    current_app.jinja_env.fragment_cache.invalidate_user(g.user.id)
+
+    row = message_rows().filter(Message.id == message.id).one()
+    return json_response(message_dict(row), 201)
+
+
+@api.delete('/messages/<int:message_id>')
+def delete_message(message_id):
+    """Delete one of the logged-in user's messages."""
+
+    require_user()
+
+    message = db.session.get(Message, message_id)
+
+    if message is None:
+        raise NotFound("No such message.")
+
+    if message.user_id != g.user.id:
+        raise Forbidden("That's not your message.")
+
+    db.session.delete(message)
+    db.session.commit()
+
+    current_app.extensions['user_cache'].delete(g.user.id)
+    fragment_cache = current_app.jinja_env.fragment_cache
+    fragment_cache.invalidate_message(message_id)
+    fragment_cache.invalidate_user(g.user.id)
+
+    return "", 204
+
+
+@api.post('/following')
+def follow_users():
+    """Follow every user in `{"user_ids": [...]}`.
+
+    Each id's status is "followed", "already_following", "self" or
+    "not_found".
+    """
+
+    require_user()
+    ids = requested_ids("user_ids")
+
+    existing = set(db.session.scalars(
+        db.select(User.id).where(User.id.in_(ids))))
+    targets = [id for id in ids if id in existing and id != g.user.id]
+
+    followed = Follow.add_many(g.user.id, targets)
+    timeline.add_follows(g.user.id, sorted(followed))
+    db.session.commit()
+
+    user_cache = current_app.extensions['user_cache']
+    fragment_cache = current_app.jinja_env.fragment_cache
+    for user_id in followed | {g.user.id}:
+        user_cache.delete(user_id)
+        fragment_cache.invalidate_user(user_id)
+
+    def status_of(id):
+        if id not in existing:
+            return "not_found"
+        if id == g.user.id:
+            return "self"
+        return "followed" if id in followed else "already_following"
+
+    return batch_results(ids, status_of)
+
+
+@api.delete('/following')
+def unfollow_users():
+    """Stop following every user in `{"user_ids": [...]}`.
+
+    Each id's status is "unfollowed" or "not_following".
+    """
+
+    require_user()
+    ids = requested_ids("user_ids")
+
+    unfollowed = Follow.remove_many(g.user.id, ids)
+    timeline.remove_follows(g.user.id, sorted(unfollowed))
+    db.session.commit()
+
+    user_cache = current_app.extensions['user_cache']
+    fragment_cache = current_app.jinja_env.fragment_cache
+    for user_id in unfollowed | {g.user.id}:
+        user_cache.delete(user_id)
+        fragment_cache.invalidate_user(user_id)
+
+    return batch_results(
+        ids,
+        lambda id: "unfollowed" if id in unfollowed else "not_following")
+
+
+@api.post('/likes')
+def like_messages():
+    """Like every message in `{"message_ids": [...]}`.
+
+    Each id's status is "liked", "already_liked", "own_message" or
+    "not_found".
+    """
+
+    require_user()
+    ids = requested_ids("message_ids")
+
+    authors = dict(db.session.execute(
+        db.select(Message.id, Message.user_id).where(Message.id.in_(ids))
+    ).all())
+    targets = [id for id in ids if authors.get(id) not in (None, g.user.id)]
+
+    liked = LikedMessages.add_many(g.user.id, targets)
+    db.session.commit()
+    current_app.extensions['user_cache'].delete(g.user.id)
+    current_app.jinja_env.fragment_cache.invalidate_user(g.user.id)
+
+    def status_of(id):
+        if id not in authors:
+            return "not_found"
+        if authors[id] == g.user.id:
+            return "own_message"
+        return "liked" if id in liked else "already_liked"
+
+    return batch_results(ids, status_of)
+
+
+@api.delete('/likes')
+def unlike_messages():
+    """Unlike every message in `{"message_ids": [...]}`.
+
+    Each id's status is "unliked" or "not_liked".
+    """
+
+    require_user()
+    ids = requested_ids("message_ids")
+
+    unliked = LikedMessages.remove_many(g.user.id, ids)
+    db.session.commit()
+    current_app.extensions['user_cache'].delete(g.user.id)
+    current_app.jinja_env.fragment_cache.invalidate_user(g.user.id)
+
+    return batch_results(
+        ids, lambda id: "unliked" if id in unliked else "not_liked")
@@ -1,16 +1,41 @@
 import os
+from datetime import datetime, timedelta
+from hmac import compare_digest
+from time import perf_counter
+
+import click
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, jsonify)
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_migrate import Migrate, stamp
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
 
 from forms import (
     UserAddForm, LoginForm, MessageForm, CSRFProtectForm, UserEditForm)
 from models import (
-    db, connect_db, User, Message, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL)
-
-from werkzeug.exceptions import Unauthorized
+    db, connect_db, hasher, User, Message, Follow, LikedMessages,
+    DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL, reconcile_counters,
+    following_status, liked_status, with_authors)
+
+from werkzeug.exceptions import NotFound, Unauthorized
+
+import timeline
+from api import api
+from cache import LRUCache
+from fragments import FragmentCache, FragmentCacheExtension, RedisStore
+from http_caching import (
+    abort_if_unchanged, apply_cache_policy, static_version, templates_version)
+from identity import load_current_user
+from instrumentation import Profiler, render_metrics
+from leaderboard import (
+    DEFAULT_TOP_WINDOW, TOP_WINDOWS, refresh_like_buckets, top_messages)
+from loader import DEFAULT_CHUNK_ROWS, load
+from pagination import decode_cursor, decode_rank_cursor, paginate
+from search import autocomplete_users, search_messages, search_users
+from suggestions import refresh_suggestions, suggestions_for
 
 load_dotenv()
 
@@ -22,9 +47,206 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+app.config['MESSAGES_PER_PAGE'] = 100
+app.config['USERS_PER_PAGE'] = 60
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))
+app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = int(
+    os.environ.get('TIMELINE_FANOUT_MAX_FOLLOWERS', 10000))
+app.config['TIMELINE_BACKFILL_LIMIT'] = int(
+    os.environ.get('TIMELINE_BACKFILL_LIMIT', 100))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE_SIZE'] = int(
+    os.environ.get('PASSWORD_HASH_QUEUE_SIZE', 32))
+app.config['PASSWORD_HASH_MAX_PER_USERNAME'] = int(
+    os.environ.get('PASSWORD_HASH_MAX_PER_USERNAME', 2))
+app.config['PASSWORD_HASH_MAX_PER_IP'] = int(
+    os.environ.get('PASSWORD_HASH_MAX_PER_IP', 4))
+app.config['PASSWORD_HASH_TARGET_MS'] = int(
+    os.environ.get('PASSWORD_HASH_TARGET_MS', 100))
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_TTL'] = int(
+    os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+# optional Redis URL, to share rendered fragments between web workers
+app.config['FRAGMENT_CACHE_REDIS_URL'] = os.environ.get(
+    'FRAGMENT_CACHE_REDIS_URL')
+# how many messages the "top messages" leaderboards show
+app.config['TOP_MESSAGES_LIMIT'] = int(
+    os.environ.get('TOP_MESSAGES_LIMIT', 50))
+# fail any request that sends more SQL statements than this (0: no limit);
+# the test modules that make requests set it to catch N+1 queries
+app.config['MAX_QUERIES_PER_REQUEST'] = int(
+    os.environ.get('MAX_QUERIES_PER_REQUEST', 0))
+# profile each request's SQL and templates (see instrumentation.py); the
+# query limit and /metrics need it
+app.config['PROFILER'] = bool(int(os.environ.get('PROFILER', 1)))
+# send each request's SQL and template timings in a Server-Timing header,
+# which any client can read: for development
+app.config['SERVER_TIMING'] = bool(int(
+    os.environ.get('SERVER_TIMING', 0)))
+# /metrics requires "Authorization: Bearer <this token>", and is not
+# found without one set
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# how many who-to-follow suggestions to compute and show per user
+app.config['SUGGESTIONS_PER_USER'] = int(
+    os.environ.get('SUGGESTIONS_PER_USER', 20))
+# bcrypt cost for new hashes; 0 picks one to fit PASSWORD_HASH_TARGET_MS
+app.config['PASSWORD_HASH_ROUNDS'] = int(
+    os.environ.get('PASSWORD_HASH_ROUNDS', 0))
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+migrate = Migrate(app, db)
+hasher.init_app(app)
+profiler = Profiler(app, db.engine) if app.config['PROFILER'] else None
+app.register_blueprint(api)
+
+# Snapshots of logged-in users, so add_user_to_g needn't query every request
+user_cache = LRUCache(
+    maxsize=app.config['USER_CACHE_SIZE'],
+    ttl=app.config['USER_CACHE_TTL'],
+)
+
+# Rendered template fragments; see fragments.py
+fragment_cache = FragmentCache(
+    local=LRUCache(
+        maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+        ttl=app.config['FRAGMENT_CACHE_TTL'],
+    ),
+    shared=(RedisStore(app.config['FRAGMENT_CACHE_REDIS_URL'],
+                       app.config['FRAGMENT_CACHE_TTL'])
+            if app.config['FRAGMENT_CACHE_REDIS_URL'] else None),
+    namespace=templates_version(
+        os.path.join(app.root_path, app.template_folder)),
+)
+app.jinja_env.add_extension(FragmentCacheExtension)
+app.jinja_env.fragment_cache = fragment_cache
+app.extensions['user_cache'] = user_cache
+
+
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute users' message/follow/like counters from the tables."""
+
+    corrected = reconcile_counters()
+    db.session.commit()
+    print(f"Corrected {corrected} counter value(s).")
+
+
+@app.cli.command('refresh-like-buckets')
+@click.option('--hours', default=24, show_default=True,
+              help="How many recent hours of likes to recount.")
+def refresh_like_buckets_command(hours):
+    """Recount recent hourly like buckets and drop expired ones.
+
+    Run hourly (e.g. from cron) so expired buckets don't pile up.
+    """
+
+    now = datetime.utcnow()
+    written, pruned = refresh_like_buckets(now - timedelta(hours=hours), now)
+    db.session.commit()
+    print(f"Rebuilt {written} bucket(s); pruned {pruned}.")
+
+
+@app.cli.command('load-csvs')
+@click.argument('directory', default='generator')
+@click.option('--append', is_flag=True,
+              help="Add to the existing data instead of starting afresh.")
+@click.option('--chunk-rows', default=DEFAULT_CHUNK_ROWS, show_default=True,
+              help="Rows sent per COPY.")
+def load_csvs_command(directory, append, chunk_rows):
+    """Bulk load a directory of table CSVs (or generated COPY files)."""
+
+    load(directory, append=append, chunk_rows=chunk_rows)
+
+    if not append:
+        # a fresh load builds the latest schema, so record it as migrated
+        stamp()
+
+
+@app.cli.command('compute-suggestions')
+def compute_suggestions_command():
+    """Recompute every user's who-to-follow suggestions from follows."""
+
+    start = perf_counter()
+    stored = refresh_suggestions(app.config['SUGGESTIONS_PER_USER'])
+    db.session.commit()
+    print(f"Stored {stored} suggestion(s) in {perf_counter() - start:.1f}s.")
+
+
+##############################################################################
+# Message list helpers
+
+
+def wants_json():
+    """Did the client ask for JSON rather than an HTML page?"""
+
+    best = request.accept_mimetypes.best_match(
+        ['text/html', 'application/json'])
+    return best == 'application/json'
+
+
+def liked_ids_for(messages):
+    """IDs of `messages` that the current user has liked."""
+
+    return liked_status(g.user, [message.id for message in messages])
+
+
+def serialize_message(message):
+    """Turn a message into a JSON-friendly dict."""
+
+    return {
+        "id": message.id,
+        "text": message.text,
+        "timestamp": message.timestamp.isoformat(),
+        "like_count": message.like_count,
+        "user": {
+            "id": message.user.id,
+            "username": message.user.username,
+            "image_url": message.user.image_url,
+        },
+    }
+
+
+def serialize_user(user):
+    """Turn a user into a JSON-friendly dict of their public profile."""
+
+    return {
+        "id": user.id,
+        "username": user.username,
+        "image_url": user.image_url,
+        "bio": user.bio,
+        "location": user.location,
+    }
+
+
+def newest_version(user_id_col, follows_filter):
+    """Highest `User.version` among the users picked out of follows.
+
+    `user_id_col` is the follows column naming the users to look at, and
+    `follows_filter` which follows rows to take them from.
+    """
+
+    return (db.session
+            .query(func.max(User.version))
+            .join(Follow, user_id_col == User.id)
+            .filter(follows_filter)
+            .scalar())
+
+
+def messages_json(messages, next_cursor):
+    """JSON response for one page of messages."""
+
+    return jsonify(
+        messages=[serialize_message(message) for message in messages],
+        next_cursor=next_cursor,
+    )
 
 
 ##############################################################################
@@ -33,10 +255,14 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a `CurrentUser`: cached columns are free, anything else loads
+    the full user row on first use.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_current_user(session[CURR_USER_KEY], user_cache)
 
     else:
         g.user = None
@@ -145,7 +371,9 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio or
+    location; results are ranked best match first. Pass the previous page's
+    'after' cursor for more.
     """
 
     if not g.user:
@@ -154,12 +382,53 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users, next_cursor = search_users(
+        search,
+        cursor=decode_rank_cursor(request.args.get('after')),
+        limit=app.config['USERS_PER_PAGE'],
+    )
+
+    if wants_json():
+        return jsonify(
+            users=[serialize_user(user) for user in users],
+            next_cursor=next_cursor,
+        )
+
+    followed_ids = following_status(g.user, [user.id for user in users])
+
+    return render_template(
+        'users/index.html',
+        users=users,
+        followed_ids=followed_ids,
+        q=search,
+        next_cursor=next_cursor,
+    )
+
+
+@app.get('/users/autocomplete')
+def autocomplete_usernames():
+    """JSON list of users whose username starts with the 'q' param."""
+
+    if not g.user:
+        raise Unauthorized()
+
+    return jsonify(users=autocomplete_users(request.args.get('q')))
+
+
+@app.get('/users/suggestions')
+def show_suggestions():
+    """Show users the current user might like to follow."""
 
-    return render_template('users/index.html', users=users)
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    users = suggestions_for(g.user, app.config['SUGGESTIONS_PER_USER'])
+
+    if wants_json():
+        return jsonify(users=[serialize_user(user) for user in users])
+
+    return render_template('users/suggestions.html', users=users)
 
 
 @app.get('/users/<int:user_id>')
@@ -171,8 +440,26 @@ def show_user(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+    abort_if_unchanged(user.id, user.version)
+
+    messages, next_cursor = paginate(
+        with_authors(Message.query.filter(Message.user_id == user.id)),
+        Message.timestamp,
+        Message.id,
+        decode_cursor(request.args.get('before')),
+        app.config['MESSAGES_PER_PAGE'],
+    )
+
+    if wants_json():
+        return messages_json(messages, next_cursor)
 
-    return render_template('users/show.html', user=user)
+    return render_template(
+        'users/show.html',
+        user=user,
+        messages=messages,
+        next_cursor=next_cursor,
+        liked_ids=liked_ids_for(messages),
+    )
 
 
 @app.get('/users/<int:user_id>/following')
@@ -184,7 +471,14 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    abort_if_unchanged(user.id, user.version, newest_version(
+        Follow.user_being_followed_id, Follow.user_following_id == user.id))
+
+    followed_ids = following_status(
+        g.user, [followed_user.id for followed_user in user.following])
+
+    return render_template(
+        'users/following.html', user=user, followed_ids=followed_ids)
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -196,34 +490,52 @@ def show_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    abort_if_unchanged(user.id, user.version, newest_version(
+        Follow.user_following_id, Follow.user_being_followed_id == user.id))
+
+    followed_ids = following_status(
+        g.user, [follower.id for follower in user.followers])
+
+    return render_template(
+        'users/followers.html', user=user, followed_ids=followed_ids)
 
 
 @app.get('/users/<int:user_id>/liked')
 def show_likes(user_id):
-    """Show list of liked warbles of this user."""
+    """Show list of liked warbles of this user, most recently liked first."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    print('This is g.user.liked', g.user.liked)
-
-    liked_messages_ids = [m.id for m in user.liked]
-
-    print('This is liked_messages_ids', liked_messages_ids)
-
-    messages = (Message
-                .query
-                .filter(Message.id.in_(liked_messages_ids))
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    # TODO: this is ordered by timestamp which is good
-    # originally could've done g.user.liked and parsed through
 
-    return render_template(f'users/liked.html', user=user, messages=messages)
+    likes = with_authors(
+        db.session
+        .query(Message, LikedMessages.liked_at)
+        .join(LikedMessages, LikedMessages.message_id == Message.id)
+        .filter(LikedMessages.user_id == user.id))
+
+    rows, next_cursor = paginate(
+        likes,
+        LikedMessages.liked_at,
+        LikedMessages.message_id,
+        decode_cursor(request.args.get('before')),
+        app.config['MESSAGES_PER_PAGE'],
+        key=lambda row: (row.liked_at, row.Message.id),
+    )
+    messages = [row.Message for row in rows]
+
+    if wants_json():
+        return messages_json(messages, next_cursor)
+
+    return render_template(
+        'users/liked.html',
+        user=user,
+        messages=messages,
+        next_cursor=next_cursor,
+        liked_ids=liked_ids_for(messages),
+    )
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -240,7 +552,13 @@ def start_following(follow_id):
     if g.csrf_form.validate_on_submit:
         followed_user = User.query.get_or_404(follow_id)
         g.user.following.append(followed_user)
+        db.session.flush()
+        timeline.add_follow(g.user.id, followed_user.id)
         db.session.commit()
+        user_cache.delete(g.user.id)
+        user_cache.delete(followed_user.id)
+        fragment_cache.invalidate_user(g.user.id)
+        fragment_cache.invalidate_user(followed_user.id)
 
         return redirect(f"/users/{g.user.id}/following")
 
@@ -261,8 +579,13 @@ def stop_following(follow_id):
     if g.csrf_form.validate_on_submit:
         followed_user = User.query.get_or_404(follow_id)
         g.user.following.remove(followed_user)
+        timeline.remove_follow(g.user.id, followed_user.id)
 
         db.session.commit()
+        user_cache.delete(g.user.id)
+        user_cache.delete(followed_user.id)
+        fragment_cache.invalidate_user(g.user.id)
+        fragment_cache.invalidate_user(followed_user.id)
 
         return redirect(f"/users/{g.user.id}/following")
 
@@ -278,8 +601,7 @@ def edit_profile():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    # user = User.query.get_or_404(g.user.id)
-    user = g.user
+    user = g.user.record
     form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
@@ -293,6 +615,8 @@ def edit_profile():
                 user.bio = form.bio.data
 
                 db.session.commit()
+                user_cache.delete(user.id)
+                fragment_cache.invalidate_user(user.id)
 
             else:
                 flash("Invalid password!", 'danger')
@@ -321,8 +645,10 @@ def delete_user():
     if g.csrf_form.validate_on_submit():
         do_logout()
 
-        db.session.delete(g.user)
+        db.session.delete(g.user.record)
         db.session.commit()
+        user_cache.delete(g.user.id)
+        fragment_cache.invalidate_user(g.user.id)
 
         return redirect("/signup")
 
@@ -349,13 +675,81 @@ def add_message():
     if form.validate_on_submit():
         message = Message(text=form.text.data)
         g.user.messages.append(message)
+        db.session.flush()
+        timeline.add_message(message)
         db.session.commit()
+        user_cache.delete(g.user.id)
+        fragment_cache.invalidate_user(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/create.html', form=form)
 
 
+@app.get('/messages/search')
+def search_messages_page():
+    """Page of messages matching the 'q' param, best match first.
+
+    Relevance is weighed against age, so fresh matches float up. Pass the
+    previous page's 'after' cursor for more.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    search = request.args.get('q')
+
+    messages, next_cursor = search_messages(
+        search,
+        cursor=decode_rank_cursor(request.args.get('after')),
+        limit=app.config['MESSAGES_PER_PAGE'],
+    )
+
+    if wants_json():
+        return messages_json(messages, next_cursor)
+
+    return render_template(
+        'messages/search.html',
+        messages=messages,
+        q=search,
+        next_cursor=next_cursor,
+        liked_ids=liked_ids_for(messages),
+    )
+
+
+@app.get('/messages/top')
+def top_messages_page():
+    """The most-liked messages of the last day, or of the 'window' param
+    ('24h' or '7d')."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    window = request.args.get('window', DEFAULT_TOP_WINDOW)
+
+    if window not in TOP_WINDOWS:
+        raise NotFound()
+
+    rows = top_messages(TOP_WINDOWS[window], app.config['TOP_MESSAGES_LIMIT'])
+    messages = [message for message, _, _ in rows]
+
+    if wants_json():
+        return jsonify(messages=[
+            dict(serialize_message(message), likes_in_window=likes)
+            for message, _, likes in rows
+        ])
+
+    return render_template(
+        'messages/top.html',
+        rows=rows,
+        window=window,
+        windows=TOP_WINDOWS,
+        liked_ids=liked_ids_for(messages),
+    )
+
+
 @app.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
@@ -365,7 +759,13 @@ def show_message(message_id):
         return redirect("/")
 
     message = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=message)
+    abort_if_unchanged(message.id, message.user.version, message.like_count)
+
+    return render_template(
+        'messages/show.html',
+        message=message,
+        liked_ids=liked_ids_for([message]),
+    )
 
 
 @app.post('/messages/<int:message_id>/liked')
@@ -374,26 +774,20 @@ def liking_message(message_id):
 
     # LOGIC: redirect back to same place
 
-    print("messages=", g.user.liked)
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     if g.csrf_form.validate_on_submit():
 
-        message = Message.query.get_or_404(message_id)
-
-        curr_url = request.form.get("location")
-        print("curr_url=", curr_url)
-
-        if message in g.user.liked:
-            g.user.liked.remove(message)
-        else :
-            g.user.liked.append(message)
+        if LikedMessages.toggle(g.user.id, message_id) is None:
+            raise NotFound()
 
         db.session.commit()
+        user_cache.delete(g.user.id)
+        fragment_cache.invalidate_user(g.user.id)
 
-        return redirect(f"{curr_url}")
+        return redirect(request.form.get("location") or "/")
 
     else:
         raise Unauthorized()
@@ -413,12 +807,39 @@ def delete_message(message_id):
 
     if g.csrf_form.validate_on_submit():
         message = Message.query.get_or_404(message_id)
+        author_id = message.user_id
+        # timeline_entries rows go with it via ON DELETE CASCADE
         db.session.delete(message)
         db.session.commit()
+        fragment_cache.invalidate_message(message_id)
+        user_cache.delete(author_id)
+        fragment_cache.invalidate_user(author_id)
 
         return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Metrics
+
+
+@app.get('/metrics')
+def metrics():
+    """Request, SQL, template and password hash metrics for Prometheus."""
+
+    token = app.config['METRICS_TOKEN']
+
+    if not (token and profiler):
+        raise NotFound()
+
+    if not compare_digest(
+            request.headers.get('Authorization', ''), f"Bearer {token}"):
+        raise Unauthorized()
+
+    return app.response_class(
+        render_metrics(profiler.metrics, hasher.metrics),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -428,29 +849,41 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of self & followed_users
+    - logged in: most recent messages of self & followed_users, a page at
+      a time (pass the previous page's `before` cursor for older ones)
     """
 
     if g.user:
-        curr_following_ids = [f.id for f in g.user.following] + [g.user.id]
+        messages, next_cursor = timeline.home_timeline(
+            g.user.id,
+            cursor=decode_cursor(request.args.get('before')),
+            per_page=app.config['MESSAGES_PER_PAGE'],
+        )
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(curr_following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        if wants_json():
+            return messages_json(messages, next_cursor)
 
-        return render_template('home.html', messages=messages)
+        return render_template(
+            'home.html',
+            messages=messages,
+            next_cursor=next_cursor,
+            liked_ids=liked_ids_for(messages),
+        )
 
     else:
         return render_template('home-anon.html')
 
 
+@app.url_defaults
+def hash_static_urls(endpoint, values):
+    """Add a content hash to static file URLs, so they can be cached forever."""
+
+    if endpoint == 'static' and 'filename' in values:
+        values.setdefault('v', static_version(values['filename']))
+
+
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add caching headers: see `http_caching` for the policy per page."""
 
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
-    return response
+    return apply_cache_policy(response)
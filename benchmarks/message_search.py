@@ -0,0 +1,161 @@
+"""Benchmark message full-text search against a naive ILIKE scan.
+
+Seeds a database with synthetic messages (1M by default) whose words follow
+a skewed distribution, so queries range from very common to rare words,
+then times the first page of results for each query both ways:
+
+- fts: `search.search_messages` (GIN-indexed tsvector, ranked)
+- ilike: `text ILIKE '%word%'`, newest first
+
+Run from the repo root against a scratch database; seeding wipes it:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/message_search.py
+
+Ranking has to score every match, so full-text search wins big on selective
+queries and by less on words found in a large share of all messages.
+
+Pass --skip-seed to rerun the timings against an already seeded database.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_bench")
+os.environ.setdefault('SECRET_KEY', "benchmark")
+
+from sqlalchemy import text  # noqa: E402
+
+from app import app  # noqa: E402
+from models import db, Message, reconcile_counters  # noqa: E402
+from search import search_messages  # noqa: E402
+
+WORDS = """
+    coffee morning rain city river music friend weekend garden train
+    book movie dinner sunset ocean mountain bridge market street window
+    teacher doctor artist engineer runner baker painter singer writer pilot
+    guitar piano violin trumpet drum camera bicycle lantern compass anchor
+    maple cedar willow birch aspen juniper cypress hemlock sequoia redwood
+    quartz basalt granite marble obsidian jasper garnet topaz opal zircon
+    falcon heron osprey kestrel plover curlew bittern grebe merganser avocet
+""".split()
+
+SYLLABLES = "ka lo mi ne ru sa ti vo ze ba".split()
+
+# The words above, most common first, then a long tail of made-up ones
+VOCABULARY = WORDS + [
+    a + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES
+]
+
+# (full-text query, the substring ILIKE looks for)
+QUERIES = [
+    ("coffee", "coffee"),
+    ("friend", "friend"),
+    ("guitar", "guitar"),
+    ("sequoia", "sequoia"),
+    ("avocet", "avocet"),
+    ('"maple cedar"', "maple cedar"),
+]
+
+
+def seed(num_messages, num_users):
+    """Wipe the database and fill it with synthetic users and messages."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(text("""
+        INSERT INTO users (email, username, password, image_url,
+                           header_image_url, bio, location)
+        SELECT 'bench' || n || '@email.com', 'bench' || n, 'x', '', '', '', ''
+        FROM generate_series(1, :num_users) AS n
+    """), {"num_users": num_users})
+
+    # Counters are fixed up in one pass afterwards rather than by trigger.
+    db.session.execute(text("ALTER TABLE messages DISABLE TRIGGER USER"))
+
+    # Squaring random() skews word choice towards the front of the vocabulary.
+    db.session.execute(text("""
+        INSERT INTO messages (text, timestamp, user_id)
+        SELECT (SELECT string_agg(
+                    (:words)[1 + floor(cardinality(:words) * random() ^ 2)],
+                    ' ')
+                FROM generate_series(1, 6 + n % 8)),
+               now() - n * interval '10 seconds',
+               (SELECT min(id) FROM users) + n % :num_users
+        FROM generate_series(1, :num_messages) AS n
+    """), {
+        "words": VOCABULARY,
+        "num_users": num_users,
+        "num_messages": num_messages,
+    })
+
+    db.session.execute(text("ALTER TABLE messages ENABLE TRIGGER USER"))
+    reconcile_counters()
+    db.session.commit()
+
+    db.session.execute(text("ANALYZE"))
+
+
+def fts(query, limit):
+    search_messages(query, limit=limit)
+
+
+def ilike(substring, limit):
+    (Message.query
+     .filter(Message.text.ilike(f"%{substring}%"))
+     .order_by(Message.timestamp.desc(), Message.id.desc())
+     .limit(limit)
+     .all())
+
+
+def time_query(search, query, limit, runs):
+    """Milliseconds for each of `runs` runs, after one warm-up run."""
+
+    search(query, limit)
+    db.session.rollback()
+
+    timings = []
+    for _ in range(runs):
+        start = perf_counter()
+        search(query, limit)
+        timings.append((perf_counter() - start) * 1000)
+        db.session.rollback()
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--skip-seed", action="store_true")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if not args.skip_seed:
+            print(f"Seeding {args.messages} messages...")
+            start = perf_counter()
+            seed(args.messages, args.users)
+            print(f"Seeded in {perf_counter() - start:.1f}s")
+
+        print(f"{'query':<20} {'fts ms':>10} {'ilike ms':>10} {'speedup':>8}")
+
+        for query, substring in QUERIES:
+            fts_ms = statistics.median(
+                time_query(fts, query, args.limit, args.runs))
+            ilike_ms = statistics.median(
+                time_query(ilike, substring, args.limit, args.runs))
+
+            print(f"{query:<20} {fts_ms:>10.1f} {ilike_ms:>10.1f} "
+                  f"{ilike_ms / fts_ms:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
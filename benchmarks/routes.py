@@ -0,0 +1,509 @@
+"""Load test every route in app.py with a mixed workload.
+
+Seeds a database with generator/create_csvs.py (100k users by default),
+then has a pool of logged-in virtual users browse and write the way real
+ones do: mostly home timelines, profiles and messages, with searches,
+follows, likes and new messages mixed in (see `WORKLOAD`). Popular users
+and messages are picked far more often than the rest. Reports per route:
+
+- latency p50 / p95 / p99 (ms) and requests/second
+- SQL statements per request
+
+Requests go through Flask's test client in this process, so this measures
+the app and the database, not a web server or the network. Run from the
+repo root against a scratch database; seeding wipes it:
+
+    DATABASE_URL=postgresql:///warbler_bench python benchmarks/routes.py
+
+Results are written as JSON (--output). Pass --compare with an earlier
+result to print the differences and exit non-zero on a regression: a p95
+more than --max-regression percent slower, or a statement or more of SQL
+per request added.
+Pass --skip-seed to rerun against an already seeded database; the same
+--seed replays the same requests. To measure what the request profiler
+(instrumentation.py) costs, run once with it off, then compare:
+
+    PROFILER=0 python benchmarks/routes.py --output off.json
+    python benchmarks/routes.py --skip-seed --compare off.json
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+from collections import defaultdict
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_bench")
+os.environ.setdefault('SECRET_KEY', "benchmark")
+
+from sqlalchemy import event, text  # noqa: E402
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from loader import load  # noqa: E402
+from models import db  # noqa: E402
+from suggestions import refresh_suggestions  # noqa: E402
+
+GENERATOR = os.path.join(ROOT, 'generator', 'create_csvs.py')
+
+# the generator's users all have this password
+PASSWORD = "password"
+
+# words the generated messages and usernames are made of
+QUERY_WORDS = """
+    river music friend garden train window ocean mountain market street
+    morning summer winter story dream light forest island coffee party
+""".split()
+
+# how many of the most popular users and messages requests pick from
+POOL_SIZE = 1000
+
+# picks from a pool are skewed towards its front by this power
+POPULARITY_POWER = 3
+
+# --compare only judges routes with this many requests in both runs, and
+# only p95s this much slower as well as --max-regression percent slower
+MIN_COMPARED_REQUESTS = 20
+MIN_REGRESSION_MS = 2
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+# SQL statements sent by the current thread; requests through the test
+# client run on the calling thread
+statements = threading.local()
+
+
+@event.listens_for(db.engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, many):
+    statements.count = getattr(statements, 'count', 0) + 1
+
+
+class VirtualUser:
+    """A logged-in test client, and what it has done during the run."""
+
+    def __init__(self, user_id, username, following, rng, pools, results):
+        self.id = user_id
+        self.username = username
+        self.following = following
+        self.rng = rng
+        self.pools = pools
+        self.results = results
+        self.posted = []
+        self.client = app.test_client()
+        self.log_in()
+
+    def log_in(self):
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.id
+
+    def pick(self, pool):
+        """Someone or something from `pool`, favouring the front."""
+
+        ids = self.pools[pool]
+        return ids[int(len(ids) * self.rng.random() ** POPULARITY_POWER)]
+
+    def request(self, route, method, url, **kwargs):
+        """Send and time one request, recording it under `route`."""
+
+        before = getattr(statements, 'count', 0)
+        start = perf_counter()
+        response = self.client.open(url, method=method, **kwargs)
+        elapsed = perf_counter() - start
+
+        self.results[route].append((
+            elapsed * 1000,
+            getattr(statements, 'count', 0) - before,
+            response.status_code,
+        ))
+        return response
+
+    def get(self, route, url):
+        return self.request(route, 'GET', url)
+
+    def post(self, route, url, data=None):
+        return self.request(route, 'POST', url, data=data or {})
+
+
+def home(user):
+    user.get('home', '/')
+
+
+def profile(user):
+    user.get('profile', f"/users/{user.pick('users')}")
+
+
+def following(user):
+    user.get('following', f"/users/{user.pick('users')}/following")
+
+
+def followers(user):
+    user.get('followers', f"/users/{user.pick('users')}/followers")
+
+
+def likes(user):
+    user.get('likes', f"/users/{user.pick('users')}/liked")
+
+
+def list_users(user):
+    user.get('list_users', f"/users?q={user.rng.choice(QUERY_WORDS)[:3]}")
+
+
+def autocomplete(user):
+    user.get('autocomplete',
+             f"/users/autocomplete?q={user.rng.choice(QUERY_WORDS)[:3]}")
+
+
+def suggestions(user):
+    user.get('suggestions', '/users/suggestions')
+
+
+def show_message(user):
+    user.get('show_message', f"/messages/{user.pick('messages')}")
+
+
+def search_messages(user):
+    user.get('search_messages',
+             f"/messages/search?q={user.rng.choice(QUERY_WORDS)}")
+
+
+def top_messages(user):
+    user.get('top_messages',
+             f"/messages/top?window={user.rng.choice(['24h', '7d'])}")
+
+
+def forms(user):
+    user.get('edit_profile_form', '/users/profile')
+    user.get('new_message_form', '/messages/new')
+
+
+def follow_toggle(user):
+    followed_id = user.pick('users')
+
+    if followed_id == user.id:
+        return
+
+    if followed_id in user.following:
+        user.post('stop_following', f"/users/stop-following/{followed_id}")
+        user.following.discard(followed_id)
+    else:
+        user.post('start_following', f"/users/follow/{followed_id}")
+        user.following.add(followed_id)
+
+
+def like_toggle(user):
+    message_id = user.pick('messages')
+    user.post('like_toggle', f"/messages/{message_id}/liked",
+              {'location': f"/messages/{message_id}"})
+
+
+def post_message(user):
+    user.post('add_message', '/messages/new',
+              {'text': ' '.join(user.rng.sample(QUERY_WORDS, 6))})
+
+    # the redirect doesn't say which message; look it up, untimed
+    with app.app_context():
+        user.posted.append(db.session.execute(text(
+            "SELECT max(id) FROM messages WHERE user_id = :id"
+        ), {'id': user.id}).scalar())
+
+
+def delete_message(user):
+    if not user.posted:
+        return post_message(user)
+
+    user.post('delete_message', f"/messages/{user.posted.pop()}/delete")
+
+
+def log_in_out(user):
+    """Log out and back in again (one bcrypt hash)."""
+
+    user.post('logout', '/logout')
+    user.get('login_form', '/login')
+    user.post('login', '/login',
+              {'username': user.username, 'password': PASSWORD})
+    user.log_in()
+
+
+def sign_up_and_delete(user):
+    """A new user signs up, then deletes their account."""
+
+    name = f"bench{user.id}x{user.rng.randrange(10 ** 9)}"
+
+    user.get('signup_form', '/signup')
+    user.post('signup', '/signup', {
+        'username': name,
+        'email': f"{name}@example.com",
+        'password': PASSWORD,
+        'image_url': '',
+    })
+    user.post('delete_user', '/users/delete')
+    user.log_in()
+
+
+# (action, weight): how often virtual users do each thing
+WORKLOAD = [
+    (home, 25),
+    (profile, 10),
+    (show_message, 8),
+    (like_toggle, 8),
+    (search_messages, 6),
+    (follow_toggle, 5),
+    (likes, 5),
+    (following, 4),
+    (followers, 4),
+    (post_message, 3),
+    (list_users, 3),
+    (autocomplete, 3),
+    (top_messages, 3),
+    (suggestions, 2),
+    (delete_message, 1),
+    (forms, 1),
+    (log_in_out, 1),
+    (sign_up_and_delete, 1),
+]
+
+
+def seed(args):
+    """Wipe the database and fill it from the generator."""
+
+    with TemporaryDirectory() as directory:
+        subprocess.run([
+            sys.executable, GENERATOR, '--out', directory,
+            '--format', 'binary', '--seed', str(args.seed),
+            '--users', str(args.users), '--messages', str(args.messages),
+            '--follows', str(args.follows), '--likes', str(args.likes),
+        ], check=True)
+        load(directory)
+
+    refresh_suggestions()
+    db.session.commit()
+
+
+# arguments only used when seeding
+SEED_ARGS = ('users', 'messages', 'follows', 'likes')
+
+
+def dataset():
+    """Row counts of the main tables."""
+
+    return {
+        table: db.session.execute(
+            text(f"SELECT count(*) FROM {table}")).scalar()
+        for table in ('users', 'messages', 'follows', 'liked_messages')
+    }
+
+
+def pools():
+    """Ids of the most followed users and the most liked and newest
+    messages, most popular first."""
+
+    users = db.session.execute(text("""
+        SELECT id FROM users ORDER BY followers_count DESC, id LIMIT :n
+    """), {'n': POOL_SIZE}).scalars().all()
+
+    liked = db.session.execute(text("""
+        SELECT id FROM messages ORDER BY like_count DESC, id LIMIT :n
+    """), {'n': POOL_SIZE // 2}).scalars().all()
+
+    newest = db.session.execute(text("""
+        SELECT id FROM messages ORDER BY id DESC LIMIT :n
+    """), {'n': POOL_SIZE // 2}).scalars().all()
+
+    # alternately most liked and newest, without repeats
+    messages = list(dict.fromkeys(
+        id for pair in zip(liked, newest) for id in pair))
+
+    return {'users': users, 'messages': messages}
+
+
+def virtual_users(args, pools, results):
+    """`args.virtual_users` users picked pseudo-randomly by --seed."""
+
+    rows = db.session.execute(text("""
+        SELECT id, username,
+               ARRAY(SELECT user_being_followed_id FROM follows
+                     WHERE user_following_id = users.id)
+        FROM users
+        ORDER BY md5(id || ':' || :seed)
+        LIMIT :n
+    """), {'seed': args.seed, 'n': args.virtual_users}).all()
+    db.session.rollback()
+
+    return [
+        VirtualUser(id, username, set(following),
+                    random.Random(args.seed * 1_000_003 + i), pools,
+                    results)
+        for i, (id, username, following) in enumerate(rows)
+    ]
+
+
+def run(users, actions, count):
+    """Have `users` take turns doing `count` random weighted actions."""
+
+    weights = [weight for _, weight in WORKLOAD]
+
+    for i in range(count):
+        user = users[i % len(users)]
+        action, = user.rng.choices(actions, weights)
+        action(user)
+
+
+def percentile(sorted_values, p):
+    """The `p`th percentile by nearest rank."""
+
+    return sorted_values[
+        min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+
+def summarize(samples, seconds):
+    timings = sorted(ms for ms, _, _ in samples)
+    sql = [count for _, count, _ in samples]
+
+    return {
+        'requests': len(samples),
+        'errors': sum(status >= 400 for _, _, status in samples),
+        'requests_per_second': round(len(samples) / seconds, 1),
+        'p50_ms': round(percentile(timings, 50), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'p99_ms': round(percentile(timings, 99), 2),
+        'mean_ms': round(statistics.fmean(timings), 2),
+        'sql_per_request': round(statistics.fmean(sql), 2),
+        'max_sql': max(sql),
+    }
+
+
+def compare(result, baseline, max_regression):
+    """Print each route against `baseline`; return whether any regressed."""
+
+    regressed = False
+    print(f"\n{'vs baseline':<20} {'p95 ms':>16} {'sql/req':>14}")
+
+    for route, now in result['routes'].items():
+        before = baseline['routes'].get(route)
+        if not before or min(before['requests'], now['requests']) < \
+                MIN_COMPARED_REQUESTS:
+            continue
+
+        slower = now['p95_ms'] > max(
+            before['p95_ms'] * (1 + max_regression / 100),
+            before['p95_ms'] + MIN_REGRESSION_MS)
+        # averages wobble with what's cached; an N+1 adds whole statements
+        more_sql = now['sql_per_request'] >= before['sql_per_request'] + 1
+        regressed |= slower or more_sql
+
+        print(f"{route:<20} {before['p95_ms']:>7.1f} -> {now['p95_ms']:<7.1f}"
+              f"{before['sql_per_request']:>6.1f} -> "
+              f"{now['sql_per_request']:<5.1f}"
+              f"{'  REGRESSED' if slower or more_sql else ''}")
+
+    before, now = baseline['overall'], result['overall']
+    print(f"{'overall mean ms':<20} {before['mean_ms']:>7.2f} -> "
+          f"{now['mean_ms']:<7.2f} "
+          f"({now['mean_ms'] / before['mean_ms'] - 1:+.1%})")
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--follows', type=int, default=2_000_000)
+    parser.add_argument('--likes', type=int, default=2_000_000)
+    parser.add_argument('--skip-seed', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=5000,
+                        help="Measured requests (roughly; some actions "
+                             "send several).")
+    parser.add_argument('--warmup', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--virtual-users', type=int, default=100)
+    parser.add_argument('--output', default=os.path.join(
+        ROOT, 'benchmarks', 'results',
+        f"routes-{datetime.now():%Y%m%d-%H%M%S}.json"))
+    parser.add_argument('--compare', metavar='BASELINE_JSON')
+    parser.add_argument('--max-regression', type=float, default=20,
+                        help="Percent p95 slowdown counted as a regression.")
+    args = parser.parse_args()
+
+    with app.app_context():
+        if not args.skip_seed:
+            start = perf_counter()
+            seed(args)
+            print(f"Seeded in {perf_counter() - start:.1f}s")
+
+        rows = dataset()
+        print(", ".join(f"{count:,} {table}" for table, count in rows.items()))
+
+        results = defaultdict(list)
+        users = virtual_users(args, pools(), results)
+        actions = [action for action, _ in WORKLOAD]
+
+        run(users, actions, args.warmup)
+        results.clear()
+
+        # each thread drives its own slice of the virtual users
+        threads = [
+            threading.Thread(target=run, args=(
+                users[i::args.threads], actions,
+                args.requests // args.threads))
+            for i in range(args.threads)
+        ]
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = perf_counter() - start
+
+    result = {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'commit': subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            capture_output=True, text=True).stdout.strip(),
+        'args': {key: value for key, value in vars(args).items()
+                 if key not in ('output', 'compare')
+                 and not (args.skip_seed and key in SEED_ARGS)},
+        'profiler': app.config['PROFILER'],
+        'dataset': rows,
+        'seconds': round(seconds, 2),
+        'overall': summarize(
+            [sample for samples in results.values() for sample in samples],
+            seconds),
+        'routes': {route: summarize(results[route], seconds)
+                   for route in sorted(results)},
+    }
+
+    print(f"\n{'route':<20} {'reqs':>6} {'err':>4} {'p50':>7} {'p95':>7} "
+          f"{'p99':>7} {'sql/req':>8}")
+    for route, stats in [*result['routes'].items(),
+                         ('overall', result['overall'])]:
+        print(f"{route:<20} {stats['requests']:>6} {stats['errors']:>4} "
+              f"{stats['p50_ms']:>7.1f} {stats['p95_ms']:>7.1f} "
+              f"{stats['p99_ms']:>7.1f} {stats['sql_per_request']:>8.1f}")
+    print(f"\n{result['overall']['requests_per_second']:.0f} requests/s "
+          f"on {args.threads} thread(s)")
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(result, json.load(f), args.max_regression):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
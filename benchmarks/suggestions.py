@@ -0,0 +1,76 @@
+"""Benchmark the who-to-follow batch on a synthetic follows graph.
+
+Builds a graph in memory (2M follows among 200k users by default) in which
+who gets followed is heavily skewed, as on real networks, then times
+`suggestions.score_candidates` over every user and reports how many blocks
+it took and the process's peak memory (max RSS). No database is needed:
+
+    python benchmarks/suggestions.py --users 200000 --follows 2000000
+
+The COPY in and out of PostgreSQL adds roughly the time it takes to write
+the resulting rows; run `flask compute-suggestions` against a seeded
+database to time the whole thing.
+"""
+
+import argparse
+import os
+import resource
+import sys
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from suggestions import (  # noqa: E402
+    DEFAULT_MAX_PATHS, DEFAULT_TOP_K, score_candidates,
+)
+
+
+def synthetic_follows(users, follows, seed=0):
+    """Distinct (follower, followed) pairs; followers are uniform and
+    followed users Zipf-distributed, so a few users have huge followings."""
+
+    rng = np.random.default_rng(seed)
+
+    followers = rng.integers(users, size=follows)
+    popularity = rng.permutation(users)
+    followed = popularity[(rng.zipf(1.3, size=follows) - 1) % users]
+
+    pairs = np.unique(followers * users + followed)
+    followers, followed = pairs // users, pairs % users
+    keep = followers != followed
+    return followers[keep], followed[keep]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200_000)
+    parser.add_argument('--follows', type=int, default=2_000_000)
+    parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K)
+    parser.add_argument('--max-paths', type=int, default=DEFAULT_MAX_PATHS)
+    args = parser.parse_args()
+
+    start = perf_counter()
+    followers, followed = synthetic_follows(args.users, args.follows)
+    print(f"graph: {len(followers):,} follows among {args.users:,} users "
+          f"({perf_counter() - start:.1f}s)")
+
+    start = perf_counter()
+    blocks = suggestions = 0
+
+    for user_ids, _, _, _ in score_candidates(
+            followers, followed, args.top_k, args.max_paths):
+        blocks += 1
+        suggestions += len(user_ids)
+
+    print(f"scored: {suggestions:,} suggestions in {blocks:,} blocks "
+          f"({perf_counter() - start:.1f}s)")
+
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"peak memory: {peak / 1024:,.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
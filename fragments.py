@@ -0,0 +1,197 @@
+"""Fragment caching for Jinja templates.
+
+Parts of a page that are the same for every viewer (a profile's header and
+stats, the body of a message) can be wrapped in a cache tag:
+
+    {% cache "user-stats", user.id, user.version %}
+      ...
+    {% endcache %}
+
+The rendered HTML is stored under the fragment's name and object id along
+with the version it was rendered at; it is reused only while the version
+still matches, so any change to the row re-renders it. Fragments showing
+only a user's name, pictures or bio use `user.profile_version` instead,
+which likes, follows and new messages leave alone. Writes in app.py also
+drop an object's fragments outright to free the space.
+
+Anything that depends on who is looking (stars, follow buttons, forms with
+CSRF tokens) must stay outside the tag.
+
+Fragments are kept in an in-process `LRUCache` and, optionally, a shared
+store (e.g. Redis) so that web workers can reuse each other's work. If the
+shared store is down, workers carry on with their own.
+"""
+
+import json
+import logging
+from time import monotonic
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# fragment names used in templates, by the kind of object they show
+USER_FRAGMENTS = ('user-hero', 'user-stats', 'user-bio')
+MESSAGE_FRAGMENTS = ('message-item', 'profile-message-item')
+
+
+class RedisStore:
+    """Shared fragment store on a Redis server (needs the `redis` package).
+
+    A page shouldn't fail, or wait long, because Redis is down: calls time
+    out after `TIMEOUT` seconds, and after an error the store is left alone
+    for `RETRY_AFTER` seconds, acting as if empty.
+    """
+
+    TIMEOUT = 0.25
+    RETRY_AFTER = 10
+
+    def __init__(self, url, ttl):
+        import redis
+
+        self.client = redis.Redis.from_url(
+            url, socket_timeout=self.TIMEOUT,
+            socket_connect_timeout=self.TIMEOUT)
+        self.errors = redis.RedisError
+        self.ttl = ttl
+        self._down_until = 0.0
+
+    def _call(self, method, *args, **kwargs):
+        """`self.client.<method>(...)`, or None if Redis isn't answering."""
+
+        if monotonic() < self._down_until:
+            return None
+
+        try:
+            return getattr(self.client, method)(*args, **kwargs)
+        except self.errors as error:
+            logger.warning("Fragment store unavailable for %ss: %s",
+                           self.RETRY_AFTER, error)
+            self._down_until = monotonic() + self.RETRY_AFTER
+            return None
+
+    def get(self, key):
+        value = self._call('get', key)
+        return None if value is None else value.decode()
+
+    def set(self, key, value):
+        self._call('set', key, value, ex=self.ttl)
+
+    def delete(self, key):
+        self._call('delete', key)
+
+
+class FragmentCache:
+    """Rendered fragments, by name, object id and version.
+
+    `local` is an `LRUCache`; `shared`, if given, is any store with
+    `get(key)`, `set(key, value)` and `delete(key)` on strings. `namespace`
+    is prefixed to every key (e.g. a hash of the templates, so a deploy
+    doesn't serve fragments rendered by old templates).
+    """
+
+    def __init__(self, local=None, shared=None, namespace=""):
+        self.local = local if local is not None else LRUCache()
+        self.shared = shared
+        self.namespace = namespace
+
+    def _key(self, name, object_id):
+        return f"{self.namespace}:{name}:{object_id}"
+
+    def get(self, name, object_id, version):
+        """Return the fragment's HTML if cached at `version`, else None."""
+
+        key = self._key(name, object_id)
+        entry = self.local.get(key)
+
+        if entry is None and self.shared is not None:
+            stored = self.shared.get(key)
+
+            if stored is not None:
+                entry = tuple(json.loads(stored))
+                self.local.set(key, entry)
+
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        return None
+
+    def set(self, name, object_id, version, html):
+        """Store a fragment's `html` as rendered at `version`."""
+
+        key = self._key(name, object_id)
+        self.local.set(key, (version, html))
+
+        if self.shared is not None:
+            self.shared.set(key, json.dumps([version, html]))
+
+    def invalidate(self, object_id, names):
+        """Drop the fragments called `names` for `object_id`."""
+
+        for name in names:
+            key = self._key(name, object_id)
+            self.local.delete(key)
+
+            if self.shared is not None:
+                self.shared.delete(key)
+
+    def invalidate_user(self, user_id):
+        """Drop every cached fragment showing user `user_id`."""
+
+        self.invalidate(user_id, USER_FRAGMENTS)
+
+    def invalidate_message(self, message_id):
+        """Drop every cached fragment showing message `message_id`."""
+
+        self.invalidate(message_id, MESSAGE_FRAGMENTS)
+
+    def clear(self):
+        """Forget every fragment held in this process."""
+
+        self.local.clear()
+
+
+class FragmentCacheExtension(Extension):
+    """Adds `{% cache name, object_id, version %}...{% endcache %}`.
+
+    Uses the `FragmentCache` set as `environment.fragment_cache`; with none
+    set, fragments are simply rendered every time.
+    """
+
+    tags = {"cache"}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        args = [parser.parse_expression()]
+        for _ in range(2):
+            parser.stream.expect("comma")
+            args.append(parser.parse_expression())
+
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+
+        return nodes.CallBlock(
+            self.call_method("_render", args), [], [], body,
+        ).set_lineno(lineno)
+
+    def _render(self, name, object_id, version, caller):
+        cache = self.environment.fragment_cache
+
+        if cache is None:
+            return caller()
+
+        html = cache.get(name, object_id, version)
+
+        if html is None:
+            html = str(caller())
+            cache.set(name, object_id, version, html)
+
+        return Markup(html)
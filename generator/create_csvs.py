@@ -1,89 +1,402 @@
-"""Generate CSVs of random data for Warbler.
+"""Generate random data for Warbler, from a few hundred rows to tens of
+millions.
 
-Students won't need to run this for the exercise; they will just use the CSV
-files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+Seeded and offline: the same arguments always write the same files. Rows
+are built with NumPy a shard of users at a time, and shards are written by
+a pool of processes, so output size is limited by disk rather than memory:
+
+    python generator/create_csvs.py                  # the sample seed data
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 50000000 --likes 50000000 --format binary \\
+        --out /tmp/warbler-data
+    flask load-csvs /tmp/warbler-data
+
+The data has the shape of a real network rather than a uniform one:
+
+- user popularity follows a power law (`--follow-skew`): a few celebrity
+  users have a large share of all followers, most have a handful
+- likes pile up on hot messages (`--like-skew`) and on celebrities'
+  messages (`--celebrity-likes`)
+- how many users each user follows, and how many messages each user posts
+  and likes, are log-normal: most users are light, a few very heavy
+- messages and follows are denser towards `--end`; likes come after their
+  message, mostly soon after
+
+Each table is written as one file per shard, `<table>.<shard>.csv` (or
+`.copy`, PostgreSQL's binary COPY format, which loads faster), and
+manifest.json lists them for `flask load-csvs`. The `--shard-users`
+setting changes the output; `--workers` doesn't. Timestamps are relative
+to `--end` (default: today), so pass it too to reproduce a data set
+exactly.
 """
 
+import argparse
+import json
 import os
-from dotenv import load_dotenv
-
-import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+from datetime import date
+from math import ceil
+from multiprocessing import Pool
+from time import perf_counter
 
-load_dotenv()
+import numpy as np
 
-UNSPLASH_CID = os.environ['UNSPLASH_CID']
+from helpers import (
+    distinct_pairs, hashed_uniform, power_law_ranks, recent_timestamps,
+    scatter, sentences, skewed_counts, write_copy, write_csv,
+)
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
-FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+USERS_COLUMNS = ['id', 'email', 'username', 'image_url', 'password', 'bio',
+                 'header_image_url', 'location']
+MESSAGES_COLUMNS = ['id', 'text', 'timestamp', 'user_id']
+FOLLOWS_COLUMNS = ['user_being_followed_id', 'user_following_id',
+                   'created_at']
+LIKES_COLUMNS = ['user_id', 'message_id', 'liked_at']
+
+# hash of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# spread of the per-user log-normal counts; larger is more skewed
+FOLLOWING_SIGMA = 1.2
+POSTING_SIGMA = 1.5
+LIKING_SIGMA = 1.5
+
+# draws of whom to follow or what to like, after which a user may have a
+# few fewer than they were meant to (the most popular are nearly all taken)
+PAIR_ROUNDS = 8
+
+# a like comes (time since posting) * u ** LIKE_DELAY_POWER after its
+# message, u uniform: mostly soon after posting, a few much later
+LIKE_DELAY_POWER = 4
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# one random stream per table, so e.g. changing --follows leaves the
+# messages unchanged
+USERS_STREAM, MESSAGES_STREAM, FOLLOWS_STREAM, LIKES_STREAM = range(4)
 
-fake = Faker()
+TABLES = {
+    'users': USERS_COLUMNS,
+    'messages': MESSAGES_COLUMNS,
+    'follows': FOLLOWS_COLUMNS,
+    'liked_messages': LIKES_COLUMNS,
+}
 
-# Generate random profile image URLs to use for users
+FORMATS = {'csv': '.csv', 'binary': '.copy'}
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-# NOTE: You will need to create a dev account at unsplash.com, 
-# generate an access key and set that to an environment
-# variable to successfully ping the API. 
+HEADER_IMAGE_URLS = [
+    f"https://images.unsplash.com/photo-{photo}?fit=max&fm=jpg&q=80&w=1080"
+    for photo in [
+        "1573996987033-47fd3a4ca35e", "1574001412492-7555e61a9b53",
+        "1575015642299-5b92fcbd0ba4", "1647598939382-5637f4eeb7b9",
+        "1653061853347-4fbf052530e9", "1668353064375-d3dcd3346d53",
+    ]
+]
 
-header_image_urls = [
-    requests.get(
-        "https://api.unsplash.com/topics/wallpapers/photos" \
-        f"?per_page=30&orientation=landscape&client_id={UNSPLASH_CID}"
-    ).json()[i]['urls']['regular'] for i in range(0,29)
+LOCATIONS = [
+    "Amsterdam", "Austin", "Bangalore", "Berlin", "Bogota", "Boston",
+    "Cairo", "Chicago", "Denver", "Dublin", "Istanbul", "Jakarta", "Lagos",
+    "Lima", "Lisbon", "London", "Los Angeles", "Madrid", "Manila",
+    "Melbourne", "Mexico City", "Montreal", "Mumbai", "Nairobi",
+    "New York", "Oakland", "Osaka", "Paris", "Portland", "San Francisco",
+    "Sao Paulo", "Seattle", "Seoul", "Singapore", "Stockholm", "Sydney",
+    "Taipei", "Tokyo", "Toronto", "Vancouver", "Warsaw", "Zurich",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+WORDS = """
+able about across after again air also always animal answer area around
+baby back ball bank base bear beat bed bird black blue boat body book box
+boy bread bright bring brother build burn buy call car care carry case cat
+catch cause center chair change child city class clean clear close cloud
+coast cold color come cook cool corner country cover cross cut dance dark
+day deep dog door down draw dream dress drink drive dry each early earth
+east easy eat edge egg end enjoy even every face fact fall family far farm
+fast father feel field fight fill find fine fire first fish five floor
+flower fly food foot forest form free fresh friend front fruit full game
+garden girl give glass gold good grass great green ground group grow hair
+half hand happy hard head hear heart heat heavy help high hill hold home
+hope horse hot hour house idea inside island job join jump keep key kind
+king know lake land large late laugh lead learn leave left letter life
+light line list listen little live long look love low machine make map
+mark market meet middle mile milk mind minute money month moon morning
+mother mountain move music name near never new news next night north note
+number ocean offer office old open order other page paint paper park part
+party pass past pay people pick picture piece place plan plant play point
+poor power pull push quick quiet rain read ready red rest rich ride right
+river road rock room round run safe sail salt same sand save school sea
+season seat second see sell send set shape share ship shop short show side
+sign simple sing sister sit size sky sleep slow small smile snow soft song
+soon sound south space speak special spring square stand star start station
+stay step stone stop store story street strong study summer sun table take
+talk tall teach team tell test thing think three time today together top
+town track train travel tree true turn under until up usual valley view
+visit voice wait walk wall want warm watch water wave way weather week west
+wheel white whole wide wild wind window winter wish wood word work world
+write year yellow young
+""".split()
+
+
+# each user's first message id, and one past the last user's last, set in
+# every worker by `init_worker`; messages are numbered user by user
+first_message_ids = None
+
+
+def init_worker(ids):
+    global first_message_ids
+    first_message_ids = ids
+
+
+def rng_for(args, stream, shard):
+    return np.random.default_rng([args.seed, stream, shard])
+
+
+def shard_ids(args, shard):
+    """The user ids in `shard`."""
+
+    start = shard * args.shard_users + 1
+    return np.arange(
+        start, min(start + args.shard_users, args.users + 1), dtype=np.int32)
+
+
+def message_counts(args, shard, rng=None):
+    """How many messages each user in `shard` posts."""
+
+    return skewed_counts(
+        rng or rng_for(args, MESSAGES_STREAM, shard),
+        len(shard_ids(args, shard)), args.messages / args.users,
+        POSTING_SIGMA)
+
+
+def users(args, shard):
+    ids = shard_ids(args, shard)
+    rng = rng_for(args, USERS_STREAM, shard)
+
+    names = sentences(rng, len(ids), WORDS, 2, 2, 20)
+    usernames = [f"{name.replace(' ', '_')}{id}"
+                 for name, id in zip(names, ids.tolist())]
+
+    return [
+        ids,
+        [f"{username}@example.com" for username in usernames],
+        usernames,
+        np.asarray(IMAGE_URLS)[rng.integers(len(IMAGE_URLS), size=len(ids))]
+        .tolist(),
+        [PASSWORD] * len(ids),
+        sentences(rng, len(ids), WORDS, 3, 12, 200),
+        np.asarray(HEADER_IMAGE_URLS)[
+            rng.integers(len(HEADER_IMAGE_URLS), size=len(ids))].tolist(),
+        np.asarray(LOCATIONS)[rng.integers(len(LOCATIONS), size=len(ids))]
+        .tolist(),
+    ]
+
+
+def message_timestamps(args, ids):
+    """When each of the message `ids` was posted; a function of the id
+    alone, so likes can be timed after their messages anywhere."""
+
+    return recent_timestamps(hashed_uniform(ids, args.seed), args.end,
+                             args.days)
+
+
+def messages(args, shard):
+    rng = rng_for(args, MESSAGES_STREAM, shard)
+    counts = message_counts(args, shard, rng)
+    first_id = first_message_ids[shard * args.shard_users]
+    ids = np.arange(first_id, first_id + counts.sum(), dtype=np.int32)
+
+    return [
+        ids,
+        sentences(rng, len(ids), WORDS, 3, 18, MAX_WARBLER_LENGTH),
+        message_timestamps(args, ids),
+        np.repeat(shard_ids(args, shard), counts),
+    ]
+
+
+def popular_users(rng, args, size):
+    """`size` user indexes (id - 1), drawn by popularity: the same users
+    get the most follows and the most likes."""
+
+    return scatter(power_law_ranks(rng, size, args.users, args.follow_skew),
+                   args.users, args.seed)
+
+
+def follows(args, shard):
+    """Follows made by the users in `shard`.
+
+    Each follower draws whom to follow by popularity rank, so followers
+    pile up on a few users without any all-pairs table.
+    """
+
+    rng = rng_for(args, FOLLOWS_STREAM, shard)
+    ids = shard_ids(args, shard)
+    wanted = np.minimum(
+        skewed_counts(rng, len(ids), args.follows / args.users,
+                      FOLLOWING_SIGMA),
+        args.users - 1)
+
+    def draw(followers):
+        followed = popular_users(rng, args, len(followers)) + 1
+        return np.where(followed == followers, -1, followed)
+
+    followers, followed = distinct_pairs(
+        ids, wanted, draw, args.users + 1, PAIR_ROUNDS)
+
+    return [
+        followed.astype(np.int32),
+        followers.astype(np.int32),
+        recent_timestamps(rng.random(len(followers)), args.end, args.days),
+    ]
+
+
+def likes(args, shard):
+    """Likes by the users in `shard`.
+
+    Most likes go to hot messages, drawn by a power law over all messages
+    (`--like-skew`); the `--celebrity-likes` share go to a message of a
+    popular user instead. Nobody likes their own messages.
+    """
+
+    rng = rng_for(args, LIKES_STREAM, shard)
+    ids = shard_ids(args, shard)
+    total = int(first_message_ids[-1]) - 1
+    wanted = np.minimum(
+        skewed_counts(rng, len(ids), args.likes / args.users, LIKING_SIGMA),
+        total // 2)
+
+    def draw(likers):
+        liked = scatter(
+            power_law_ranks(rng, len(likers), total, args.like_skew),
+            total, args.seed) + 1
+
+        celebrity = rng.random(len(likers)) < args.celebrity_likes
+        authors = popular_users(rng, args, int(celebrity.sum()))
+        firsts = first_message_ids[authors]
+        posted = first_message_ids[authors + 1] - firsts
+        liked[celebrity] = np.where(
+            posted > 0,
+            firsts + (rng.random(len(authors)) * posted).astype(np.int64),
+            -1)
+
+        own = np.searchsorted(first_message_ids, liked, 'right') == likers
+        return np.where(own, -1, liked)
+
+    likers, liked = distinct_pairs(ids, wanted, draw, total + 1, PAIR_ROUNDS)
+
+    posted_at = message_timestamps(args, liked)
+    since = (np.datetime64(args.end, 'us') - posted_at).astype(np.int64)
+    delays = since * rng.random(len(liked)) ** LIKE_DELAY_POWER
+
+    return [
+        likers.astype(np.int32),
+        liked.astype(np.int32),
+        posted_at + delays.astype(np.int64).astype('timedelta64[us]'),
+    ]
+
+
+def write_shard(task):
+    """Generate and write one table's shard; return its manifest entry."""
+
+    args, table, shard = task
+    columns = GENERATORS[table](args, shard)
+
+    name = f"{table}.{shard:04d}{FORMATS[args.format]}"
+    path = os.path.join(args.out, name)
+
+    if args.format == 'csv':
+        write_csv(path, TABLES[table], columns)
+    else:
+        write_copy(path, columns)
+
+    return table, shard, name, len(columns[0])
+
+
+GENERATORS = {
+    'users': users,
+    'messages': messages,
+    'follows': follows,
+    'liked_messages': likes,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000,
+                        help="Mean total; the actual count varies a little.")
+    parser.add_argument('--follows', type=int, default=5000,
+                        help="Mean total; the actual count varies a little.")
+    parser.add_argument('--likes', type=int, default=3000,
+                        help="Mean total; the actual count varies a little.")
+    parser.add_argument('--follow-skew', type=float, default=1.1,
+                        help="Power-law exponent of user popularity; "
+                             "higher concentrates follows (and celebrity "
+                             "likes) on fewer users.")
+    parser.add_argument('--like-skew', type=float, default=1.2,
+                        help="Power-law exponent of message popularity; "
+                             "higher concentrates likes on fewer messages.")
+    parser.add_argument('--celebrity-likes', type=float, default=0.3,
+                        help="Share of likes that go to popular users' "
+                             "messages rather than hot messages.")
+    parser.add_argument('--days', type=int, default=730,
+                        help="Messages span this many days before --end.")
+    parser.add_argument('--end', type=date.fromisoformat,
+                        default=date.today(), help="YYYY-MM-DD")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--out', default=os.path.dirname(
+        os.path.abspath(__file__)))
+    parser.add_argument('--shard-users', type=int, default=50_000,
+                        help="Users per shard; memory per worker grows "
+                             "with it.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+
+    args = parser.parse_args()
+    args.shards = ceil(args.users / args.shard_users)
+    return args
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.out, exist_ok=True)
+    start = perf_counter()
+
+    # message ids run on from user to user, so count everyone's messages
+    counts = np.concatenate(
+        [message_counts(args, shard) for shard in range(args.shards)])
+    ids = np.concatenate(([1], 1 + np.cumsum(counts)))
+
+    tasks = [
+        (args, table, shard)
+        for table in TABLES
+        for shard in range(args.shards)
+    ]
+    manifest = {
+        'format': args.format,
+        'tables': {
+            table: {'columns': columns, 'files': [None] * args.shards,
+                    'rows': 0}
+            for table, columns in TABLES.items()
+        },
+    }
+
+    with Pool(args.workers, init_worker, (ids,)) as pool:
+        for table, shard, name, rows in pool.imap_unordered(
+                write_shard, tasks):
+            manifest['tables'][table]['files'][shard] = name
+            manifest['tables'][table]['rows'] += rows
+            print(f"{name}: {rows:,} rows ({perf_counter() - start:.1f}s)")
+
+    with open(os.path.join(args.out, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    for table, entry in manifest['tables'].items():
+        print(f"{table}: {entry['rows']:,} rows")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,193 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything here works on whole NumPy arrays at a time; see create_csvs.py.
+"""
 
+import csv
+import struct
+from math import gcd
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+import numpy as np
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+# PostgreSQL's binary COPY format: a fixed signature, no flags and no header
+# extension, then one tuple per row, then -1
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_TRAILER = struct.pack('>h', -1)
 
-    return datetime.fromtimestamp(random_timestamp)
+# binary COPY timestamps are microseconds since this
+PG_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+
+# big-endian (field length, value) pairs, per column dtype
+BINARY_FIELDS = {
+    np.dtype(np.int32): [('length', '>i4'), ('value', '>i4')],
+    np.dtype(np.int64): [('length', '>i4'), ('value', '>i8')],
+}
+
+
+def power_law_ranks(rng, size, n, exponent):
+    """Draw `size` ranks in [0, n); rank r comes up in proportion to
+    (r + 1) ** -exponent, so rank 0 is by far the most common.
+
+    Sampled by inverting the CDF of the continuous power law on [1, n + 1),
+    so nothing of size n is built.
+    """
+
+    u = rng.random(size)
+
+    if exponent == 1:
+        x = (n + 1) ** u
+    else:
+        a = 1 - exponent
+        x = (1 + u * ((n + 1) ** a - 1)) ** (1 / a)
+
+    return np.minimum(x.astype(np.int64) - 1, n - 1)
+
+
+def scatter(ranks, n, seed):
+    """Map ranks in [0, n) one-to-one onto [0, n), so e.g. the most
+    popular users aren't simply the lowest ids."""
+
+    multiplier = max(int(n * 0.6180339887) | 1, 1)
+    while gcd(multiplier, n) != 1:
+        multiplier += 2
+
+    return (ranks * multiplier + seed) % n
+
+
+def skewed_counts(rng, size, mean, sigma):
+    """`size` counts averaging `mean`, with a log-normal tail: most are
+    near the median, a few are many times the mean."""
+
+    if mean <= 0:
+        return np.zeros(size, dtype=np.int64)
+
+    return rng.poisson(rng.lognormal(np.log(mean) - sigma ** 2 / 2, sigma, size))
+
+
+def hashed_uniform(keys, seed):
+    """A float in [0, 1) for each integer key, the same every time for the
+    same key and seed (splitmix64), so e.g. any process can work out a
+    message's timestamp from its id alone."""
+
+    with np.errstate(over='ignore'):
+        z = np.asarray(keys, dtype=np.uint64) + np.uint64(
+            (seed * 0x9E3779B97F4A7C15 + 0x9E3779B97F4A7C15) % 2 ** 64)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+
+    return (z >> np.uint64(11)).astype(np.float64) / 2 ** 53
+
+
+def recent_timestamps(u, end, days):
+    """A datetime64 timestamp in the `days` before `end` for each uniform
+    `u`, denser towards `end`, as on a growing site."""
+
+    span = np.int64(days * 86_400_000_000)
+    ages = (np.asarray(u) ** 2 * span).astype(np.int64)
+
+    return np.datetime64(end, 'us') - ages.astype('timedelta64[us]')
+
+
+def distinct_pairs(ids, wanted, draw, n, rounds):
+    """Up to `wanted[i]` distinct targets in [0, n) for each of the
+    consecutive `ids`, as (sources, targets) sorted by source then target.
+
+    `draw(sources)` picks a target for each source, or -1 for none; repeats
+    and -1s are redrawn for up to `rounds` rounds.
+    """
+
+    ids = ids.astype(np.int64)
+    # (source, target) as source * n + target, kept sorted
+    pairs = np.empty(0, dtype=np.int64)
+
+    for _ in range(rounds):
+        have = np.bincount(pairs // n - ids[0], minlength=len(ids))
+        sources = np.repeat(ids, wanted - have)
+        if not len(sources):
+            break
+
+        targets = draw(sources)
+        pairs = np.sort(np.concatenate(
+            [pairs, (sources * n + targets)[targets >= 0]]))
+        pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))]
+
+    return np.divmod(pairs, n)
+
+
+def sentences(rng, size, words, min_words, max_words, max_length):
+    """`size` strings of `min_words` to `max_words` random `words`, cut to
+    `max_length` characters."""
+
+    picks = np.asarray(words, dtype=object)[
+        rng.integers(len(words), size=(size, max_words))].tolist()
+    lengths = rng.integers(min_words, max_words + 1, size=size).tolist()
+
+    return [' '.join(row[:length])[:max_length]
+            for row, length in zip(picks, lengths)]
+
+
+def _text_values(column):
+    if isinstance(column, np.ndarray) and column.dtype.kind == 'M':
+        return np.datetime_as_string(column.astype('datetime64[us]')).tolist()
+    if isinstance(column, np.ndarray):
+        return column.tolist()
+    return column
+
+
+def write_csv(path, header, columns):
+    """Write equal-length `columns` (arrays or lists) as CSV under `header`."""
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(zip(*map(_text_values, columns)))
+
+
+def _binary_fields(column):
+    """Each row's encoded field (length + value) for one column."""
+
+    if isinstance(column, np.ndarray) and column.dtype.kind == 'M':
+        column = (column.astype('datetime64[us]') - PG_EPOCH).astype(np.int64)
+
+    if isinstance(column, np.ndarray):
+        fields = np.empty(len(column), dtype=BINARY_FIELDS[column.dtype])
+        fields['length'] = column.dtype.itemsize
+        fields['value'] = column
+        return fields
+
+    encoded = [value.encode() for value in column]
+    return [struct.pack('>i', len(value)) + value for value in encoded]
+
+
+def write_copy(path, columns):
+    """Write equal-length `columns` in PostgreSQL's binary COPY format.
+
+    int32/int64 arrays become integer/bigint fields, datetime64 arrays
+    timestamps and lists of str text.
+    """
+
+    fields = [_binary_fields(column) for column in columns]
+    count = struct.pack('>h', len(columns))
+
+    with open(path, 'wb') as f:
+        f.write(COPY_HEADER)
+
+        if all(isinstance(field, np.ndarray) for field in fields):
+            # fixed-width rows: lay them out in one structured array
+            rows = np.empty(len(fields[0]), dtype=[('count', '>i2')] + [
+                (f'f{i}', field.dtype) for i, field in enumerate(fields)])
+            rows['count'] = len(columns)
+            for i, field in enumerate(fields):
+                rows[f'f{i}'] = field
+            rows.tofile(f)
+        else:
+            fields = [
+                field.view(f'V{field.dtype.itemsize}').tolist()
+                if isinstance(field, np.ndarray) else field
+                for field in fields
+            ]
+            f.write(b''.join(
+                count + b''.join(row) for row in zip(*fields)))
+
+        f.write(COPY_TRAILER)
@@ -0,0 +1,363 @@
+"""Password hashing off the request thread.
+
+bcrypt is deliberately slow (~250 ms a hash at the default cost), so a burst
+of logins would otherwise pin every web worker on CPU. `PasswordHasher` runs
+hashes in a small process pool instead and bounds how many can be waiting:
+
+- at most `PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE_SIZE` hashes are in
+  flight per web process; past that, requests get a 503 with Retry-After
+- each username and each client IP may have only a few hashes in flight
+  (`PASSWORD_HASH_MAX_PER_USERNAME` / `_PER_IP`); past that, a 429
+
+so a credential-stuffing burst is turned away cheaply instead of queueing up
+ahead of everyone else. Every hash is timed into `PasswordHasher.metrics`.
+
+With `PASSWORD_HASH_WORKERS = 0` hashes run inline on the request thread
+(still subject to the same limits).
+
+New hashes use a bcrypt cost calibrated at startup so that one hash takes
+at most `PASSWORD_HASH_TARGET_MS` on this host (or `PASSWORD_HASH_ROUNDS`,
+if set). Hashes stored at a lower cost are rehashed in the background
+after a successful login, so raising the target needs no password resets.
+Hashes at a higher cost are left alone: hosts calibrate separately, and two
+that settled on different costs mustn't rehash the same users back and
+forth. To lower the cost everywhere, set `PASSWORD_HASH_ROUNDS` for the
+whole fleet.
+"""
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from multiprocessing import get_context
+from threading import Lock
+from time import perf_counter
+
+from flask import current_app, has_request_context, request
+from werkzeug.exceptions import (
+    HTTPException, ServiceUnavailable, TooManyRequests,
+)
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_MAX_PER_USERNAME = 2
+DEFAULT_MAX_PER_IP = 4
+DEFAULT_RETRY_AFTER = 1
+DEFAULT_TARGET_MS = 100
+DEFAULT_MIN_ROUNDS = 10
+DEFAULT_MAX_ROUNDS = 16
+
+# cost used to time this host's hashing speed; cheap enough to run at startup
+PROBE_ROUNDS = 8
+
+# upper bounds (seconds) of the hash duration histogram
+DURATION_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float('inf'))
+
+
+class HashingBusy(ServiceUnavailable):
+    """Every hashing slot is taken; the client should retry shortly."""
+
+    description = "Too many logins in progress. Please try again shortly."
+
+
+class TooManyHashAttempts(TooManyRequests):
+    """This username or client already has its share of hashes running."""
+
+    description = "Too many attempts at once. Please try again shortly."
+
+
+##############################################################################
+# Run in the worker processes
+
+
+def _generate(bcrypt, password, rounds):
+    start = perf_counter()
+    pw_hash = bcrypt.generate_password_hash(password, rounds).decode('UTF-8')
+    return pw_hash, perf_counter() - start
+
+
+def _check(bcrypt, pw_hash, password):
+    start = perf_counter()
+    matches = bcrypt.check_password_hash(pw_hash, password)
+    return matches, perf_counter() - start
+
+
+##############################################################################
+# Work factor
+
+
+def bcrypt_cost(pw_hash):
+    """The cost (log2 rounds) a bcrypt hash like `$2b$12$...` was made with."""
+
+    return int(pw_hash.split('$')[2])
+
+
+def calibrate_rounds(bcrypt, target_seconds,
+                     min_rounds=DEFAULT_MIN_ROUNDS,
+                     max_rounds=DEFAULT_MAX_ROUNDS):
+    """Highest bcrypt cost that hashes within `target_seconds` on this host.
+
+    Times a few cheap hashes and extrapolates, since each step up in cost
+    doubles the work. Never goes below `min_rounds` or above `max_rounds`.
+    """
+
+    rounds = PROBE_ROUNDS
+    seconds = min(
+        _generate(bcrypt, "calibration", PROBE_ROUNDS)[1] for _ in range(3))
+
+    while rounds < max_rounds and seconds * 2 <= target_seconds:
+        rounds += 1
+        seconds *= 2
+
+    return max(rounds, min_rounds)
+
+
+##############################################################################
+# Metrics
+
+
+class HashMetrics:
+    """Counts and timings of password hashes, by operation."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = Counter()
+            self.seconds = Counter()
+            self.wait_seconds = Counter()
+            self.max_seconds = Counter()
+            self.buckets = Counter()
+            self.rejected = Counter()
+
+    def observe(self, operation, seconds, wait_seconds):
+        """Record one `operation` that hashed for `seconds` after waiting."""
+
+        with self._lock:
+            self.count[operation] += 1
+            self.seconds[operation] += seconds
+            self.wait_seconds[operation] += wait_seconds
+            self.max_seconds[operation] = max(
+                self.max_seconds[operation], seconds)
+
+            for bound in DURATION_BUCKETS:
+                if seconds <= bound:
+                    self.buckets[operation, bound] += 1
+
+    def reject(self, reason):
+        """Record a hash turned away for `reason`."""
+
+        with self._lock:
+            self.rejected[reason] += 1
+
+    def snapshot(self):
+        """Return the metrics so far as a plain dict."""
+
+        with self._lock:
+            return {
+                "operations": {
+                    operation: {
+                        "count": self.count[operation],
+                        "seconds": self.seconds[operation],
+                        "wait_seconds": self.wait_seconds[operation],
+                        "max_seconds": self.max_seconds[operation],
+                        "buckets": {
+                            bound: self.buckets[operation, bound]
+                            for bound in DURATION_BUCKETS
+                        },
+                    }
+                    for operation in self.count
+                },
+                "rejected": dict(self.rejected),
+            }
+
+
+##############################################################################
+# Service
+
+
+class PasswordHasher:
+    """Bounded, pooled front end to a Flask-Bcrypt `bcrypt` object."""
+
+    def __init__(self, bcrypt, app=None):
+        self.bcrypt = bcrypt
+        self.metrics = HashMetrics()
+
+        self.workers = 0
+        self.queue_size = DEFAULT_QUEUE_SIZE
+        self.max_per_username = DEFAULT_MAX_PER_USERNAME
+        self.max_per_ip = DEFAULT_MAX_PER_IP
+        self.retry_after = DEFAULT_RETRY_AFTER
+        self.rounds = DEFAULT_MIN_ROUNDS
+
+        self._executor = None
+        self._background = None
+        self._pending = set()
+        self._lock = Lock()
+        self._in_flight = 0
+        self._per_key = Counter()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read pool size and limits from `app.config`; set the bcrypt cost."""
+
+        config = app.config
+        self.workers = config.get('PASSWORD_HASH_WORKERS', DEFAULT_WORKERS)
+        self.queue_size = config.get(
+            'PASSWORD_HASH_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)
+        self.max_per_username = config.get(
+            'PASSWORD_HASH_MAX_PER_USERNAME', DEFAULT_MAX_PER_USERNAME)
+        self.max_per_ip = config.get(
+            'PASSWORD_HASH_MAX_PER_IP', DEFAULT_MAX_PER_IP)
+        self.retry_after = config.get(
+            'PASSWORD_HASH_RETRY_AFTER', DEFAULT_RETRY_AFTER)
+
+        self.rounds = config.get('PASSWORD_HASH_ROUNDS') or calibrate_rounds(
+            self.bcrypt,
+            config.get('PASSWORD_HASH_TARGET_MS', DEFAULT_TARGET_MS) / 1000,
+            config.get('PASSWORD_HASH_MIN_ROUNDS', DEFAULT_MIN_ROUNDS),
+            config.get('PASSWORD_HASH_MAX_ROUNDS', DEFAULT_MAX_ROUNDS),
+        )
+        app.logger.info("Hashing passwords with bcrypt cost %s", self.rounds)
+
+        self.shutdown()
+
+    def shutdown(self):
+        """Stop the worker processes (a new pool starts on next use)."""
+
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn, not fork: forking would copy the parent's open
+                # database connections and threads into the workers
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=get_context('spawn'),
+                )
+
+            return self._executor
+
+    @contextmanager
+    def slot(self, username=None):
+        """Hold one hashing slot for `username` and the current client.
+
+        Raises `TooManyHashAttempts` if either already has its limit in
+        flight, or `HashingBusy` if every slot is taken.
+        """
+
+        keys = []
+        if username:
+            keys.append(("username", username.lower(), self.max_per_username))
+        if has_request_context() and request.remote_addr:
+            keys.append(("ip", request.remote_addr, self.max_per_ip))
+
+        with self._lock:
+            for kind, key, limit in keys:
+                if self._per_key[kind, key] >= limit:
+                    self.metrics.reject(kind)
+                    raise TooManyHashAttempts(retry_after=self.retry_after)
+
+            if self._in_flight >= self.workers + self.queue_size:
+                self.metrics.reject("queue")
+                raise HashingBusy(retry_after=self.retry_after)
+
+            self._in_flight += 1
+            for kind, key, _ in keys:
+                self._per_key[kind, key] += 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                for kind, key, _ in keys:
+                    self._per_key[kind, key] -= 1
+                    if not self._per_key[kind, key]:
+                        del self._per_key[kind, key]
+
+    def _run(self, operation, fn, *args, username=None):
+        with self.slot(username):
+            queued_at = perf_counter()
+
+            if self.workers:
+                try:
+                    result, seconds = self._pool().submit(
+                        fn, self.bcrypt, *args).result()
+                except BrokenProcessPool:
+                    # a worker died; start afresh on the next request
+                    self.shutdown()
+                    self.metrics.reject("broken")
+                    raise HashingBusy(retry_after=self.retry_after)
+            else:
+                result, seconds = fn(self.bcrypt, *args)
+
+            wait_seconds = perf_counter() - queued_at - seconds
+            self.metrics.observe(operation, seconds, max(wait_seconds, 0))
+
+            return result
+
+    def generate_password_hash(self, password, username=None):
+        """Hash `password` (for `username`); returns the hash as a string."""
+
+        if not password:
+            raise ValueError('Password must be non-empty.')
+
+        return self._run(
+            "generate", _generate, password, self.rounds, username=username)
+
+    def check_password_hash(self, pw_hash, password, username=None):
+        """Does `password` (for `username`) match `pw_hash`?"""
+
+        return self._run(
+            "check", _check, pw_hash, password, username=username)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made at a cost below the current target?"""
+
+        return bcrypt_cost(pw_hash) < self.rounds
+
+    def rehash_in_background(self, password, save):
+        """Hash `password` at the target cost, then call `save(new_hash)`.
+
+        Runs on a background thread inside an app context, after the current
+        request has been answered. Skipped quietly if hashing is busy; the
+        next login will try again.
+        """
+
+        app = current_app._get_current_object()
+
+        def rehash():
+            with app.app_context():
+                try:
+                    new_hash = self._run(
+                        "rehash", _generate, password, self.rounds)
+                except HTTPException:
+                    return
+
+                save(new_hash)
+
+        with self._lock:
+            if self._background is None:
+                self._background = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="rehash")
+
+            future = self._background.submit(rehash)
+            self._pending.add(future)
+
+        future.add_done_callback(self._pending.discard)
+        return future
+
+    def wait_for_rehashes(self, timeout=None):
+        """Block until background rehashes started so far have finished."""
+
+        wait(list(self._pending), timeout=timeout)
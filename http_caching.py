@@ -0,0 +1,128 @@
+"""HTTP caching policy for Warbler.
+
+- Static files are linked with a hash of their contents in the URL (`?v=`),
+  so a given URL never changes and can be cached for a year as immutable.
+- Profile, message and follow-list pages get a weak ETag built from the
+  versions of the rows they show (see `User.version`) plus who is looking.
+  `abort_if_unchanged` answers a matching If-None-Match with a 304 before
+  the page is queried for or rendered.
+- These pages are personal (stars, follow buttons, CSRF tokens), so they
+  are only ever `private`; everything else stays `no-store`.
+"""
+
+import os
+from functools import lru_cache
+from hashlib import sha1
+from time import time
+
+from flask import abort, current_app, g, request, session
+from sqlalchemy import select
+
+from models import db, User
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+ETAG_KEY = 'warbler.etag'
+
+
+@lru_cache(maxsize=None)
+def _file_hash(path, mtime):
+    with open(path, 'rb') as file:
+        return sha1(file.read()).hexdigest()[:12]
+
+
+def static_version(filename):
+    """Short hash of static file `filename`'s contents, or None if missing."""
+
+    path = os.path.join(current_app.static_folder, filename)
+
+    try:
+        return _file_hash(path, os.path.getmtime(path))
+    except OSError:
+        return None
+
+
+@lru_cache(maxsize=None)
+def templates_version(template_folder):
+    """Short hash of every template under `template_folder`."""
+
+    digest = sha1()
+
+    for root, dirs, files in sorted(os.walk(template_folder)):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as file:
+                digest.update(file.read())
+
+    return digest.hexdigest()[:12]
+
+
+def page_etag(*versions):
+    """Weak ETag for the current page showing rows at `versions`.
+
+    Also covers the viewer (and their CSRF secret, so a cached page's forms
+    still work), the URL, the response format and the templates in use.
+    The viewer's version is read fresh rather than from `g.user`, which may
+    be a snapshot cached before a like or follow made in another process.
+    """
+
+    viewer = g.get('user')
+    viewer_version = viewer and db.session.scalar(
+        select(User.version).where(User.id == viewer.id))
+    csrf_lifetime = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+
+    parts = (
+        templates_version(
+            os.path.join(current_app.root_path, current_app.template_folder)),
+        request.full_path,
+        request.accept_mimetypes.best_match(['text/html', 'application/json']),
+        viewer.id if viewer else None,
+        viewer_version,
+        session.get('csrf_token'),
+        # revalidate well before embedded CSRF tokens expire
+        int(time() // (csrf_lifetime / 2)),
+    ) + versions
+
+    return sha1(repr(parts).encode()).hexdigest()
+
+
+def abort_if_unchanged(*versions):
+    """End the request with a 304 if the client has this page already.
+
+    Otherwise, remembers the ETag so `apply_cache_policy` sends it with the
+    page. A page with flashed messages pending is always rendered, so the
+    messages aren't lost.
+    """
+
+    # Kept in the WSGI environ rather than `g`: connect_db pushes an app
+    # context that outlives requests, so `g` isn't reset between them.
+    etag = request.environ[ETAG_KEY] = page_etag(*versions)
+
+    if '_flashes' in session:
+        return
+
+    if request.if_none_match.contains_weak(etag):
+        abort(current_app.response_class(status=304))
+
+
+def apply_cache_policy(response):
+    """Set Cache-Control (and ETag) on `response` for the current request."""
+
+    if request.endpoint == 'static':
+        version = request.args.get('v')
+
+        if version and version == static_version(request.view_args['filename']):
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+
+    elif ETAG_KEY in request.environ and response.status_code in (200, 304):
+        response.set_etag(request.environ[ETAG_KEY], weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.update(('Cookie', 'Accept'))
+
+    else:
+        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
+        response.cache_control.no_store = True
+
+    return response
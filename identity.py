@@ -0,0 +1,122 @@
+"""Cached identity of the logged-in user.
+
+Every request needs to know who is logged in, but most only render the
+user's name, pictures and counts. `UserSnapshot` holds just those columns
+(and the row's version, for ETags) and is kept in an LRU cache between
+requests; `CurrentUser` wraps it for the length of one request and loads the
+full `User` row only when a view or template touches something the snapshot
+doesn't have.
+
+Writes that change a user's row, counters included, drop their snapshot
+from the cache; other workers' copies expire after `USER_CACHE_TTL`.
+"""
+
+from werkzeug.exceptions import Unauthorized
+
+from models import db, Follow, User
+
+
+class UserSnapshot:
+    """Read-only copy of the user columns templates render from."""
+
+    __slots__ = (
+        'id',
+        'username',
+        'image_url',
+        'header_image_url',
+        'bio',
+        'location',
+        'messages_count',
+        'following_count',
+        'followers_count',
+        'likes_count',
+        'version',
+    )
+
+    def __init__(self, user):
+        for name in self.__slots__:
+            object.__setattr__(self, name, getattr(user, name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("UserSnapshot is read-only")
+
+    def __repr__(self):
+        return f"<UserSnapshot #{self.id}: {self.username}>"
+
+
+class CurrentUser:
+    """The logged-in user for one request.
+
+    Snapshot columns are answered from the cache. Anything else (e.g.
+    `.following`, `.messages`) is looked up on the full `User`, which is
+    loaded from the database the first time it's needed. Views that change
+    the user should work on `.record` directly.
+    """
+
+    __slots__ = ('snapshot', '_record')
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self._record = None
+
+    @property
+    def record(self):
+        """The full `User` row, loaded on first use."""
+
+        if self._record is None:
+            self._record = db.session.get(User, self.snapshot.id)
+
+            if self._record is None:
+                # deleted since it was cached (e.g. by another worker)
+                raise Unauthorized()
+
+        return self._record
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`?"""
+
+        return Follow.exists(self.id, other_user.id)
+
+    def is_followed_by(self, other_user):
+        """Is this user followed by `other_user`?"""
+
+        return Follow.exists(other_user.id, self.id)
+
+    def __getattr__(self, name):
+        if name in UserSnapshot.__slots__:
+            return getattr(self.snapshot, name)
+
+        return getattr(self.record, name)
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
+def load_current_user(user_id, cache):
+    """Return a `CurrentUser` for `user_id`, or None if there's no such user.
+
+    Looks in `cache` first; on a miss, reads the user and caches a snapshot.
+    """
+
+    snapshot = cache.get(user_id)
+
+    if snapshot is None:
+        user = db.session.get(User, user_id)
+
+        if user is None:
+            return None
+
+        snapshot = UserSnapshot(user)
+        cache.set(user_id, snapshot)
+
+        current_user = CurrentUser(snapshot)
+        current_user._record = user
+        return current_user
+
+    return CurrentUser(snapshot)
@@ -0,0 +1,333 @@
+"""Per-request SQL and template profiling.
+
+`Profiler` listens on the database engine and on Flask's request and
+template signals, and for each request tallies:
+
+- SQL statements sent, and time spent in them
+- the slowest statement, as a fingerprint (literals and parameters
+  replaced by `?`), so it can be shown without leaking data
+- time spent rendering templates
+
+It sends them back in a `Server-Timing` header (`SERVER_TIMING`), which
+browser dev tools show per request, and adds them up per endpoint for
+`render_metrics`, which formats them (and the password hasher's metrics)
+for Prometheus at /metrics. Totals are per process; Prometheus scrapes and
+sums each web worker.
+
+With `MAX_QUERIES_PER_REQUEST` set (every test module that makes requests
+sets it), any request that sends more statements fails with
+`TooManyQueries`, so an N+1 query pattern (e.g. a lazy load per row of a
+list) breaks the build instead of slowing down production.
+
+The per-statement work is two clock reads and a few additions, about
+three microseconds against the hundreds a round trip to PostgreSQL takes;
+the rest happens once per request.
+"""
+
+import re
+from collections import defaultdict
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+
+from flask import (
+    current_app, request, request_started,
+    template_rendered, before_render_template,
+)
+from sqlalchemy import event
+
+PROFILE_KEY = 'warbler.profile'
+
+# upper bounds of the request duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                    float('inf'))
+
+FINGERPRINT_LENGTH = 300
+
+# quoted strings, numbers and bind parameters (psycopg2's %(name)s style)
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s")
+
+# lists of them, e.g. IN (?, ?, ?), however long
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+# column labels in select lists ("users.id AS users_id, ..."), which make
+# SQLAlchemy's statements twice as long and say nothing new
+_LABELS = re.compile(r"\s+AS\s+\w+(?=\s*,|\s+FROM\b)")
+
+
+class TooManyQueries(AssertionError):
+    """A request sent more SQL statements than `MAX_QUERIES_PER_REQUEST`."""
+
+
+def fingerprint(statement):
+    """`statement` with its values taken out, so that every run of the same
+    query reads the same: "SELECT ... WHERE id = ? AND x IN (...)"."""
+
+    statement = _LISTS.sub('(...)', _LITERALS.sub('?', statement))
+    statement = _LABELS.sub('', statement)
+    return ' '.join(statement.split())[:FINGERPRINT_LENGTH]
+
+
+class RequestProfile:
+    """What one request has done so far."""
+
+    __slots__ = ('start', 'queries', 'db_seconds', 'slowest_seconds',
+                 'slowest_statement', 'template_seconds', 'template_depth',
+                 'template_start')
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        self.template_start = 0.0
+
+
+class EndpointMetrics:
+    """Totals per endpoint, since the process started."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = defaultdict(int)
+            self.seconds = defaultdict(float)
+            self.buckets = defaultdict(int)
+            self.queries = defaultdict(int)
+            self.db_seconds = defaultdict(float)
+            self.template_seconds = defaultdict(float)
+            # endpoint: (seconds, fingerprint) of its slowest statement
+            self.slowest = {}
+
+    def observe(self, endpoint, seconds, profile):
+        """Record one request to `endpoint` that took `seconds`."""
+
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.seconds[endpoint] += seconds
+            self.queries[endpoint] += profile.queries
+            self.db_seconds[endpoint] += profile.db_seconds
+            self.template_seconds[endpoint] += profile.template_seconds
+
+            for bound in DURATION_BUCKETS:
+                if seconds <= bound:
+                    self.buckets[endpoint, bound] += 1
+
+            slowest = self.slowest.get(endpoint)
+            if profile.slowest_statement and (
+                    not slowest or profile.slowest_seconds > slowest[0]):
+                self.slowest[endpoint] = (
+                    profile.slowest_seconds,
+                    fingerprint(profile.slowest_statement))
+
+
+class Profiler:
+    """Per-request SQL and template timings for a Flask app."""
+
+    def __init__(self, app=None, engine=None):
+        self.metrics = EndpointMetrics()
+        self._current = ContextVar(PROFILE_KEY, default=None)
+
+        if app is not None:
+            self.init_app(app, engine)
+
+    def init_app(self, app, engine):
+        """Profile `app`'s requests, and the statements sent on `engine`."""
+
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'handle_error', self._execute_failed)
+        request_started.connect(self._start, app)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        app.after_request(self._finish)
+        app.teardown_request(self._record)
+
+    # kept in a context variable, not g: the app context (and so g) can
+    # outlive a single request here, and `request` is a proxy, costing
+    # more to look up than the rest of the per-statement work together
+
+    def profile(self):
+        """The current request's `RequestProfile`, or None outside of a
+        request being handled."""
+
+        return self._current.get()
+
+    def count(self):
+        """Statements the current request has sent so far."""
+
+        return self.profile().queries
+
+    def _start(self, sender, **extra):
+        profile = request.environ[PROFILE_KEY] = RequestProfile()
+        self._current.set(profile)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        many):
+        profile = self.profile()
+
+        if profile:
+            profile.queries += 1
+            conn.info.setdefault(PROFILE_KEY, []).append(perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       many):
+        profile = self.profile()
+        starts = conn.info.get(PROFILE_KEY)
+
+        if profile and starts:
+            seconds = perf_counter() - starts.pop()
+            profile.db_seconds += seconds
+
+            if seconds > profile.slowest_seconds:
+                profile.slowest_seconds = seconds
+                profile.slowest_statement = statement
+
+    def _execute_failed(self, context):
+        # no connection if it was connecting that failed
+        starts = context.connection and context.connection.info.get(
+            PROFILE_KEY)
+
+        if self.profile() and starts:
+            starts.pop()
+
+    def _before_render(self, sender, **extra):
+        profile = self.profile()
+
+        if not profile:
+            return
+
+        # a template rendered while rendering another is counted once
+        if not profile.template_depth:
+            profile.template_start = perf_counter()
+        profile.template_depth += 1
+
+    def _after_render(self, sender, **extra):
+        profile = self.profile()
+
+        if not profile:
+            return
+
+        profile.template_depth -= 1
+        if not profile.template_depth:
+            profile.template_seconds += (
+                perf_counter() - profile.template_start)
+
+    def _finish(self, response):
+        profile = self.profile()
+        limit = current_app.config.get('MAX_QUERIES_PER_REQUEST')
+
+        if limit and profile.queries > limit:
+            raise TooManyQueries(
+                f"{request.method} {request.full_path} sent "
+                f"{profile.queries} SQL statements (limit {limit})")
+
+        if current_app.config.get('SERVER_TIMING'):
+            response.headers['Server-Timing'] = (
+                f'db;dur={profile.db_seconds * 1000:.1f};'
+                f'desc="{profile.queries} queries", '
+                f'tpl;dur={profile.template_seconds * 1000:.1f}, '
+                f'app;dur={(perf_counter() - profile.start) * 1000:.1f}')
+
+        return response
+
+    def _record(self, exc):
+        # popped, as a context can be torn down twice; and test request
+        # contexts (e.g. session_transaction), never started, are skipped
+        profile = request.environ.pop(PROFILE_KEY, None)
+
+        # the test client tears a request down once the next one started
+        if profile is self._current.get():
+            self._current.set(None)
+
+        if profile:
+            self.metrics.observe(
+                request.endpoint or 'unmatched',
+                perf_counter() - profile.start,
+                profile)
+
+
+def _label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def render_metrics(metrics, hash_metrics):
+    """`metrics` (an `EndpointMetrics`) and the password hasher's
+    `hash_metrics` in Prometheus's text exposition format."""
+
+    lines = []
+
+    def family(name, kind, help):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    with metrics._lock:
+        endpoints = sorted(metrics.requests)
+
+        family('warbler_http_request_duration_seconds', 'histogram',
+               "Time to handle a request, by endpoint.")
+        for endpoint in endpoints:
+            label = f'endpoint="{_label(endpoint)}"'
+            for bound in DURATION_BUCKETS:
+                lines.append(
+                    f'warbler_http_request_duration_seconds_bucket'
+                    f'{{{label},le="{_bound(bound)}"}} '
+                    f'{metrics.buckets[endpoint, bound]}')
+            lines.append(f'warbler_http_request_duration_seconds_sum'
+                         f'{{{label}}} {metrics.seconds[endpoint]}')
+            lines.append(f'warbler_http_request_duration_seconds_count'
+                         f'{{{label}}} {metrics.requests[endpoint]}')
+
+        for name, totals, help in [
+            ('warbler_db_queries_total', metrics.queries,
+             "SQL statements sent, by endpoint."),
+            ('warbler_db_seconds_total', metrics.db_seconds,
+             "Time spent in SQL statements, by endpoint."),
+            ('warbler_template_seconds_total', metrics.template_seconds,
+             "Time spent rendering templates, by endpoint."),
+        ]:
+            family(name, 'counter', help)
+            for endpoint in endpoints:
+                lines.append(
+                    f'{name}{{endpoint="{_label(endpoint)}"}} '
+                    f'{totals[endpoint]}')
+
+        family('warbler_db_slowest_query_seconds', 'gauge',
+               "The slowest SQL statement seen, by endpoint.")
+        for endpoint, (seconds, statement) in sorted(metrics.slowest.items()):
+            lines.append(
+                f'warbler_db_slowest_query_seconds{{endpoint='
+                f'"{_label(endpoint)}",statement="{_label(statement)}"}} '
+                f'{seconds}')
+
+    hashes = hash_metrics.snapshot()
+
+    family('warbler_password_hash_seconds', 'histogram',
+           "Time spent hashing passwords, by operation.")
+    for operation, stats in sorted(hashes['operations'].items()):
+        label = f'operation="{_label(operation)}"'
+        for bound, count in stats['buckets'].items():
+            lines.append(f'warbler_password_hash_seconds_bucket'
+                         f'{{{label},le="{_bound(bound)}"}} {count}')
+        lines.append(f'warbler_password_hash_seconds_sum{{{label}}} '
+                     f'{stats["seconds"]}')
+        lines.append(f'warbler_password_hash_seconds_count{{{label}}} '
+                     f'{stats["count"]}')
+
+    family('warbler_password_hash_rejected_total', 'counter',
+           "Password hashes turned away, by reason.")
+    for reason, count in sorted(hashes['rejected'].items()):
+        lines.append(f'warbler_password_hash_rejected_total'
+                     f'{{reason="{_label(reason)}"}} {count}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,129 @@
+"""Most-liked messages over a rolling window.
+
+Every like adds one to its message's bucket for the hour it was made in
+(`MessageLikeBucket`, maintained by trigger; see models.py), so the top
+messages of the last day or week are a sum over at most a week of buckets,
+read by range from the primary key. Neither reading the leaderboard nor
+refreshing it ever touches likes outside the window.
+
+Windows are exact: "24h" is the 24 hours up to now. The hours wholly inside
+come from buckets; the part of an hour at the start of the window is
+counted from the likes themselves (by the liked_at index).
+
+`refresh_like_buckets` rebuilds the recent buckets from `liked_messages`
+(e.g. after a bulk load with triggers off) and drops buckets too old to be
+in any window (`prune_like_buckets`). The trigger only ever adds buckets, so
+run `flask refresh-like-buckets --hours 1` every hour (from cron, say) to
+keep message_like_buckets to a week of rows; recounting one hour is cheap.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import (
+    Integer, delete, desc, func, insert, select, union_all,
+)
+
+from models import db, LikedMessages, Message, MessageLikeBucket, User
+
+# leaderboard windows, by the name used in URLs
+TOP_WINDOWS = {
+    '24h': timedelta(hours=24),
+    '7d': timedelta(days=7),
+}
+
+DEFAULT_TOP_WINDOW = '24h'
+
+# buckets older than the longest window are never read again
+BUCKET_RETENTION = max(TOP_WINDOWS.values())
+
+
+def hour_start(moment):
+    """The start of the hour `moment` falls in."""
+
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def window_start(window, now=None):
+    """`(start, first_hour)`: when `window` (a timedelta) ending `now`
+    starts, and the first hour bucket wholly inside it."""
+
+    start = (now or datetime.utcnow()) - window
+    first_hour = hour_start(start)
+
+    if first_hour < start:
+        first_hour += timedelta(hours=1)
+
+    return start, first_hour
+
+
+def top_messages(window, limit, now=None):
+    """The `limit` most-liked messages in `window`, with their authors.
+
+    Returns `(message, user, likes)` rows, most likes first (ties go to the
+    newer message).
+    """
+
+    start, first_hour = window_start(window, now)
+
+    counts = union_all(
+        select(MessageLikeBucket.message_id, MessageLikeBucket.likes)
+        .where(MessageLikeBucket.hour >= first_hour),
+        # integer, like buckets.likes, so that the sum stays a bigint
+        select(LikedMessages.message_id, func.count().cast(Integer))
+        .where(LikedMessages.liked_at >= start,
+               LikedMessages.liked_at < first_hour)
+        .group_by(LikedMessages.message_id),
+    ).subquery()
+
+    likes = func.sum(counts.c.likes).label('likes')
+
+    top = (select(counts.c.message_id, likes)
+           .group_by(counts.c.message_id)
+           .having(likes > 0)
+           .order_by(desc(likes), counts.c.message_id.desc())
+           .limit(limit)
+           .subquery())
+
+    return db.session.execute(
+        select(Message, User, top.c.likes)
+        .join(top, top.c.message_id == Message.id)
+        .join(User, User.id == Message.user_id)
+        .order_by(top.c.likes.desc(), Message.id.desc())
+    ).all()
+
+
+def refresh_like_buckets(since, now=None):
+    """Rebuild every bucket from the hour of `since` onwards, and drop the
+    buckets that have aged out of every window as of `now`.
+
+    Recounts only the likes made since then (by the liked_at index).
+    Returns how many buckets were written and how many were pruned.
+    """
+
+    since = hour_start(since)
+    hour = func.date_trunc('hour', LikedMessages.liked_at)
+
+    db.session.execute(
+        delete(MessageLikeBucket).where(MessageLikeBucket.hour >= since))
+
+    result = db.session.execute(
+        insert(MessageLikeBucket).from_select(
+            ['hour', 'message_id', 'likes'],
+            select(hour, LikedMessages.message_id, func.count())
+            .where(LikedMessages.liked_at >= since)
+            .group_by(hour, LikedMessages.message_id)))
+
+    pruned = prune_like_buckets(
+        (now or datetime.utcnow()) - BUCKET_RETENTION)
+
+    return result.rowcount, pruned
+
+
+def prune_like_buckets(before):
+    """Drop buckets for hours before `before`; returns how many."""
+
+    result = db.session.execute(
+        delete(MessageLikeBucket)
+        .where(MessageLikeBucket.hour < hour_start(before)))
+
+    return result.rowcount
@@ -0,0 +1,298 @@
+"""Bulk loading CSV files into the database with COPY.
+
+A directory of CSVs named after their tables (users.csv, messages.csv,
+follows.csv, liked_messages.csv; any may be missing) is streamed into
+PostgreSQL with `COPY ... FROM STDIN`, `chunk_rows` rows per COPY, so
+memory use doesn't grow with the file. Each file's header names the columns
+it fills; an `id` column may be given, and the id sequences are moved past
+the largest id loaded afterwards.
+
+If the directory has a manifest.json (as generator/create_csvs.py writes),
+it lists each table's columns and files instead, and the files may be in
+PostgreSQL's binary COPY format; each binary file is one COPY.
+
+A fresh load (the default) recreates the schema, then until the data is in:
+
+- drops the secondary indexes and foreign keys of the loaded and derived
+  tables, and recreates them afterwards (one sort per index, and one pass
+  per foreign key, instead of row-at-a-time maintenance)
+- disables the counter triggers, then recomputes counters, timelines and
+  like buckets in bulk
+
+An append load (`append=True`) adds to the data already there and leaves
+the schema alone: indexes, foreign keys and triggers stay in place, so the
+counters and buckets keep themselves current. Each messages and follows file
+is copied into a temporary table first, so that only the rows it adds are
+fanned out to timelines (see `timeline.add_loaded_messages`).
+
+Progress (rows and rows/second per file) is passed to `report`.
+
+A fresh load that fails part way leaves a half-built database; run it
+again.
+"""
+
+import io
+import json
+import os
+from datetime import datetime
+from time import perf_counter
+
+from sqlalchemy import column, table as table_clause, text
+
+from leaderboard import BUCKET_RETENTION, refresh_like_buckets
+from models import db, reconcile_counters
+from timeline import (
+    add_loaded_follows, add_loaded_messages, rebuild_timelines,
+)
+
+# tables loaded from CSV, in dependency order
+LOAD_ORDER = ('users', 'messages', 'follows', 'liked_messages')
+
+# tables filled from the loaded ones afterwards
+DERIVED_TABLES = ('timeline_entries', 'message_like_buckets')
+
+# tables whose ids come from a sequence
+SERIAL_TABLES = ('users', 'messages')
+
+# what an append load does with each file's new rows, once staged
+APPEND_FAN_OUT = {
+    'messages': add_loaded_messages,
+    'follows': add_loaded_follows,
+}
+
+# the temporary table they're staged in
+STAGING_TABLE = 'staged_rows'
+
+DEFAULT_CHUNK_ROWS = 100_000
+
+MANIFEST = 'manifest.json'
+
+
+def csv_records(lines, chunk_rows):
+    """Group CSV `lines` into chunks of up to `chunk_rows` whole records.
+
+    A record can span lines when a quoted field holds a newline; it ends
+    once its quotes balance.
+    """
+
+    chunk = []
+    records = 0
+    quotes = 0
+
+    for line in lines:
+        chunk.append(line)
+        quotes += line.count('"')
+
+        if quotes % 2 == 0:
+            records += 1
+
+            if records == chunk_rows:
+                yield chunk, records
+                chunk, records = [], 0
+
+    if chunk:
+        yield chunk, records
+
+
+def print_progress(table, rows, seconds):
+    print(f"{table}: {rows:,} rows in {seconds:.1f}s "
+          f"({rows / max(seconds, 1e-9):,.0f} rows/s)")
+
+
+def table_files(directory):
+    """[(table, format, columns, paths)] to load from `directory`, in load
+    order. `columns` is None for CSVs, whose headers name them."""
+
+    manifest_path = os.path.join(directory, MANIFEST)
+
+    if not os.path.exists(manifest_path):
+        return [
+            (table, 'csv', None, [os.path.join(directory, f"{table}.csv")])
+            for table in LOAD_ORDER
+            if os.path.exists(os.path.join(directory, f"{table}.csv"))
+        ]
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    return [
+        (table, manifest['format'], manifest['tables'][table]['columns'],
+         [os.path.join(directory, name)
+          for name in manifest['tables'][table]['files']])
+        for table in LOAD_ORDER
+        if table in manifest['tables']
+    ]
+
+
+def _check_columns(table, columns, path):
+    unknown = set(columns) - set(db.metadata.tables[table].c.keys())
+
+    if unknown:
+        raise ValueError(
+            f"{path}: no such column(s) in {table}: {sorted(unknown)}")
+
+
+def copy_csv(table, path, chunk_rows=DEFAULT_CHUNK_ROWS,
+             report=print_progress, into=None):
+    """COPY the CSV at `path` into `table` (or the table `into`, shaped
+    like it), `chunk_rows` rows at a time.
+
+    Returns how many rows were loaded.
+    """
+
+    cursor = db.session.connection().connection.cursor()
+    start = perf_counter()
+    loaded = 0
+
+    with open(path, newline='') as lines:
+        columns = lines.readline().strip().split(',')
+        _check_columns(table, columns, path)
+
+        statement = (f"COPY {into or table} ({', '.join(columns)}) "
+                     f"FROM STDIN WITH (FORMAT csv)")
+
+        for chunk, records in csv_records(lines, chunk_rows):
+            cursor.copy_expert(statement, io.StringIO(''.join(chunk)))
+            loaded += records
+            report(table, loaded, perf_counter() - start)
+
+    return loaded
+
+
+def copy_binary(table, path, columns, report=print_progress, into=None):
+    """COPY the binary COPY file at `path` into `table`'s `columns` (or
+    those of the table `into`, shaped like it).
+
+    Returns how many rows were loaded.
+    """
+
+    _check_columns(table, columns, path)
+    cursor = db.session.connection().connection.cursor()
+    start = perf_counter()
+
+    with open(path, 'rb') as f:
+        cursor.copy_expert(
+            f"COPY {into or table} ({', '.join(columns)}) FROM STDIN "
+            f"WITH (FORMAT binary)", f)
+
+    report(table, cursor.rowcount, perf_counter() - start)
+    return cursor.rowcount
+
+
+def _deferred_ddl(tables):
+    """(drop, create) statements for the secondary indexes and foreign
+    keys of `tables`, as the catalog has them now."""
+
+    # indexes first, so they're in place to check the foreign keys against
+    rows = db.session.execute(text("""
+        SELECT format('DROP INDEX %s', indexrelid::regclass),
+               pg_get_indexdef(indexrelid)
+        FROM pg_index
+        WHERE indrelid::regclass::text = ANY(:tables)
+        AND NOT indisprimary AND NOT indisunique
+    UNION ALL
+        SELECT format('ALTER TABLE %s DROP CONSTRAINT %I',
+                      conrelid::regclass, conname),
+               format('ALTER TABLE %s ADD CONSTRAINT %I %s',
+                      conrelid::regclass, conname,
+                      pg_get_constraintdef(oid))
+        FROM pg_constraint
+        WHERE contype = 'f' AND conrelid::regclass::text = ANY(:tables)
+    """), {'tables': list(tables)}).all()
+
+    return [drop for drop, _ in rows], [create for _, create in rows]
+
+
+def _set_triggers(tables, enabled):
+    for table in tables:
+        db.session.execute(text(
+            f"ALTER TABLE {table} "
+            f"{'ENABLE' if enabled else 'DISABLE'} TRIGGER USER"))
+
+
+def reset_sequences():
+    """Move each id sequence past the largest id in its table."""
+
+    for table in SERIAL_TABLES:
+        db.session.execute(text(f"""
+            SELECT setval(pg_get_serial_sequence('{table}', 'id'),
+                          COALESCE(max(id), 1), max(id) IS NOT NULL)
+            FROM {table}
+        """))
+
+
+def _staged(table, copy):
+    """`copy` (a function of the table to COPY into) into a temporary table
+    shaped like `table`, then move the rows into `table` and fan them out.
+
+    Returns how many rows were loaded.
+    """
+
+    # generated columns (messages.search_vector) fill themselves in
+    columns = [c.name for c in db.metadata.tables[table].c if c.computed is None]
+
+    db.session.execute(text(
+        f"CREATE TEMP TABLE {STAGING_TABLE} "
+        f"(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"))
+    loaded = copy(STAGING_TABLE)
+    db.session.execute(text(
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"SELECT {', '.join(columns)} FROM {STAGING_TABLE}"))
+    APPEND_FAN_OUT[table](
+        table_clause(STAGING_TABLE, *map(column, columns)))
+
+    return loaded
+
+
+def load(directory, append=False, chunk_rows=DEFAULT_CHUNK_ROWS,
+         report=print_progress):
+    """Load the CSVs in `directory`; see the module docstring.
+
+    Commits as it goes. Returns {table: rows loaded}.
+    """
+
+    files = table_files(directory)
+
+    if not append:
+        db.drop_all()
+        db.create_all()
+
+        drops, creates = _deferred_ddl(LOAD_ORDER + DERIVED_TABLES)
+        for statement in drops:
+            db.session.execute(text(statement))
+        _set_triggers(LOAD_ORDER, enabled=False)
+        db.session.commit()
+
+    loaded = {}
+
+    for table, file_format, columns, paths in files:
+        loaded[table] = 0
+
+        for path in paths:
+            def copy(into=None):
+                if file_format == 'binary':
+                    return copy_binary(table, path, columns, report, into)
+                return copy_csv(table, path, chunk_rows, report, into)
+
+            if append and table in APPEND_FAN_OUT:
+                loaded[table] += _staged(table, copy)
+            else:
+                loaded[table] += copy()
+            db.session.commit()
+
+    reset_sequences()
+
+    if not append:
+        _set_triggers(LOAD_ORDER, enabled=True)
+        reconcile_counters()
+        refresh_like_buckets(datetime.utcnow() - BUCKET_RETENTION)
+        rebuild_timelines()
+
+        for statement in creates:
+            db.session.execute(text(statement))
+
+    db.session.commit()
+    db.session.execute(text("ANALYZE"))
+    db.session.commit()
+
+    return loaded
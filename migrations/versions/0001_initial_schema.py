@@ -0,0 +1,71 @@
+"""Initial schema: users, follows, messages and liked_messages.
+
+Databases created with `db.create_all()` before migrations existed match
+this revision; mark them with `flask db stamp 0001` and then upgrade.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('email', sa.String(length=50), nullable=False),
+        sa.Column('username', sa.String(length=30), nullable=False),
+        sa.Column('image_url', sa.String(length=255), nullable=False),
+        sa.Column('header_image_url', sa.String(length=255), nullable=False),
+        sa.Column('bio', sa.Text(), nullable=False),
+        sa.Column('location', sa.String(length=30), nullable=False),
+        sa.Column('password', sa.String(length=100), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('email'),
+        sa.UniqueConstraint('username'),
+    )
+    op.create_table(
+        'follows',
+        sa.Column('user_being_followed_id', sa.Integer(), nullable=False),
+        sa.Column('user_following_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['user_being_followed_id'], ['users.id'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(
+            ['user_following_id'], ['users.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('user_being_followed_id', 'user_following_id'),
+    )
+    op.create_table(
+        'messages',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('text', sa.String(length=140), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_table(
+        'liked_messages',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('message_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['message_id'], ['messages.id'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('user_id', 'message_id'),
+    )
+
+
+def downgrade():
+    op.drop_table('liked_messages')
+    op.drop_table('messages')
+    op.drop_table('follows')
+    op.drop_table('users')
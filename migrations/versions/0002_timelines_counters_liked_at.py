@@ -0,0 +1,154 @@
+"""Timelines, user counters and liked_at.
+
+Adds the materialized timeline_entries table, the denormalized counter
+columns on users (with the triggers that maintain them) and
+liked_messages.liked_at, then backfills all three from existing rows.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 09:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+COUNTERS = ('messages_count', 'following_count', 'followers_count',
+            'likes_count')
+
+# (trigger/function name, table, [(counter column, key column)])
+COUNTER_TRIGGERS = [
+    ('follows_counters', 'follows', [
+        ('following_count', 'user_following_id'),
+        ('followers_count', 'user_being_followed_id'),
+    ]),
+    ('messages_counters', 'messages', [
+        ('messages_count', 'user_id'),
+    ]),
+    ('liked_messages_counters', 'liked_messages', [
+        ('likes_count', 'user_id'),
+    ]),
+]
+
+
+def _counter_updates(columns, row, delta):
+    return "\n".join(
+        f"        UPDATE users SET {counter} = {counter} {delta} 1\n"
+        f"            WHERE id = {row}.{key};"
+        for counter, key in columns
+    )
+
+
+def upgrade():
+    for counter in COUNTERS:
+        op.add_column('users', sa.Column(
+            counter, sa.Integer(), server_default='0', nullable=False))
+
+    op.add_column('users', sa.Column(
+        'fanout_on_read', sa.Boolean(), server_default=sa.false(),
+        nullable=False))
+
+    op.add_column('liked_messages', sa.Column(
+        'liked_at', sa.DateTime(), server_default=sa.func.now(),
+        nullable=False))
+    op.create_index(
+        'ix_liked_messages_user_liked_at',
+        'liked_messages',
+        ['user_id', sa.text('liked_at DESC'), sa.text('message_id DESC')],
+    )
+
+    op.create_table(
+        'timeline_entries',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('message_id', sa.Integer(), nullable=False),
+        sa.Column('author_id', sa.Integer(), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['message_id'], ['messages.id'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('user_id', 'message_id'),
+    )
+    op.create_index(
+        'ix_timeline_entries_user_timestamp',
+        'timeline_entries',
+        ['user_id', sa.text('timestamp DESC'), sa.text('message_id DESC')],
+    )
+    op.create_index(
+        'ix_timeline_entries_user_author',
+        'timeline_entries',
+        ['user_id', 'author_id'],
+    )
+    op.create_index(
+        'ix_timeline_entries_message_id',
+        'timeline_entries',
+        ['message_id'],
+    )
+
+    for name, table, columns in COUNTER_TRIGGERS:
+        op.execute(f"""
+CREATE OR REPLACE FUNCTION {name}() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+{_counter_updates(columns, 'NEW', '+')}
+    ELSE
+{_counter_updates(columns, 'OLD', '-')}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+""")
+        op.execute(f"""
+CREATE TRIGGER {name}
+    AFTER INSERT OR DELETE ON {table}
+    FOR EACH ROW EXECUTE FUNCTION {name}();
+""")
+
+    # Backfill counters and timelines from the rows already there.
+    for name, table, columns in COUNTER_TRIGGERS:
+        for counter, key in columns:
+            op.execute(f"""
+                UPDATE users SET {counter} = counts.n
+                FROM (SELECT {key} AS id, COUNT(*) AS n
+                      FROM {table} GROUP BY {key}) AS counts
+                WHERE users.id = counts.id
+            """)
+
+    op.execute("""
+        INSERT INTO timeline_entries (user_id, message_id, author_id, timestamp)
+        SELECT user_id, id, user_id, timestamp FROM messages
+        UNION ALL
+        SELECT follows.user_following_id, messages.id, messages.user_id,
+               messages.timestamp
+        FROM messages
+        JOIN follows ON follows.user_being_followed_id = messages.user_id
+        ON CONFLICT DO NOTHING
+    """)
+
+
+def downgrade():
+    for name, table, columns in COUNTER_TRIGGERS:
+        op.execute(f"DROP TRIGGER {name} ON {table}")
+        op.execute(f"DROP FUNCTION {name}()")
+
+    op.drop_index(
+        'ix_timeline_entries_message_id', table_name='timeline_entries')
+    op.drop_index(
+        'ix_timeline_entries_user_author', table_name='timeline_entries')
+    op.drop_index(
+        'ix_timeline_entries_user_timestamp', table_name='timeline_entries')
+    op.drop_table('timeline_entries')
+
+    op.drop_index(
+        'ix_liked_messages_user_liked_at', table_name='liked_messages')
+    op.drop_column('liked_messages', 'liked_at')
+
+    op.drop_column('users', 'fanout_on_read')
+
+    for counter in COUNTERS:
+        op.drop_column('users', counter)
@@ -0,0 +1,47 @@
+"""Indexes for the timeline, profile, follower and like query shapes.
+
+- messages(user_id, timestamp DESC, id DESC): profile pages and pulling
+  fan-out-on-read authors into home timelines
+- follows(user_following_id): "who does X follow" (the primary key leads
+  with user_being_followed_id)
+- liked_messages(message_id): likes of a message, and cascades on message
+  delete
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 09:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_messages_user_timestamp',
+        'messages',
+        ['user_id', sa.text('timestamp DESC'), sa.text('id DESC')],
+    )
+    op.create_index(
+        'ix_follows_user_following_id',
+        'follows',
+        ['user_following_id'],
+    )
+    op.create_index(
+        'ix_liked_messages_message_id',
+        'liked_messages',
+        ['message_id'],
+    )
+
+
+def downgrade():
+    op.drop_index('ix_liked_messages_message_id', table_name='liked_messages')
+    op.drop_index('ix_follows_user_following_id', table_name='follows')
+    op.drop_index('ix_messages_user_timestamp', table_name='messages')
@@ -0,0 +1,52 @@
+"""Indexes for user search and username autocomplete.
+
+Always adds a lower(username) text_pattern_ops index for prefix matches.
+Where the server has pg_trgm available, also installs the extension and
+GIN trigram indexes on username, bio and location; without it the app
+searches with its in-process n-gram index instead.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+TRIGRAM_COLUMNS = ('username', 'bio', 'location')
+
+
+def _pg_trgm_available():
+    return bool(op.get_bind().execute(sa.text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).first())
+
+
+def upgrade():
+    op.create_index(
+        'ix_users_username_lower',
+        'users',
+        [sa.text('lower(username) text_pattern_ops')],
+    )
+
+    if _pg_trgm_available():
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+        for column in TRIGRAM_COLUMNS:
+            op.execute(
+                f"CREATE INDEX ix_users_{column}_trgm ON users "
+                f"USING gin ({column} gin_trgm_ops)")
+
+
+def downgrade():
+    for column in TRIGRAM_COLUMNS:
+        op.execute(f"DROP INDEX IF EXISTS ix_users_{column}_trgm")
+
+    op.drop_index('ix_users_username_lower', table_name='users')
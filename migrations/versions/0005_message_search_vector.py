@@ -0,0 +1,40 @@
+"""Full-text search column and index for messages.
+
+Adds messages.search_vector, a stored generated tsvector of the message
+text, and a GIN index on it for /messages/search. Adding the column
+rewrites the messages table once to fill it in.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17 09:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('messages', sa.Column(
+        'search_vector',
+        postgresql.TSVECTOR(),
+        sa.Computed("to_tsvector('english', text)", persisted=True),
+    ))
+    op.create_index(
+        'ix_messages_search_vector',
+        'messages',
+        ['search_vector'],
+        postgresql_using='gin',
+    )
+
+
+def downgrade():
+    op.drop_index('ix_messages_search_vector', table_name='messages')
+    op.drop_column('messages', 'search_vector')
@@ -0,0 +1,50 @@
+"""Row versions on users for ETags.
+
+Adds users.version, numbered from users_version_seq, and a trigger that
+renumbers a user on every update (the counter triggers included).
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17 09:50:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE SEQUENCE users_version_seq")
+    op.add_column('users', sa.Column(
+        'version',
+        sa.BigInteger(),
+        nullable=False,
+        server_default=sa.text("nextval('users_version_seq')"),
+    ))
+
+    op.execute("""
+        CREATE FUNCTION users_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := nextval('users_version_seq');
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER users_version
+            BEFORE UPDATE ON users
+            FOR EACH ROW EXECUTE FUNCTION users_version()
+    """)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER users_version ON users")
+    op.execute("DROP FUNCTION users_version()")
+    op.drop_column('users', 'version')
+    op.execute("DROP SEQUENCE users_version_seq")
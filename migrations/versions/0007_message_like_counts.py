@@ -0,0 +1,106 @@
+"""Message like counts and hourly like buckets.
+
+Adds messages.like_count and the message_like_buckets table, both kept up to
+date by the liked_messages counter trigger, plus an index on
+liked_messages.liked_at for recounting recent buckets. Backfills the counts,
+and the buckets for the last week.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+LIKES_TRIGGER_FUNCTION = """
+CREATE OR REPLACE FUNCTION liked_messages_counters() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET likes_count = likes_count + 1
+            WHERE id = NEW.user_id;{insert}
+    ELSE
+        UPDATE users SET likes_count = likes_count - 1
+            WHERE id = OLD.user_id;{delete}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+MESSAGE_UPDATES_ON_INSERT = """
+        UPDATE messages SET like_count = like_count + 1
+            WHERE id = NEW.message_id;
+        INSERT INTO message_like_buckets (hour, message_id, likes)
+            VALUES (date_trunc('hour', NEW.liked_at), NEW.message_id, 1)
+            ON CONFLICT (hour, message_id)
+            DO UPDATE SET likes = message_like_buckets.likes + 1;"""
+
+MESSAGE_UPDATES_ON_DELETE = """
+        UPDATE messages SET like_count = like_count - 1
+            WHERE id = OLD.message_id;
+        -- skip buckets of a message being deleted; they go with it
+        IF FOUND THEN
+            UPDATE message_like_buckets SET likes = likes - 1
+                WHERE hour = date_trunc('hour', OLD.liked_at)
+                AND message_id = OLD.message_id;
+        END IF;"""
+
+
+def upgrade():
+    op.add_column('messages', sa.Column(
+        'like_count', sa.Integer(), server_default='0', nullable=False))
+
+    op.create_table(
+        'message_like_buckets',
+        sa.Column('hour', sa.DateTime(), nullable=False),
+        sa.Column('message_id', sa.Integer(), nullable=False),
+        sa.Column('likes', sa.Integer(), server_default='0', nullable=False),
+        sa.ForeignKeyConstraint(
+            ['message_id'], ['messages.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('hour', 'message_id'),
+    )
+    op.create_index(
+        'ix_message_like_buckets_message_id',
+        'message_like_buckets',
+        ['message_id'],
+    )
+    op.create_index(
+        'ix_liked_messages_liked_at',
+        'liked_messages',
+        ['liked_at'],
+    )
+
+    op.execute(LIKES_TRIGGER_FUNCTION.format(
+        insert=MESSAGE_UPDATES_ON_INSERT, delete=MESSAGE_UPDATES_ON_DELETE))
+
+    op.execute("""
+        UPDATE messages SET like_count = counts.n
+        FROM (SELECT message_id AS id, COUNT(*) AS n
+              FROM liked_messages GROUP BY message_id) AS counts
+        WHERE messages.id = counts.id
+    """)
+    op.execute("""
+        INSERT INTO message_like_buckets (hour, message_id, likes)
+        SELECT date_trunc('hour', liked_at), message_id, COUNT(*)
+        FROM liked_messages
+        WHERE liked_at >= date_trunc('hour', now() - interval '7 days')
+        GROUP BY 1, 2
+    """)
+
+
+def downgrade():
+    op.execute(LIKES_TRIGGER_FUNCTION.format(insert="", delete=""))
+    op.drop_index('ix_liked_messages_liked_at', table_name='liked_messages')
+    op.drop_index(
+        'ix_message_like_buckets_message_id',
+        table_name='message_like_buckets')
+    op.drop_table('message_like_buckets')
+    op.drop_column('messages', 'like_count')
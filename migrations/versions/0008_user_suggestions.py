@@ -0,0 +1,51 @@
+"""Who-to-follow suggestions.
+
+Adds the user_suggestions table, filled by `flask compute-suggestions`.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-17 10:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'user_suggestions',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('suggested_user_id', sa.Integer(), nullable=False),
+        sa.Column('rank', sa.SmallInteger(), nullable=False),
+        sa.Column('score', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['suggested_user_id'], ['users.id'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('user_id', 'suggested_user_id'),
+    )
+    op.create_index(
+        'ix_user_suggestions_user_rank',
+        'user_suggestions',
+        ['user_id', 'rank'],
+    )
+    op.create_index(
+        'ix_user_suggestions_suggested_user_id',
+        'user_suggestions',
+        ['suggested_user_id'],
+    )
+
+
+def downgrade():
+    op.drop_index(
+        'ix_user_suggestions_suggested_user_id',
+        table_name='user_suggestions')
+    op.drop_index(
+        'ix_user_suggestions_user_rank', table_name='user_suggestions')
+    op.drop_table('user_suggestions')
@@ -0,0 +1,29 @@
+"""When follows were made.
+
+Adds follows.created_at. Existing follows get the time of the migration.
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-17 10:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('follows', sa.Column(
+        'created_at', sa.DateTime(), server_default=sa.func.now(),
+        nullable=False,
+    ))
+
+
+def downgrade():
+    op.drop_column('follows', 'created_at')
@@ -0,0 +1,56 @@
+"""Profile versions on users for fragment caching.
+
+Adds users.profile_version, which the users_version trigger sets to the new
+version only when username, pictures, bio or location change, so fragments
+keyed on it survive counter updates.
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-17 10:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column(
+        'profile_version',
+        sa.BigInteger(),
+        nullable=False,
+        server_default='0',
+    ))
+
+    op.execute("""
+        CREATE OR REPLACE FUNCTION users_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := nextval('users_version_seq');
+            IF (NEW.username, NEW.image_url, NEW.header_image_url, NEW.bio,
+                    NEW.location) IS DISTINCT FROM (OLD.username,
+                    OLD.image_url, OLD.header_image_url, OLD.bio,
+                    OLD.location) THEN
+                NEW.profile_version := NEW.version;
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+
+
+def downgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION users_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := nextval('users_version_seq');
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.drop_column('users', 'profile_version')
@@ -1,11 +1,21 @@
 """SQLAlchemy models for Warbler."""
 
 from datetime import datetime
+from functools import partial
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (
+    DDL, delete, event, exists, func, literal, literal_column, select, text,
+    update,
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert
+from sqlalchemy.orm import selectinload
+
+from hashing import PasswordHasher
 
 bcrypt = Bcrypt()
+hasher = PasswordHasher(bcrypt)
 db = SQLAlchemy()
 
 DEFAULT_IMAGE_URL = (
@@ -35,6 +45,80 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+    # The primary key leads with user_being_followed_id, which covers
+    # "who follows X"; this covers "who does X follow".
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id', user_following_id),
+    )
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?
+
+        A primary key probe on follows; doesn't load either user's list.
+        """
+
+        query = cls.query.filter_by(
+            user_being_followed_id=followed_id,
+            user_following_id=follower_id,
+        )
+        return db.session.query(query.exists()).scalar()
+
+    @classmethod
+    def add_many(cls, follower_id, followed_ids):
+        """Have `follower_id` follow each of `followed_ids` (which must exist).
+
+        One INSERT; pairs that already exist are skipped. Returns the set of
+        ids that were newly followed.
+        """
+
+        if not followed_ids:
+            return set()
+
+        rows = db.session.execute(
+            insert(cls)
+            .values([
+                {
+                    'user_being_followed_id': followed_id,
+                    'user_following_id': follower_id,
+                }
+                for followed_id in followed_ids
+            ])
+            .on_conflict_do_nothing()
+            .returning(cls.user_being_followed_id))
+
+        return {followed_id for (followed_id,) in rows}
+
+    @classmethod
+    def remove_many(cls, follower_id, followed_ids):
+        """Have `follower_id` stop following each of `followed_ids`.
+
+        One DELETE; returns the set of ids that were actually unfollowed.
+        """
+
+        if not followed_ids:
+            return set()
+
+        rows = db.session.execute(
+            delete(cls)
+            .where(cls.user_following_id == follower_id,
+                   cls.user_being_followed_id.in_(followed_ids))
+            .returning(cls.user_being_followed_id))
+
+        return {followed_id for (followed_id,) in rows}
+
+
+# Source of User.version values; one sequence for all users, so versions
+# only ever go up and the newest change among any set of users is the max.
+users_version_seq = db.Sequence('users_version_seq', metadata=db.metadata)
+
 
 class User(db.Model):
     """User in the system."""
@@ -88,6 +172,64 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts, kept up to date by the triggers at the bottom of
+    # this file; `reconcile_counters` recomputes them in bulk.
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Renumbered by trigger on every update to the row, counters included;
+    # used to build ETags for pages that show this user.
+    version = db.Column(
+        db.BigInteger,
+        nullable=False,
+        server_default=users_version_seq.next_value(),
+        server_onupdate=db.FetchedValue(),
+    )
+
+    # Set (to the new `version`) by the same trigger, but only when a column
+    # shown on profiles and messages changes, not the counters; keys the
+    # fragments that show this user's name and pictures.
+    profile_version = db.Column(
+        db.BigInteger,
+        nullable=False,
+        server_default="0",
+        server_onupdate=db.FetchedValue(),
+    )
+
+    # Set once this user has too many followers to fan their messages out on
+    # write; their followers pull these messages at read time instead.
+    fanout_on_read = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
     messages = db.relationship('Message', cascade="all,delete", backref="user")
     # TODO: ^ understand better how this cascade works ^
 
@@ -107,6 +249,15 @@ class User(db.Model):
     )
     # TODO: indicate that liked is plural; consider "liked_messages"
 
+    __table_args__ = (
+        # prefix matches for username autocomplete
+        db.Index(
+            'ix_users_username_lower',
+            db.func.lower(username).label('username_lower'),
+            postgresql_ops={'username_lower': 'text_pattern_ops'},
+        ),
+    )
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
@@ -117,7 +268,7 @@ class User(db.Model):
         Hashes password and adds user to session.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.generate_password_hash(password, username=username)
 
         user = User(
             username=username,
@@ -144,25 +295,40 @@ class User(db.Model):
         user = cls.query.filter_by(username=username).one_or_none()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check_password_hash(
+                user.password, password, username=username)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    hasher.rehash_in_background(
+                        password,
+                        partial(cls.replace_password, user.id, user.password),
+                    )
                 return user
 
         return False
 
+    @classmethod
+    def replace_password(cls, user_id, old_hash, new_hash):
+        """Swap user's password hash `old_hash` for `new_hash` and commit.
+
+        Does nothing if the password has changed since `old_hash` was read.
+        """
+
+        db.session.execute(
+            update(cls)
+            .where(cls.id == user_id, cls.password == old_hash)
+            .values(password=new_hash))
+        db.session.commit()
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follow.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follow.exists(self.id, other_user.id)
 
 
 class Message(db.Model):
@@ -193,6 +359,85 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized count of likes, kept up to date by trigger like the
+    # counters on users
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Full-text search document for `text`, kept current by PostgreSQL
+    search_vector = db.deferred(db.Column(
+        TSVECTOR,
+        db.Computed("to_tsvector('english', text)", persisted=True),
+    ))
+
+    __table_args__ = (
+        db.Index(
+            'ix_messages_user_timestamp',
+            user_id,
+            timestamp.desc(),
+            id.desc(),
+        ),
+        db.Index(
+            'ix_messages_search_vector',
+            search_vector,
+            postgresql_using='gin',
+        ),
+    )
+
+
+def following_status(user, user_ids):
+    """Return the set of `user_ids` that `user` follows.
+
+    Answers a whole page of users with one query, so list templates can
+    pick Follow/Unfollow buttons without a lookup per user.
+    """
+
+    if not user_ids:
+        return set()
+
+    rows = (db.session
+            .query(Follow.user_being_followed_id)
+            .filter(Follow.user_following_id == user.id,
+                    Follow.user_being_followed_id.in_(user_ids))
+            .all())
+
+    return {followed_id for (followed_id,) in rows}
+
+
+def liked_status(user, message_ids):
+    """Return the set of `message_ids` that `user` has liked.
+
+    One query for a whole page of messages, so templates can pick the star
+    for each message without walking `user.liked`.
+    """
+
+    if not message_ids:
+        return set()
+
+    rows = (db.session
+            .query(LikedMessages.message_id)
+            .filter(LikedMessages.user_id == user.id,
+                    LikedMessages.message_id.in_(message_ids))
+            .all())
+
+    return {message_id for (message_id,) in rows}
+
+
+def with_authors(query):
+    """`query` for messages, also loading each message's author.
+
+    Authors come in one extra SELECT for the whole list, with just the
+    columns message lists show, instead of a lazy load per author.
+    """
+
+    return query.options(
+        selectinload(Message.user).load_only(
+            User.username, User.image_url, User.profile_version))
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -222,4 +467,418 @@ class LikedMessages(db.Model):
         db.Integer,
         db.ForeignKey('messages.id', ondelete="cascade"),
         primary_key=True,
-    )
\ No newline at end of file
+    )
+
+    liked_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_liked_messages_user_liked_at',
+            user_id,
+            liked_at.desc(),
+            message_id.desc(),
+        ),
+        db.Index('ix_liked_messages_message_id', message_id),
+        db.Index('ix_liked_messages_liked_at', liked_at),
+    )
+
+    @classmethod
+    def add_many(cls, user_id, message_ids):
+        """Have `user_id` like each of `message_ids` (which must exist).
+
+        One INSERT; messages already liked are skipped. Returns the set of
+        ids that were newly liked.
+        """
+
+        if not message_ids:
+            return set()
+
+        rows = db.session.execute(
+            insert(cls)
+            .values([
+                {'user_id': user_id, 'message_id': message_id}
+                for message_id in message_ids
+            ])
+            .on_conflict_do_nothing()
+            .returning(cls.message_id))
+
+        return {message_id for (message_id,) in rows}
+
+    @classmethod
+    def remove_many(cls, user_id, message_ids):
+        """Have `user_id` unlike each of `message_ids`.
+
+        One DELETE; returns the set of ids that were actually unliked.
+        """
+
+        if not message_ids:
+            return set()
+
+        rows = db.session.execute(
+            delete(cls)
+            .where(cls.user_id == user_id, cls.message_id.in_(message_ids))
+            .returning(cls.message_id))
+
+        return {message_id for (message_id,) in rows}
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` for `user_id` if they haven't, else unlike it.
+
+        One statement: a DELETE of the like and, only if that removed
+        nothing, an INSERT. Concurrent toggles by the same user therefore
+        never collide on the primary key: an INSERT that finds the like just
+        added by a racing click keeps it (a no-op ON CONFLICT DO UPDATE, so
+        that RETURNING still reports the row), leaving the message liked.
+
+        Returns `(liked, like_count)` as of this toggle, or None if there is
+        no such message.
+        """
+
+        removed = (
+            delete(cls)
+            .where(cls.user_id == user_id, cls.message_id == message_id)
+            .returning(cls.message_id)
+            .cte('removed'))
+
+        stmt = (
+            insert(cls)
+            .from_select(
+                ['user_id', 'message_id'],
+                select(literal(user_id), Message.id)
+                .where(Message.id == message_id, ~exists(removed.select())),
+                include_defaults=False)
+        )
+        # xmax is 0 only on rows this INSERT created, not ones it kept
+        added = (
+            stmt.on_conflict_do_update(
+                index_elements=[cls.user_id, cls.message_id],
+                set_={'user_id': stmt.excluded.user_id})
+            .returning(cls.message_id,
+                       literal_column('xmax = 0').label('inserted'))
+            .cte('added'))
+
+        def changed(cte, *where):
+            return (select(func.count()).select_from(cte).where(*where)
+                    .scalar_subquery())
+
+        # The CTEs' changes (and the triggers they fire) aren't visible to
+        # the outer query, so adjust the count it sees by what they did.
+        # Referring to them in WHERE runs them first, so that FOR UPDATE
+        # then waits on, and reads, the count as any racing toggle left it.
+        return db.session.execute(
+            select(
+                exists(added.select()).label('liked'),
+                (Message.like_count
+                 + changed(added, added.c.inserted)
+                 - changed(removed)).label('like_count'),
+            )
+            .where(Message.id == message_id,
+                   changed(added) + changed(removed) >= 0)
+            .with_for_update(of=Message)
+        ).one_or_none()
+
+
+class MessageLikeBucket(db.Model):
+    """How many times a message was liked in one hour.
+
+    Kept up to date by trigger as likes come and go; the "top messages"
+    leaderboards sum the buckets in their window (see leaderboard.py).
+    """
+
+    __tablename__ = 'message_like_buckets'
+
+    # start of the hour (UTC) the likes were made in
+    hour = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    __table_args__ = (
+        db.Index('ix_message_like_buckets_message_id', message_id),
+    )
+
+
+class UserSuggestion(db.Model):
+    """A user suggested for another to follow, from the batch in
+    suggestions.py."""
+
+    __tablename__ = 'user_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # 1 for the best suggestion for `user_id`, then 2, ...
+    rank = db.Column(
+        db.SmallInteger,
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_user_suggestions_user_rank', user_id, rank),
+        db.Index('ix_user_suggestions_suggested_user_id', suggested_user_id),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # No foreign key: entries already go when their message is deleted, and
+    # a key here would make every user delete scan this table.
+    author_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_timeline_entries_user_timestamp',
+            user_id,
+            timestamp.desc(),
+            message_id.desc(),
+        ),
+        db.Index('ix_timeline_entries_user_author', user_id, author_id),
+        db.Index('ix_timeline_entries_message_id', message_id),
+    )
+
+
+##############################################################################
+# Counter and version maintenance
+#
+# Every insert/delete on follows, messages and liked_messages adjusts the
+# matching counter columns on users (and, for likes, the message's like_count
+# and hourly like bucket) in the same transaction, including rows removed by
+# ON DELETE CASCADE. Every update to a user (counters included) gives it a
+# new version; one changing what profiles show also a new profile_version.
+
+FOLLOWS_COUNTERS_TRIGGER = DDL("""
+CREATE OR REPLACE FUNCTION follows_counters() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET following_count = following_count + 1
+            WHERE id = NEW.user_following_id;
+        UPDATE users SET followers_count = followers_count + 1
+            WHERE id = NEW.user_being_followed_id;
+    ELSE
+        UPDATE users SET following_count = following_count - 1
+            WHERE id = OLD.user_following_id;
+        UPDATE users SET followers_count = followers_count - 1
+            WHERE id = OLD.user_being_followed_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER follows_counters
+    AFTER INSERT OR DELETE ON follows
+    FOR EACH ROW EXECUTE FUNCTION follows_counters();
+""")
+
+MESSAGES_COUNTERS_TRIGGER = DDL("""
+CREATE OR REPLACE FUNCTION messages_counters() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET messages_count = messages_count + 1
+            WHERE id = NEW.user_id;
+    ELSE
+        UPDATE users SET messages_count = messages_count - 1
+            WHERE id = OLD.user_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER messages_counters
+    AFTER INSERT OR DELETE ON messages
+    FOR EACH ROW EXECUTE FUNCTION messages_counters();
+""")
+
+LIKED_MESSAGES_COUNTERS_TRIGGER = DDL("""
+CREATE OR REPLACE FUNCTION liked_messages_counters() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE users SET likes_count = likes_count + 1
+            WHERE id = NEW.user_id;
+        UPDATE messages SET like_count = like_count + 1
+            WHERE id = NEW.message_id;
+        INSERT INTO message_like_buckets (hour, message_id, likes)
+            VALUES (date_trunc('hour', NEW.liked_at), NEW.message_id, 1)
+            ON CONFLICT (hour, message_id)
+            DO UPDATE SET likes = message_like_buckets.likes + 1;
+    ELSE
+        UPDATE users SET likes_count = likes_count - 1
+            WHERE id = OLD.user_id;
+        UPDATE messages SET like_count = like_count - 1
+            WHERE id = OLD.message_id;
+        -- skip buckets of a message being deleted; they go with it
+        IF FOUND THEN
+            UPDATE message_like_buckets SET likes = likes - 1
+                WHERE hour = date_trunc('hour', OLD.liked_at)
+                AND message_id = OLD.message_id;
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER liked_messages_counters
+    AFTER INSERT OR DELETE ON liked_messages
+    FOR EACH ROW EXECUTE FUNCTION liked_messages_counters();
+""")
+
+USERS_VERSION_TRIGGER = DDL("""
+CREATE OR REPLACE FUNCTION users_version() RETURNS trigger AS $$
+BEGIN
+    NEW.version := nextval('users_version_seq');
+    IF (NEW.username, NEW.image_url, NEW.header_image_url, NEW.bio,
+            NEW.location) IS DISTINCT FROM (OLD.username, OLD.image_url,
+            OLD.header_image_url, OLD.bio, OLD.location) THEN
+        NEW.profile_version := NEW.version;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_version
+    BEFORE UPDATE ON users
+    FOR EACH ROW EXECUTE FUNCTION users_version();
+""")
+
+event.listen(
+    Follow.__table__,
+    'after_create',
+    FOLLOWS_COUNTERS_TRIGGER.execute_if(dialect='postgresql'),
+)
+
+event.listen(
+    Message.__table__,
+    'after_create',
+    MESSAGES_COUNTERS_TRIGGER.execute_if(dialect='postgresql'),
+)
+
+event.listen(
+    LikedMessages.__table__,
+    'after_create',
+    LIKED_MESSAGES_COUNTERS_TRIGGER.execute_if(dialect='postgresql'),
+)
+
+event.listen(
+    User.__table__,
+    'after_create',
+    USERS_VERSION_TRIGGER.execute_if(dialect='postgresql'),
+)
+
+
+# Trigram indexes for user search (see search.py). pg_trgm ships with most
+# PostgreSQL installs but not all; without it search falls back to an
+# in-process index, so only create these where the extension is available.
+USERS_TRIGRAM_INDEXES = DDL("""
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX ix_users_username_trgm ON users
+    USING gin (username gin_trgm_ops);
+CREATE INDEX ix_users_bio_trgm ON users
+    USING gin (bio gin_trgm_ops);
+CREATE INDEX ix_users_location_trgm ON users
+    USING gin (location gin_trgm_ops);
+""")
+
+
+def pg_trgm_available(ddl, target, bind, **kw):
+    """Can the pg_trgm extension be installed on `bind`'s server?"""
+
+    return bind.dialect.name == 'postgresql' and bool(bind.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).first())
+
+
+event.listen(
+    User.__table__,
+    'after_create',
+    USERS_TRIGRAM_INDEXES.execute_if(callable_=pg_trgm_available),
+)
+
+
+def reconcile_counters():
+    """Recompute every counter column from the underlying tables.
+
+    Runs one set-based UPDATE per counter and only rewrites rows whose value
+    drifted. Returns how many counter values were corrected.
+    """
+
+    # (table, counter column, counted table, its key column)
+    counters = [
+        ('users', 'messages_count', 'messages', 'user_id'),
+        ('users', 'following_count', 'follows', 'user_following_id'),
+        ('users', 'followers_count', 'follows', 'user_being_followed_id'),
+        ('users', 'likes_count', 'liked_messages', 'user_id'),
+        ('messages', 'like_count', 'liked_messages', 'message_id'),
+    ]
+
+    corrected = 0
+
+    for target, column, table, key in counters:
+        result = db.session.execute(text(f"""
+            UPDATE {target}
+            SET {column} = counts.n
+            FROM (
+                SELECT {target}.id, COUNT({table}.{key}) AS n
+                FROM {target} LEFT JOIN {table} ON {table}.{key} = {target}.id
+                GROUP BY {target}.id
+            ) AS counts
+            WHERE {target}.id = counts.id AND {target}.{column} <> counts.n
+        """))
+        corrected += result.rowcount
+
+    return corrected
@@ -0,0 +1,123 @@
+"""Keyset (cursor) pagination helpers for Warbler.
+
+Message lists are ordered newest first on `(timestamp, id)`. Instead of an
+OFFSET, the client gets an opaque cursor for the last row it saw and the
+next page is fetched with `WHERE (timestamp, id) < (cursor)`, which is the
+same index range scan however far back the reader has scrolled.
+
+Ranked results (e.g. search) use the same idea with a `(rank, id)` cursor,
+and lists of users ordered by id with a plain id cursor.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+
+from sqlalchemy import tuple_
+from werkzeug.exceptions import BadRequest
+
+
+def _encode(*parts):
+    raw = "|".join(str(part) for part in parts).encode()
+    return urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode(cursor, *types):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        parts = urlsafe_b64decode(padded).decode().split("|")
+
+        if len(parts) != len(types):
+            raise ValueError(cursor)
+
+        return tuple(kind(part) for kind, part in zip(types, parts))
+
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        raise BadRequest("Invalid cursor.")
+
+
+def encode_cursor(timestamp, id):
+    """Make an opaque cursor string pointing at `(timestamp, id)`."""
+
+    return _encode(timestamp.isoformat(), id)
+
+
+def decode_cursor(cursor):
+    """Turn a cursor string back into `(timestamp, id)`.
+
+    Returns None for an empty cursor; raises BadRequest for a malformed one.
+    """
+
+    if not cursor:
+        return None
+
+    return _decode(cursor, datetime.fromisoformat, int)
+
+
+def encode_rank_cursor(rank, id):
+    """Make an opaque cursor for a result list ordered by `(rank, id)`."""
+
+    return _encode(repr(float(rank)), id)
+
+
+def decode_rank_cursor(cursor):
+    """Turn a rank cursor back into `(rank, id)`; None if empty."""
+
+    if not cursor:
+        return None
+
+    return _decode(cursor, float, int)
+
+
+def encode_id_cursor(id):
+    """Make an opaque cursor for a result list ordered by id."""
+
+    return _encode(id)
+
+
+def decode_id_cursor(cursor):
+    """Turn an id cursor back into the id; None if empty."""
+
+    if not cursor:
+        return None
+
+    return _decode(cursor, int)[0]
+
+
+def keyset_filter(query, timestamp_col, id_col, cursor):
+    """Restrict `query` to rows strictly older than `cursor`, newest first."""
+
+    if cursor:
+        query = query.filter(tuple_(timestamp_col, id_col) < tuple_(*cursor))
+
+    return query.order_by(timestamp_col.desc(), id_col.desc())
+
+
+def _timestamp_and_id(row):
+    return row.timestamp, row.id
+
+
+def paginate(query, timestamp_col, id_col, cursor, per_page,
+             key=_timestamp_and_id):
+    """Fetch one page of `query` older than `cursor`.
+
+    Returns `(rows, next_cursor)`; `next_cursor` is None on the last page.
+    `key(row)` gives the `(timestamp, id)` of a row for the next cursor;
+    by default rows' own `.timestamp` and `.id`.
+    """
+
+    rows = (keyset_filter(query, timestamp_col, id_col, cursor)
+            .limit(per_page + 1)
+            .all())
+
+    return page_of(rows, per_page, key)
+
+
+def page_of(rows, per_page, key=_timestamp_and_id):
+    """Trim `rows` (fetched with one extra) to a page and its next cursor."""
+
+    if len(rows) <= per_page:
+        return rows, None
+
+    rows = rows[:per_page]
+    return rows, encode_cursor(*key(rows[-1]))
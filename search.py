@@ -0,0 +1,562 @@
+"""User search for Warbler.
+
+`/users?q=` matches the query anywhere in a user's username, bio or
+location (or a username within trigram distance of it, to forgive typos)
+and ranks matches by trigram similarity, username first:
+
+    rank = boost + 3 * sim(username) + sim(bio) + sim(location)
+
+where `boost` favors exact and prefix username matches.
+
+On PostgreSQL with the pg_trgm extension this runs in the database against
+GIN trigram indexes. Elsewhere (SQLite test runs, or a server without
+pg_trgm) `NgramIndex`, an in-process n-gram index over the same columns,
+stands in with the same matching and ranking rules.
+
+`/messages/search?q=` is PostgreSQL full-text search over message text,
+backed by the GIN-indexed `Message.search_vector` column. Results are
+ranked by text relevance decayed by age (see `message_rank`).
+"""
+
+import re
+from bisect import bisect_left, insort
+from collections import defaultdict
+from threading import RLock
+from time import monotonic
+
+from flask import current_app
+from sqlalchemy import (
+    Float, and_, case, cast, event, func, inspect, or_, text, tuple_,
+)
+from sqlalchemy.orm import Session
+
+from models import db, Message, User, with_authors
+from pagination import encode_rank_cursor
+
+USERNAME_WEIGHT = 3.0
+EXACT_BOOST = 10.0
+PREFIX_BOOST = 5.0
+
+# pg_trgm's default `%` threshold; used for typo-tolerant username matches
+SIMILARITY_THRESHOLD = 0.3
+
+DEFAULT_FALLBACK_TTL = 300
+
+# What the in-process fallback indexes; see `NgramIndex`
+INDEXED_COLUMNS = (User.id, User.username, User.bio, User.location,
+                   User.image_url)
+
+# A message's relevance is scaled down by a factor of e for every this many
+# seconds of age; see `message_rank`
+MESSAGE_RECENCY_DECAY = 3 * 24 * 60 * 60
+
+# floor for ts_rank_cd before taking its log
+MIN_RELEVANCE = 1e-6
+
+TEXT_SEARCH_CONFIG = 'english'
+
+_WORD_RE = re.compile(r"[^\W_]+")
+
+
+##############################################################################
+# Trigrams, as pg_trgm computes them
+
+
+def trigrams(value):
+    """Return the set of pg_trgm-style trigrams of `value`.
+
+    Each alphanumeric word is lowercased and padded with two spaces in front
+    and one behind before being cut into three-character pieces.
+    """
+
+    grams = set()
+
+    for word in _WORD_RE.findall(value.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    return grams
+
+
+def similarity(grams, other_grams):
+    """Jaccard similarity of two trigram sets, like pg_trgm's similarity()."""
+
+    if not grams or not other_grams:
+        return 0.0
+
+    return len(grams & other_grams) / len(grams | other_grams)
+
+
+def _windows(value):
+    """Every three-character substring of `value` (for substring lookups)."""
+
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def _escape_like(value):
+    return (value
+            .replace("\\", "\\\\")
+            .replace("%", "\\%")
+            .replace("_", "\\_"))
+
+
+def _after(rank, user_id, cursor):
+    """Does `(rank, user_id)` sort after `cursor` (rank desc, id asc)?"""
+
+    if cursor is None:
+        return True
+
+    cursor_rank, cursor_id = cursor
+    return rank < cursor_rank or (rank == cursor_rank and user_id > cursor_id)
+
+
+##############################################################################
+# In-process fallback
+
+
+class NgramIndex:
+    """In-memory trigram index over users' username, bio and location."""
+
+    def __init__(self, rows):
+        """Build from `(id, username, bio, location, image_url)` rows."""
+
+        self.docs = {}
+        self.substring_postings = defaultdict(set)
+        self.username_postings = defaultdict(set)
+        self.field_grams = {}
+        self.prefixes = []
+
+        for row in rows:
+            self._add(row)
+
+        self.prefixes.sort()
+
+    def _add(self, row):
+        user_id, username, bio, location, image_url = row
+        fields = (username, bio or "", location or "")
+        lowered = tuple(field.lower() for field in fields)
+
+        self.docs[user_id] = (fields, lowered, image_url)
+
+        for field in lowered:
+            for window in _windows(field):
+                self.substring_postings[window].add(user_id)
+
+        grams = [trigrams(field) for field in fields]
+        self.field_grams[user_id] = grams
+
+        for gram in grams[0]:
+            self.username_postings[gram].add(user_id)
+
+        self.prefixes.append((lowered[0], user_id))
+
+    def remove(self, user_id):
+        """Drop `user_id` from the index, if it's there."""
+
+        if user_id not in self.docs:
+            return
+
+        _, lowered, _ = self.docs.pop(user_id)
+        username_grams = self.field_grams.pop(user_id)[0]
+
+        for postings, keys in [
+            (self.substring_postings,
+             set().union(*(_windows(field) for field in lowered))),
+            (self.username_postings, username_grams),
+        ]:
+            for key in keys:
+                postings[key].discard(user_id)
+                if not postings[key]:
+                    del postings[key]
+
+        del self.prefixes[bisect_left(self.prefixes, (lowered[0], user_id))]
+
+    def update(self, user_ids, rows):
+        """Replace the entries for `user_ids` with `rows`.
+
+        Ids without a row (deleted users) are dropped.
+        """
+
+        for user_id in user_ids:
+            self.remove(user_id)
+
+        for row in rows:
+            self._add(row)
+            # `_add` appended the new prefix; move it into place
+            insort(self.prefixes, self.prefixes.pop())
+
+    def _substring_candidates(self, needle):
+        windows = _windows(needle)
+
+        if not windows:
+            # too short to use the index; check everyone
+            return set(self.docs)
+
+        postings = [self.substring_postings.get(w, set()) for w in windows]
+        return set.intersection(*postings)
+
+    def rank(self, user_id, query, query_grams):
+        """Rank of `user_id` for `query`, or None if it doesn't match."""
+
+        fields, lowered, _ = self.docs[user_id]
+        username_grams, bio_grams, location_grams = self.field_grams[user_id]
+        needle = query.lower()
+
+        username_sim = similarity(query_grams, username_grams)
+
+        matches = (
+            any(needle in field for field in lowered) or
+            username_sim >= SIMILARITY_THRESHOLD
+        )
+
+        if not matches:
+            return None
+
+        if lowered[0] == needle:
+            boost = EXACT_BOOST
+        elif lowered[0].startswith(needle):
+            boost = PREFIX_BOOST
+        else:
+            boost = 0.0
+
+        return (
+            boost +
+            USERNAME_WEIGHT * username_sim +
+            similarity(query_grams, bio_grams) +
+            similarity(query_grams, location_grams)
+        )
+
+    def search(self, query, cursor=None, limit=20):
+        """Return up to `limit` `(rank, user_id)` pairs after `cursor`."""
+
+        query_grams = trigrams(query)
+
+        candidates = self._substring_candidates(query.lower())
+        for gram in query_grams:
+            candidates |= self.username_postings.get(gram, set())
+
+        ranked = []
+        for user_id in candidates:
+            rank = self.rank(user_id, query, query_grams)
+
+            if rank is not None and _after(rank, user_id, cursor):
+                ranked.append((rank, user_id))
+
+        ranked.sort(key=lambda pair: (-pair[0], pair[1]))
+        return ranked[:limit]
+
+    def autocomplete(self, prefix, limit=10):
+        """Return up to `limit` `(user_id, username, image_url)` by prefix."""
+
+        prefix = prefix.lower()
+        results = []
+
+        for i in range(bisect_left(self.prefixes, (prefix, -1)),
+                       len(self.prefixes)):
+            lowered, user_id = self.prefixes[i]
+
+            if not lowered.startswith(prefix) or len(results) == limit:
+                break
+
+            fields, _, image_url = self.docs[user_id]
+            results.append((user_id, fields[0], image_url))
+
+        return results
+
+
+class _FallbackIndex:
+    """Process-wide `NgramIndex`, kept in step with writes to users.
+
+    Flushes from this process that add or delete users, or change a
+    searched column, mark those users stale (via session hooks), and the
+    next lookup reloads just their rows; they are marked again when the
+    transaction ends, so rolled back or newly committed values are picked
+    up too. Bulk deletes of users drop the whole index. Writes from other
+    processes, and bulk loads that bypass the ORM, are picked up when the
+    whole index expires after `ttl` seconds.
+
+    Lookups hold the lock, since entries are updated in place.
+    """
+
+    def __init__(self):
+        self._index = None
+        self._built_at = 0
+        # reentrant, as reloading may autoflush, which marks users stale
+        self._lock = RLock()
+        self._stale = set()
+
+    def mark_stale(self, user_ids):
+        with self._lock:
+            self._stale.update(user_ids)
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+
+    def _current(self):
+        ttl = current_app.config.get('USER_SEARCH_INDEX_TTL',
+                                     DEFAULT_FALLBACK_TTL)
+
+        if self._index is None or monotonic() - self._built_at > ttl:
+            self._stale.clear()
+            self._index = NgramIndex(db.session.query(*INDEXED_COLUMNS))
+            self._built_at = monotonic()
+
+        elif self._stale:
+            user_ids, self._stale = self._stale, set()
+            self._index.update(user_ids, db.session.query(*INDEXED_COLUMNS)
+                               .filter(User.id.in_(user_ids)))
+
+        return self._index
+
+    def search(self, query, cursor=None, limit=20):
+        with self._lock:
+            return self._current().search(query, cursor, limit)
+
+    def autocomplete(self, prefix, limit=10):
+        with self._lock:
+            return self._current().autocomplete(prefix, limit)
+
+
+fallback_index = _FallbackIndex()
+
+_STALE_KEY = 'search.stale_user_ids'
+
+
+def _flushed_users(session, flush_context):
+    """Note users whose indexed columns this flush wrote."""
+
+    changed = {user for user in session.new | session.deleted
+               if isinstance(user, User)}
+    changed.update(
+        user for user in session.dirty
+        if isinstance(user, User) and any(
+            inspect(user).attrs[column.key].history.has_changes()
+            for column in INDEXED_COLUMNS
+            if column is not User.id))
+
+    if changed:
+        user_ids = {user.id for user in changed}
+        session.info.setdefault(_STALE_KEY, set()).update(user_ids)
+        fallback_index.mark_stale(user_ids)
+
+
+def _transaction_ended(session):
+    user_ids = session.info.pop(_STALE_KEY, None)
+
+    if user_ids:
+        fallback_index.mark_stale(user_ids)
+
+
+def _bulk_deleted_users(orm_execute_state):
+    """Drop the whole index after a bulk `DELETE FROM users`."""
+
+    if (orm_execute_state.is_delete and
+            orm_execute_state.bind_mapper is inspect(User)):
+        fallback_index.invalidate()
+
+
+event.listen(Session, 'after_flush', _flushed_users)
+event.listen(Session, 'after_commit', _transaction_ended)
+event.listen(Session, 'after_rollback', _transaction_ended)
+event.listen(Session, 'do_orm_execute', _bulk_deleted_users)
+
+_trigram_available = {}
+
+
+def trigram_available():
+    """Is pg_trgm installed in the database we're connected to?"""
+
+    engine = db.engine
+
+    if engine not in _trigram_available:
+        available = engine.dialect.name == 'postgresql' and bool(
+            db.session.execute(text(
+                "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+            )).first())
+        _trigram_available[engine] = available
+
+    return _trigram_available[engine]
+
+
+##############################################################################
+# Search
+
+
+def _users_in_order(user_ids):
+    users = {user.id: user for user in User.query.filter(User.id.in_(user_ids))}
+    return [users[user_id] for user_id in user_ids if user_id in users]
+
+
+def _page(ranked, limit):
+    """Split `(rank, row)` pairs fetched with one extra into a page."""
+
+    if len(ranked) <= limit:
+        return [row for _, row in ranked], None
+
+    ranked = ranked[:limit]
+    rank, row = ranked[-1]
+    return [row for _, row in ranked], encode_rank_cursor(rank, row.id)
+
+
+def _sql_rank(query):
+    lowered = func.lower(User.username)
+
+    def sim(column):
+        return cast(func.similarity(column, query), Float)
+
+    boost = case(
+        (lowered == query.lower(), EXACT_BOOST),
+        (lowered.like(_escape_like(query.lower()) + "%", escape="\\"),
+         PREFIX_BOOST),
+        else_=0.0,
+    )
+
+    return (boost +
+            USERNAME_WEIGHT * sim(User.username) +
+            sim(User.bio) +
+            sim(User.location))
+
+
+def _sql_search(query, cursor, limit):
+    pattern = f"%{_escape_like(query)}%"
+    rank = _sql_rank(query)
+
+    matches = (db.session
+               .query(rank.label('rank'), User)
+               .filter(or_(
+                   User.username.ilike(pattern, escape="\\"),
+                   User.bio.ilike(pattern, escape="\\"),
+                   User.location.ilike(pattern, escape="\\"),
+                   User.username.op('%')(query),
+               )))
+
+    if cursor:
+        cursor_rank, cursor_id = cursor
+        matches = matches.filter(or_(
+            rank < cursor_rank,
+            and_(rank == cursor_rank, User.id > cursor_id),
+        ))
+
+    return [
+        (row.rank, row.User)
+        for row in matches.order_by(rank.desc(), User.id).limit(limit + 1)
+    ]
+
+
+def _fallback_search(query, cursor, limit):
+    ranked = fallback_index.search(query, cursor, limit + 1)
+    users = _users_in_order([user_id for _, user_id in ranked])
+    ranks = {user_id: rank for rank, user_id in ranked}
+
+    return [(ranks[user.id], user) for user in users]
+
+
+def search_users(query, cursor=None, limit=20):
+    """Return one page of users matching `query`, best match first.
+
+    With no query, lists everyone in signup order. `cursor` is a decoded
+    `(rank, id)` rank cursor; returns `(users, next_cursor)`.
+    """
+
+    query = (query or "").strip()
+
+    if not query:
+        everyone = User.query
+        if cursor:
+            everyone = everyone.filter(User.id > cursor[1])
+
+        users = everyone.order_by(User.id).limit(limit + 1).all()
+        return _page([(0.0, user) for user in users], limit)
+
+    if trigram_available():
+        ranked = _sql_search(query, cursor, limit)
+    else:
+        ranked = _fallback_search(query, cursor, limit)
+
+    return _page(ranked, limit)
+
+
+def autocomplete_users(prefix, limit=10):
+    """Return up to `limit` `{id, username, image_url}` dicts by prefix."""
+
+    prefix = (prefix or "").strip()
+
+    if not prefix:
+        return []
+
+    if trigram_available():
+        rows = (db.session
+                .query(User.id, User.username, User.image_url)
+                .filter(func.lower(User.username).like(
+                    _escape_like(prefix.lower()) + "%", escape="\\"))
+                .order_by(func.lower(User.username), User.id)
+                .limit(limit)
+                .all())
+    else:
+        rows = fallback_index.autocomplete(prefix, limit)
+
+    return [
+        {"id": user_id, "username": username, "image_url": image_url}
+        for user_id, username, image_url in rows
+    ]
+
+
+##############################################################################
+# Message search
+
+
+def _message_query(query):
+    return func.websearch_to_tsquery(TEXT_SEARCH_CONFIG, query)
+
+
+def message_rank(tsquery):
+    """SQL expression ranking a message for `tsquery`, higher is better.
+
+    This is `relevance * exp(-age / MESSAGE_RECENCY_DECAY)` on a log scale.
+    Since `now` is the same for every message it drops out of the ordering,
+    leaving `ln(relevance) + epoch(timestamp) / MESSAGE_RECENCY_DECAY`: the
+    same order, but a rank that doesn't change between page loads, so it
+    can go in a cursor.
+    """
+
+    relevance = func.greatest(
+        func.ts_rank_cd(Message.search_vector, tsquery), MIN_RELEVANCE)
+
+    return cast(
+        func.ln(relevance) +
+        cast(func.extract('epoch', Message.timestamp), Float) /
+        MESSAGE_RECENCY_DECAY,
+        Float,
+    )
+
+
+def search_messages(query, cursor=None, limit=20):
+    """Return one page of messages matching `query`, best match first.
+
+    `query` uses web search syntax ("quoted phrases", -excluded, or).
+    `cursor` is a decoded `(rank, id)` rank cursor; returns
+    `(messages, next_cursor)`.
+    """
+
+    query = (query or "").strip()
+
+    if not query:
+        return [], None
+
+    tsquery = _message_query(query)
+    rank = message_rank(tsquery)
+
+    matches = with_authors(db.session
+                           .query(rank.label('rank'), Message)
+                           .filter(Message.search_vector.op('@@')(tsquery)))
+
+    if cursor:
+        matches = matches.filter(tuple_(rank, Message.id) < tuple_(*cursor))
+
+    rows = (matches
+            .order_by(rank.desc(), Message.id.desc())
+            .limit(limit + 1)
+            .all())
+
+    return _page([(row.rank, row.Message) for row in rows], limit)
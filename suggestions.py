@@ -0,0 +1,272 @@
+"""Who-to-follow suggestions from the follows graph.
+
+Suggestions are friends of friends: users followed by the people someone
+follows, that they don't follow yet. Each candidate `w` for user `u` scores
+
+    sum, over every `v` that `u` follows and that follows `w`, of
+        1 / log(2 + number of users `v` follows)
+
+so a shared follow from someone selective counts for more than one from
+someone who follows everybody (as in Adamic-Adar).
+
+Scores are computed offline by `flask compute-suggestions`. The whole edge
+list is streamed with binary COPY into a SciPy sparse matrix A (follower x
+followed), and the scores are A W A, with W the diagonal of the weights
+above. The product is taken a block of rows at a time, with each block sized by how
+many paths it will walk, so memory stays bounded however dense the graph.
+The top `SUGGESTIONS_PER_USER` for each user replace the user_suggestions
+table in one transaction, so pages keep reading the old suggestions until
+the new ones are complete.
+
+Serving them is an index range read of at most K rows (`suggestions_for`).
+"""
+
+import io
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import delete, exists, text
+
+from models import db, Follow, User, UserSuggestion
+
+DEFAULT_TOP_K = 20
+
+# most two-step paths (u -> v -> w) to score at once; bounds the size of
+# each block's score matrix
+DEFAULT_MAX_PATHS = 20_000_000
+
+
+# one follow in binary COPY format: a field count, then a length and an
+# int4 value for each column
+EDGE_ROW = np.dtype([
+    ('count', '>i2'),
+    ('follower_length', '>i4'), ('follower', '>i4'),
+    ('followed_length', '>i4'), ('followed', '>i4'),
+])
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+# signature, flags, header extension length
+COPY_HEADER_SIZE = len(COPY_SIGNATURE) + 8
+
+COPY_TRAILER = b'\xff\xff'
+
+# bytes of COPY output to gather before parsing them
+EDGE_CHUNK_SIZE = 1 << 20
+
+
+class _EdgeSink:
+    """File-like target for a binary `COPY follows ... TO STDOUT`.
+
+    Parses the stream a chunk at a time into int64 arrays, which grow by
+    doubling from `capacity`, so memory is the arrays plus one chunk.
+    """
+
+    def __init__(self, capacity):
+        self.followers = np.empty(capacity, dtype=np.int64)
+        self.followed = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+        self.pending = bytearray()
+        self.in_header = True
+
+    def write(self, data):
+        self.pending += data
+
+        if len(self.pending) >= EDGE_CHUNK_SIZE:
+            self._parse()
+
+    def _parse(self):
+        if self.in_header:
+            if len(self.pending) < COPY_HEADER_SIZE:
+                return
+
+            if not self.pending.startswith(COPY_SIGNATURE):
+                raise ValueError("not a binary COPY stream")
+
+            extension = int.from_bytes(
+                self.pending[COPY_HEADER_SIZE - 4:COPY_HEADER_SIZE], 'big')
+            del self.pending[:COPY_HEADER_SIZE + extension]
+            self.in_header = False
+
+        count = len(self.pending) // EDGE_ROW.itemsize
+        rows = np.frombuffer(self.pending, dtype=EDGE_ROW, count=count)
+
+        if ((rows['count'] != 2).any() or
+                (rows['follower_length'] != 4).any() or
+                (rows['followed_length'] != 4).any()):
+            raise ValueError("unexpected row in COPY of follows")
+
+        if self.size + count > len(self.followers):
+            capacity = max(2 * len(self.followers), self.size + count)
+            self.followers = np.resize(self.followers, capacity)
+            self.followed = np.resize(self.followed, capacity)
+
+        self.followers[self.size:self.size + count] = rows['follower']
+        self.followed[self.size:self.size + count] = rows['followed']
+        self.size += count
+
+        # release the view on `pending` so it can shrink
+        del rows
+        del self.pending[:count * EDGE_ROW.itemsize]
+
+    def close(self):
+        """Parse what's left; returns (follower ids, followed ids)."""
+
+        self._parse()
+
+        if self.pending != COPY_TRAILER:
+            raise ValueError("truncated COPY of follows")
+
+        return self.followers[:self.size], self.followed[:self.size]
+
+
+def load_follow_edges():
+    """Every follow, as arrays of (follower ids, followed ids).
+
+    Streams a binary COPY, so no text copy of the table is ever held.
+    """
+
+    # planner's row estimate (-1 if never analyzed); the arrays grow if
+    # it's low
+    estimate = db.session.execute(text(
+        "SELECT reltuples FROM pg_class WHERE oid = 'follows'::regclass"
+    )).scalar()
+
+    sink = _EdgeSink(max(int(estimate), 1024))
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        "COPY follows (user_following_id, user_being_followed_id) TO STDOUT"
+        " WITH (FORMAT binary)",
+        sink,
+    )
+
+    return sink.close()
+
+
+def _row_blocks(paths, max_paths):
+    """Split rows into consecutive (start, stop) ranges of at most
+    `max_paths` paths each (or single rows, where one row has more)."""
+
+    total = np.cumsum(paths)
+    start = 0
+
+    while start < len(paths):
+        offset = total[start - 1] if start else 0
+        stop = int(np.searchsorted(total, offset + max_paths, side='right'))
+        stop = max(stop, start + 1)
+        yield start, stop
+        start = stop
+
+
+def _top_k_per_row(scores, top_k):
+    """The `top_k` best entries of each row of CSR matrix `scores`.
+
+    Returns (rows, columns, scores, ranks), best first within each row;
+    ties go to the lower column.
+    """
+
+    rows = np.repeat(np.arange(scores.shape[0]), np.diff(scores.indptr))
+    order = np.lexsort((scores.indices, -scores.data, rows))
+
+    rows = rows[order]
+    columns = scores.indices[order]
+    data = scores.data[order]
+    ranks = np.arange(len(rows)) - scores.indptr[rows] + 1
+
+    keep = ranks <= top_k
+    return rows[keep], columns[keep], data[keep], ranks[keep]
+
+
+def score_candidates(followers, followed, top_k=DEFAULT_TOP_K,
+                     max_paths=DEFAULT_MAX_PATHS):
+    """Score friends of friends for every follower in the edge list.
+
+    `followers[i]` follows `followed[i]`. Yields, a block of users at a
+    time, arrays of (user ids, suggested user ids, scores, ranks) holding
+    each user's `top_k` best candidates.
+    """
+
+    ids, edges = np.unique(
+        np.concatenate([followers, followed]), return_inverse=True)
+    n = len(ids)
+    sources, targets = edges[:len(followers)], edges[len(followers):]
+
+    follows = sparse.csr_matrix(
+        (np.ones(len(sources), dtype=np.float32), (sources, targets)),
+        shape=(n, n))
+
+    out_degree = np.diff(follows.indptr)
+    weighted = sparse.diags(
+        (1 / np.log(2 + out_degree)).astype(np.float32)) @ follows
+
+    # paths from each row = the sum of its follows' out-degrees
+    paths = follows @ out_degree
+
+    for start, stop in _row_blocks(paths, max_paths):
+        block = follows[start:stop]
+        scores = (block @ weighted).tocsr()
+
+        # never suggest someone already followed, or the user themself
+        own = sparse.csr_matrix(
+            (np.ones(stop - start, dtype=np.float32),
+             (np.arange(stop - start), np.arange(start, stop))),
+            shape=scores.shape)
+        excluded = (block + own).tocsr()
+        excluded.data[:] = 1
+        scores = scores - scores.multiply(excluded)
+        scores.eliminate_zeros()
+
+        rows, columns, data, ranks = _top_k_per_row(scores, top_k)
+        yield ids[start + rows], ids[columns], data, ranks
+
+
+def refresh_suggestions(top_k=DEFAULT_TOP_K, max_paths=DEFAULT_MAX_PATHS):
+    """Recompute every user's suggestions and replace the stored ones.
+
+    Doesn't commit. Returns how many suggestions were stored.
+    """
+
+    followers, followed = load_follow_edges()
+
+    db.session.execute(delete(UserSuggestion))
+    cursor = db.session.connection().connection.cursor()
+    stored = 0
+
+    for user_ids, suggested_ids, scores, ranks in score_candidates(
+            followers, followed, top_k, max_paths):
+        buffer = io.StringIO()
+        np.savetxt(
+            buffer,
+            np.column_stack([user_ids, suggested_ids, ranks, scores]),
+            fmt=['%d', '%d', '%d', '%.6g'],
+            delimiter='\t',
+        )
+        buffer.seek(0)
+
+        cursor.copy_expert(
+            "COPY user_suggestions (user_id, suggested_user_id, rank, score)"
+            " FROM STDIN",
+            buffer,
+        )
+        stored += len(user_ids)
+
+    return stored
+
+
+def suggestions_for(user, limit):
+    """Up to `limit` users suggested for `user` to follow, best first.
+
+    Skips anyone `user` has followed since the suggestions were computed.
+    """
+
+    already_followed = exists().where(
+        Follow.user_following_id == user.id,
+        Follow.user_being_followed_id == UserSuggestion.suggested_user_id,
+    )
+
+    return (User.query
+            .join(UserSuggestion, UserSuggestion.suggested_user_id == User.id)
+            .filter(UserSuggestion.user_id == user.id, ~already_followed)
+            .order_by(UserSuggestion.rank)
+            .limit(limit)
+            .all())
@@ -0,0 +1,276 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_api.py
+
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import brotli
+
+from models import db, Follow, LikedMessages, Message, User
+from timeline import rebuild_timelines
+
+# BEFORE we import our app, let's set an environmental variable to use a
+# different database for tests (we need to do this before we import our app,
+# since that will have already connected to the database).
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, fragment_cache, user_cache
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Fail any request sending more SQL statements than this (catches N+1s)
+app.config['MAX_QUERIES_PER_REQUEST'] = 10
+
+
+class ApiTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+
+        now = datetime.utcnow()
+        messages = [
+            Message(text=f"u2 message {i}", user_id=u2.id,
+                    timestamp=now - timedelta(minutes=i))
+            for i in range(3)
+        ]
+        db.session.add_all(messages)
+        db.session.add_all([
+            Follow(user_being_followed_id=u2.id, user_following_id=u1.id),
+            Follow(user_being_followed_id=u2.id, user_following_id=u3.id),
+        ])
+        db.session.flush()
+        db.session.add(LikedMessages(user_id=u1.id, message_id=messages[2].id))
+        db.session.commit()
+
+        rebuild_timelines()
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+        self.message_ids = [message.id for message in messages]
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['MESSAGES_PER_PAGE'] = 100
+        app.config['USERS_PER_PAGE'] = 60
+        user_cache.clear()
+        fragment_cache.clear()
+
+    def test_requires_login(self):
+        """Tests anonymous requests get a JSON 401."""
+
+        resp = app.test_client().get("/api/v1/timeline")
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn("error", resp.get_json())
+
+    def test_timeline_pages(self):
+        """Tests the home timeline walks back in pages by cursor."""
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        first = self.client.get("/api/v1/timeline").get_json()
+        second = self.client.get(
+            "/api/v1/timeline",
+            query_string={"before": first["next_cursor"]},
+        ).get_json()
+
+        self.assertEqual(
+            [m["id"] for m in first["messages"] + second["messages"]],
+            self.message_ids)
+        self.assertIsNone(second["next_cursor"])
+        self.assertEqual(first["messages"][0]["user"]["username"], "u2")
+
+    def test_profile(self):
+        """Tests a profile includes its counters."""
+
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}")
+        data = resp.get_json()
+
+        self.assertEqual(data["username"], "u2")
+        self.assertEqual(data["messages_count"], 3)
+        self.assertEqual(data["followers_count"], 2)
+
+        missing = self.client.get("/api/v1/users/0")
+        self.assertEqual(missing.status_code, 404)
+
+    def test_followers_pages(self):
+        """Tests follower lists page by id."""
+
+        app.config['USERS_PER_PAGE'] = 1
+
+        url = f"/api/v1/users/{self.u2_id}/followers"
+        first = self.client.get(url).get_json()
+        second = self.client.get(
+            url, query_string={"after": first["next_cursor"]}).get_json()
+
+        self.assertEqual(
+            [u["id"] for u in first["users"] + second["users"]],
+            [self.u1_id, self.u3_id])
+        self.assertIsNone(second["next_cursor"])
+
+    def test_following_and_likes(self):
+        """Tests following and likes lists."""
+
+        following = self.client.get(
+            f"/api/v1/users/{self.u1_id}/following").get_json()
+        likes = self.client.get(
+            f"/api/v1/users/{self.u1_id}/likes").get_json()
+
+        self.assertEqual([u["id"] for u in following["users"]], [self.u2_id])
+        self.assertEqual(
+            [m["id"] for m in likes["messages"]], [self.message_ids[2]])
+
+    def test_create_and_delete_message(self):
+        """Tests posting and deleting a message."""
+
+        resp = self.client.post("/api/v1/messages", json={"text": "hello"})
+
+        self.assertEqual(resp.status_code, 201)
+        message_id = resp.get_json()["id"]
+        self.assertEqual(resp.get_json()["user"]["id"], self.u1_id)
+
+        timeline = self.client.get("/api/v1/timeline").get_json()
+        self.assertEqual(timeline["messages"][0]["id"], message_id)
+
+        resp = self.client.delete(f"/api/v1/messages/{message_id}")
+
+        self.assertEqual(resp.status_code, 204)
+        self.assertIsNone(db.session.get(Message, message_id))
+
+    def test_create_message_validation(self):
+        """Tests bad message bodies are rejected."""
+
+        form = self.client.post("/api/v1/messages", data={"text": "hi"})
+        empty = self.client.post("/api/v1/messages", json={"text": " "})
+        long = self.client.post("/api/v1/messages", json={"text": "x" * 141})
+
+        self.assertEqual(form.status_code, 415)
+        self.assertEqual(empty.status_code, 400)
+        self.assertEqual(long.status_code, 400)
+
+    def test_delete_others_message(self):
+        """Tests users can't delete other users' messages."""
+
+        resp = self.client.delete(f"/api/v1/messages/{self.message_ids[0]}")
+
+        self.assertEqual(resp.status_code, 403)
+
+    def test_compression(self):
+        """Tests big responses are brotli or gzip encoded on request."""
+
+        db.session.add_all([
+            Message(text="x" * 140, user_id=self.u2_id) for _ in range(20)])
+        db.session.commit()
+
+        url = f"/api/v1/users/{self.u2_id}/messages"
+
+        br = self.client.get(url, headers={"Accept-Encoding": "gzip, br"})
+        gz = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        plain = self.client.get(url)
+
+        self.assertEqual(br.headers["Content-Encoding"], "br")
+        self.assertEqual(gz.headers["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Encoding", plain.headers)
+
+        self.assertEqual(json.loads(brotli.decompress(br.data)),
+                         plain.get_json())
+        self.assertEqual(json.loads(gzip.decompress(gz.data)),
+                         plain.get_json())
+
+    def test_batch_follow(self):
+        """Tests following several users at once reports each outcome."""
+
+        resp = self.client.post("/api/v1/following", json={
+            "user_ids": [self.u3_id, self.u2_id, self.u1_id, 0, self.u3_id],
+        })
+
+        self.assertEqual(resp.get_json()["results"], [
+            {"id": self.u3_id, "status": "followed"},
+            {"id": self.u2_id, "status": "already_following"},
+            {"id": self.u1_id, "status": "self"},
+            {"id": 0, "status": "not_found"},
+        ])
+        self.assertTrue(Follow.exists(self.u1_id, self.u3_id))
+
+    def test_batch_unfollow(self):
+        """Tests unfollowing several users drops them from the timeline."""
+
+        resp = self.client.delete("/api/v1/following", json={
+            "user_ids": [self.u2_id, self.u3_id],
+        })
+
+        self.assertEqual(resp.get_json()["results"], [
+            {"id": self.u2_id, "status": "unfollowed"},
+            {"id": self.u3_id, "status": "not_following"},
+        ])
+
+        timeline = self.client.get("/api/v1/timeline").get_json()
+        self.assertEqual(timeline["messages"], [])
+
+    def test_batch_likes(self):
+        """Tests liking and unliking several messages at once."""
+
+        own = Message(text="mine", user_id=self.u1_id)
+        db.session.add(own)
+        db.session.commit()
+
+        liked = self.client.post("/api/v1/likes", json={
+            "message_ids": [self.message_ids[0], self.message_ids[2],
+                            own.id, 0],
+        })
+        unliked = self.client.delete("/api/v1/likes", json={
+            "message_ids": [self.message_ids[2], self.message_ids[1]],
+        })
+
+        self.assertEqual(liked.get_json()["results"], [
+            {"id": self.message_ids[0], "status": "liked"},
+            {"id": self.message_ids[2], "status": "already_liked"},
+            {"id": own.id, "status": "own_message"},
+            {"id": 0, "status": "not_found"},
+        ])
+        self.assertEqual(unliked.get_json()["results"], [
+            {"id": self.message_ids[2], "status": "unliked"},
+            {"id": self.message_ids[1], "status": "not_liked"},
+        ])
+
+        likes = self.client.get(
+            f"/api/v1/users/{self.u1_id}/likes").get_json()
+        self.assertEqual(
+            [m["id"] for m in likes["messages"]], [self.message_ids[0]])
+
+    def test_batch_validation(self):
+        """Tests batch bodies must be short lists of ids."""
+
+        not_list = self.client.post("/api/v1/likes", json={"message_ids": 1})
+        not_ints = self.client.post(
+            "/api/v1/following", json={"user_ids": ["1"]})
+        too_many = self.client.post(
+            "/api/v1/following", json={"user_ids": list(range(501))})
+
+        self.assertEqual(not_list.status_code, 400)
+        self.assertEqual(not_ints.status_code, 400)
+        self.assertEqual(too_many.status_code, 400)
@@ -5,9 +5,16 @@
 #    python -m unittest test_user_model.py
 
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Barrier
 from unittest import TestCase
 
-from models import db, User, Message, Follow
+from leaderboard import (
+    hour_start, prune_like_buckets, refresh_like_buckets, top_messages)
+from models import (
+    db, User, Message, Follow, LikedMessages, MessageLikeBucket,
+    reconcile_counters)
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
@@ -129,4 +136,245 @@ class MessageModelTestCase(TestCase):
         db.session.commit()
 
         self.assertEqual(len(u2.liked), 0)
-        self.assertNotEqual(len(u2.liked), 1)
\ No newline at end of file
+        self.assertNotEqual(len(u2.liked), 1)
+
+
+class LikeToggleTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        users = [
+            User(username=f"u{i}", email=f"u{i}@email.com",
+                 password=PASSWORD, image_url="")
+            for i in range(8)
+        ]
+        db.session.add_all(users)
+        db.session.flush()
+
+        message = Message(text="Test", user_id=users[0].id)
+        db.session.add(message)
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+        self.message_id = message.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def likes(self):
+        return LikedMessages.query.filter_by(message_id=self.message_id).count()
+
+    def test_toggle(self):
+        """Tests toggling likes and then unlikes, reporting the count."""
+
+        u1, u2 = self.user_ids[:2]
+
+        self.assertEqual(
+            tuple(LikedMessages.toggle(u1, self.message_id)), (True, 1))
+        self.assertEqual(
+            tuple(LikedMessages.toggle(u2, self.message_id)), (True, 2))
+        self.assertEqual(
+            tuple(LikedMessages.toggle(u1, self.message_id)), (False, 1))
+        db.session.commit()
+
+        self.assertEqual(self.likes(), 1)
+
+    def test_toggle_missing_message(self):
+        """Tests toggling a message that doesn't exist does nothing."""
+
+        self.assertIsNone(LikedMessages.toggle(self.user_ids[0], 0))
+
+    def parallel_toggles(self, user_ids):
+        """Toggle the message for each of `user_ids` at once, each in its
+        own session; returns what each toggle reported."""
+
+        barrier = Barrier(len(user_ids))
+
+        def toggle(user_id):
+            with app.app_context():
+                barrier.wait()
+                result = LikedMessages.toggle(user_id, self.message_id)
+                db.session.commit()
+                return result
+
+        with ThreadPoolExecutor(max_workers=len(user_ids)) as pool:
+            return list(pool.map(toggle, user_ids))
+
+    def test_parallel_toggles_by_many_users(self):
+        """Tests concurrent likes by different users all count."""
+
+        results = self.parallel_toggles(self.user_ids)
+
+        self.assertTrue(all(liked for liked, _ in results))
+        self.assertEqual(self.likes(), 8)
+        # each saw the likes committed before it, plus its own
+        self.assertEqual(sorted(count for _, count in results),
+                         list(range(1, 9)))
+
+    def test_parallel_toggles_by_one_user(self):
+        """Tests a burst of toggles by one user never collides, and each
+        reports the state it left."""
+
+        for _ in range(5):
+            results = self.parallel_toggles([self.user_ids[1]] * 8)
+            db.session.expire_all()
+            message = db.session.get(Message, self.message_id)
+
+            self.assertEqual(len(results), 8)
+            for liked, like_count in results:
+                self.assertEqual(like_count, int(liked))
+            self.assertEqual(message.like_count, self.likes())
+
+
+class LeaderboardTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        users = [
+            User(username=f"u{i}", email=f"u{i}@email.com",
+                 password=PASSWORD, image_url="")
+            for i in range(3)
+        ]
+        db.session.add_all(users)
+        db.session.flush()
+
+        messages = [Message(text=f"m{i}", user_id=users[0].id)
+                    for i in range(2)]
+        db.session.add_all(messages)
+        db.session.flush()
+
+        # m0: liked twice now; m1: liked once now and twice three days ago
+        self.now = datetime.utcnow()
+        old = self.now - timedelta(days=3)
+        db.session.add_all([
+            LikedMessages(user_id=users[1].id, message_id=messages[0].id,
+                          liked_at=self.now),
+            LikedMessages(user_id=users[2].id, message_id=messages[0].id,
+                          liked_at=self.now),
+            LikedMessages(user_id=users[0].id, message_id=messages[1].id,
+                          liked_at=self.now),
+            LikedMessages(user_id=users[1].id, message_id=messages[1].id,
+                          liked_at=old),
+            LikedMessages(user_id=users[2].id, message_id=messages[1].id,
+                          liked_at=old),
+        ])
+        db.session.commit()
+
+        self.user_ids = [user.id for user in users]
+        self.message_ids = [message.id for message in messages]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def top(self, window):
+        return [(message.id, likes)
+                for message, _, likes in top_messages(window, 10, self.now)]
+
+    def test_like_count(self):
+        """Tests likes and unlikes keep Message.like_count current."""
+
+        m0, m1 = self.message_ids
+
+        self.assertEqual(db.session.get(Message, m0).like_count, 2)
+        self.assertEqual(db.session.get(Message, m1).like_count, 3)
+
+        LikedMessages.remove_many(self.user_ids[1], [m0, m1])
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(db.session.get(Message, m0).like_count, 1)
+        self.assertEqual(db.session.get(Message, m1).like_count, 2)
+        self.assertEqual(reconcile_counters(), 0)
+
+    def test_top_messages_windows(self):
+        """Tests the leaderboard counts only likes inside its window."""
+
+        m0, m1 = self.message_ids
+
+        self.assertEqual(self.top(timedelta(hours=24)), [(m0, 2), (m1, 1)])
+        self.assertEqual(self.top(timedelta(days=7)), [(m1, 3), (m0, 2)])
+
+    def test_window_is_exact(self):
+        """Tests likes just outside the window's first hour don't count,
+        and ones just inside do."""
+
+        m0, m1 = self.message_ids
+        start = self.now - timedelta(hours=24)
+
+        users = [User(username=f"late{i}", email=f"late{i}@email.com",
+                      password=PASSWORD, image_url="")
+                 for i in range(2)]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add_all([
+            LikedMessages(user_id=users[0].id, message_id=m1,
+                          liked_at=start - timedelta(minutes=1)),
+            LikedMessages(user_id=users[1].id, message_id=m1,
+                          liked_at=start + timedelta(minutes=1)),
+        ])
+        db.session.commit()
+
+        # m1 ties m0 at 2, and is newer
+        self.assertEqual(self.top(timedelta(hours=24)), [(m1, 2), (m0, 2)])
+
+    def test_unlike_leaves_leaderboard(self):
+        """Tests unliking takes the like back out of its bucket."""
+
+        m0, m1 = self.message_ids
+
+        LikedMessages.remove_many(self.user_ids[0], [m1])
+        db.session.commit()
+
+        self.assertEqual(self.top(timedelta(hours=24)), [(m0, 2)])
+
+    def test_refresh_and_prune(self):
+        """Tests buckets can be rebuilt for a recent window and pruned."""
+
+        m0, m1 = self.message_ids
+
+        db.session.execute(MessageLikeBucket.__table__.delete())
+
+        written, _ = refresh_like_buckets(
+            self.now - timedelta(days=1), self.now)
+        self.assertEqual(written, 2)
+        self.assertEqual(self.top(timedelta(days=7)), [(m0, 2), (m1, 1)])
+
+        refresh_like_buckets(self.now - timedelta(days=7), self.now)
+        self.assertEqual(self.top(timedelta(days=7)), [(m1, 3), (m0, 2)])
+
+        pruned = prune_like_buckets(self.now - timedelta(days=1))
+        self.assertEqual(pruned, 1)
+        self.assertEqual(self.top(timedelta(days=7)), [(m0, 2), (m1, 1)])
+
+    def test_refresh_prunes_expired(self):
+        """Tests refreshing also drops buckets older than any window."""
+
+        m0, _ = self.message_ids
+
+        db.session.add(MessageLikeBucket(
+            hour=hour_start(self.now - timedelta(days=8)),
+            message_id=m0, likes=5))
+        db.session.flush()
+
+        _, pruned = refresh_like_buckets(
+            self.now - timedelta(hours=1), self.now)
+
+        self.assertEqual(pruned, 1)
+        self.assertEqual(
+            MessageLikeBucket.query.filter(
+                MessageLikeBucket.hour < self.now - timedelta(days=7)
+            ).count(), 0)
+
+    def test_delete_liked_message(self):
+        """Tests a message liked in this transaction can still be deleted."""
+
+        m0 = Message(text="new", user_id=self.user_ids[0])
+        db.session.add(m0)
+        db.session.flush()
+        LikedMessages.add_many(self.user_ids[1], [m0.id])
+
+        db.session.delete(m0)
+        db.session.commit()
+
+        self.assertEqual(
+            MessageLikeBucket.query.filter_by(message_id=m0.id).count(), 0)
@@ -6,9 +6,12 @@
 
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, Message, User
+from instrumentation import TooManyQueries, fingerprint
+from models import db, Follow, LikedMessages, Message, User
+from timeline import rebuild_timelines
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,7 +22,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, profiler
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -38,6 +41,9 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any request sending more SQL statements than this (catches N+1s)
+app.config['MAX_QUERIES_PER_REQUEST'] = 10
+
 
 class MessageBaseViewTestCase(TestCase):
     def setUp(self):
@@ -68,3 +74,379 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertEqual(resp.status_code, 302)
 
             Message.query.filter_by(text="Hello").one()
+
+
+class HomepageTimelineViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = 10000
+        db.session.rollback()
+
+    def post_as(self, c, user_id, text):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return c.post("/messages/new", data={"text": text})
+
+    def test_followed_messages_on_homepage(self):
+        """Tests that follows and new messages reach the home timeline."""
+
+        with app.test_client() as c:
+            self.post_as(c, self.u2_id, "before-follow")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+
+            self.post_as(c, self.u2_id, "after-follow")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("before-follow", html)
+            self.assertIn("after-follow", html)
+
+    def test_unfollow_removes_messages_from_homepage(self):
+        """Tests that unfollowing drops that user's messages from home."""
+
+        with app.test_client() as c:
+            self.post_as(c, self.u2_id, "u2-warble")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+            c.post(f"/users/stop-following/{self.u2_id}")
+
+            resp = c.get("/")
+
+            self.assertNotIn("u2-warble", resp.get_data(as_text=True))
+
+    def test_fanout_on_read_author(self):
+        """Tests popular authors are merged into the timeline at read time."""
+
+        app.config['TIMELINE_FANOUT_MAX_FOLLOWERS'] = 0
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+
+            self.assertTrue(db.session.get(User, self.u2_id).fanout_on_read)
+
+            self.post_as(c, self.u2_id, "celebrity-warble")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/")
+
+            self.assertIn("celebrity-warble", resp.get_data(as_text=True))
+
+
+class MessageListQueryCountTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.max_queries = app.config['MAX_QUERIES_PER_REQUEST']
+
+        authors = [
+            User(username=f"author{i}", email=f"author{i}@email.com",
+                 password="x", image_url="")
+            for i in range(25)
+        ]
+        db.session.add_all(authors)
+        db.session.flush()
+
+        messages = [Message(text=f"popular {author.username}",
+                            user_id=author.id)
+                    for author in authors]
+        db.session.add_all(messages)
+        db.session.add_all(
+            [Follow(user_following_id=self.u1_id,
+                    user_being_followed_id=author.id)
+             for author in authors])
+        db.session.flush()
+        LikedMessages.add_many(self.u1_id, [m.id for m in messages])
+        db.session.commit()
+
+        rebuild_timelines()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['MAX_QUERIES_PER_REQUEST'] = self.max_queries
+        app.config['PROPAGATE_EXCEPTIONS'] = None
+
+    def test_lists_of_many_authors(self):
+        """Tests message lists load all their authors in a fixed number of
+        queries."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for url in ["/", f"/users/{self.u1_id}/liked",
+                        "/messages/search?q=popular"]:
+                resp = c.get(url)
+
+                self.assertEqual(resp.status_code, 200, url)
+                self.assertIn("@author24", resp.get_data(as_text=True))
+
+    def test_query_limit(self):
+        """Tests a request over the query limit fails."""
+
+        app.config['MAX_QUERIES_PER_REQUEST'] = 1
+        app.config['PROPAGATE_EXCEPTIONS'] = True
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with self.assertRaises(TooManyQueries):
+                c.get("/")
+
+
+class ProfilerTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        profiler.metrics.reset()
+        app.config['METRICS_TOKEN'] = "sekrit"
+
+    def tearDown(self):
+        super().tearDown()
+        db.session.rollback()
+        app.config['METRICS_TOKEN'] = None
+        app.config['SERVER_TIMING'] = False
+
+    def test_server_timing(self):
+        """Tests responses say their SQL and template time, when asked to."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertNotIn("Server-Timing", c.get("/").headers)
+
+            app.config['SERVER_TIMING'] = True
+            resp = c.get("/")
+
+        timing = resp.headers["Server-Timing"]
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="\d+ queries", '
+                                 r'tpl;dur=[\d.]+, app;dur=[\d.]+$')
+
+    def test_metrics(self):
+        """Tests /metrics totals requests and statements per endpoint."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/")
+            c.get(f"/users/{self.u1_id}")
+            c.get(f"/users/{self.u1_id}")
+            resp = c.get("/metrics",
+                         headers={"Authorization": "Bearer sekrit"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+
+        text = resp.get_data(as_text=True)
+        self.assertIn('warbler_http_request_duration_seconds_count'
+                      '{endpoint="show_user"} 2', text)
+        self.assertIn('warbler_http_request_duration_seconds_bucket'
+                      '{endpoint="homepage",le="+Inf"} 1', text)
+        self.assertRegex(text, r'warbler_db_queries_total'
+                               r'\{endpoint="homepage"\} [1-9]')
+        self.assertRegex(text, r'warbler_db_slowest_query_seconds'
+                               r'\{endpoint="show_user",statement="SELECT ')
+
+    def test_metrics_token(self):
+        """Tests /metrics wants the bearer token, and is not found without
+        one set."""
+
+        with app.test_client() as c:
+            self.assertEqual(c.get("/metrics").status_code, 401)
+            self.assertEqual(
+                c.get("/metrics",
+                      headers={"Authorization": "Bearer wrong"}).status_code,
+                401)
+            self.assertEqual(
+                c.get("/metrics",
+                      headers={"Authorization": "Bearer sekrit"}).status_code,
+                200)
+
+            app.config['METRICS_TOKEN'] = None
+            self.assertEqual(
+                c.get("/metrics",
+                      headers={"Authorization": "Bearer "}).status_code,
+                404)
+
+    def test_fingerprint(self):
+        """Tests fingerprints take out literals, parameters and labels."""
+
+        self.assertEqual(
+            fingerprint("SELECT users.id AS users_id, users.bio AS "
+                        "users_bio\nFROM users WHERE users.username = 'bo''b' "
+                        "AND users.id IN (%(id_1_1)s, %(id_1_2)s) LIMIT 20"),
+            "SELECT users.id, users.bio FROM users WHERE users.username = ? "
+            "AND users.id IN (...) LIMIT ?")
+
+
+class TopMessagesViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_top_messages(self):
+        """Tests liked messages show on the leaderboard with their counts."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/messages/{self.m1_id}/liked", data={"location": "/"})
+
+            page = c.get("/messages/top")
+            week = c.get("/messages/top?window=7d",
+                         headers={"Accept": "application/json"})
+            bad = c.get("/messages/top?window=1y")
+            message = c.get(f"/messages/{self.m1_id}")
+
+        self.assertEqual(page.status_code, 200)
+        self.assertIn("m1-text", page.get_data(as_text=True))
+        self.assertEqual(
+            [(m["id"], m["likes_in_window"]) for m in week.json["messages"]],
+            [(self.m1_id, 1)])
+        self.assertEqual(bad.status_code, 404)
+        self.assertIn("1 like\n", message.get_data(as_text=True))
+
+
+class MessageSearchViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        now = datetime.utcnow()
+
+        db.session.add_all([
+            Message(text="went running by the river", user_id=self.u1_id,
+                    timestamp=now - timedelta(days=30)),
+            Message(text="she runs by the river", user_id=self.u1_id,
+                    timestamp=now),
+            Message(text="baking bread all day", user_id=self.u1_id,
+                    timestamp=now),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['MESSAGES_PER_PAGE'] = 100
+        db.session.rollback()
+
+    def search(self, c, q, **params):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        return c.get(
+            "/messages/search",
+            query_string={"q": q, **params},
+            headers={"Accept": "application/json"},
+        ).get_json()
+
+    def test_search_matches_word_stems(self):
+        """Tests that searching 'run' finds 'running' and 'runs' only."""
+
+        with app.test_client() as c:
+            texts = [m["text"] for m in self.search(c, "run")["messages"]]
+
+            self.assertEqual(len(texts), 2)
+            self.assertNotIn("baking bread all day", texts)
+
+    def test_search_prefers_recent_matches(self):
+        """Tests that equally relevant newer messages rank first."""
+
+        with app.test_client() as c:
+            texts = [m["text"] for m in self.search(c, "river")["messages"]]
+
+            self.assertEqual(
+                texts,
+                ["she runs by the river", "went running by the river"])
+
+    def test_search_pages(self):
+        """Tests that cursors walk through every match once."""
+
+        app.config['MESSAGES_PER_PAGE'] = 1
+
+        with app.test_client() as c:
+            first = self.search(c, "river")
+            second = self.search(c, "river", after=first["next_cursor"])
+
+            self.assertIsNone(second["next_cursor"])
+            self.assertEqual(
+                [m["text"] for m in first["messages"] + second["messages"]],
+                ["she runs by the river", "went running by the river"])
+
+    def test_search_page(self):
+        """Tests the HTML results page."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/messages/search?q=bread")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("baking bread all day", html)
+            self.assertNotIn("by the river", html)
+
+
+class MessageConditionalGetTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_message_page_revalidates(self):
+        """Tests a message page is 304 until the viewer likes it."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            url = f"/messages/{self.m1_id}"
+            etag = c.get(url).headers["ETag"]
+
+            resp = c.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            c.post(f"/messages/{self.m1_id}/liked", data={"location": url})
+
+            resp = c.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
@@ -0,0 +1,190 @@
+"""Password hashing service tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_password_hashing.py
+
+import os
+from contextlib import ExitStack
+from unittest import TestCase
+
+from hashing import bcrypt_cost, calibrate_rounds
+from models import bcrypt, db, hasher, User
+
+# BEFORE we import our app, let's set an environmental variable to use a
+# different database for tests (we need to do this before we import our app,
+# since that will have already connected to the database).
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Fail any request sending more SQL statements than this (catches N+1s)
+app.config['MAX_QUERIES_PER_REQUEST'] = 10
+
+
+class PasswordHasherTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+        hasher.metrics.reset()
+
+    def tearDown(self):
+        db.session.rollback()
+        hasher.init_app(app)
+
+    def login(self, c, username="u1", password="password"):
+        return c.post(
+            "/login",
+            data={"username": username, "password": password},
+            environ_base={"REMOTE_ADDR": "10.0.0.1"},
+        )
+
+    def test_pooled_authenticate(self):
+        """Tests hashes run in the pool and are timed."""
+
+        self.assertTrue(hasher.workers)
+
+        self.assertTrue(User.authenticate("u1", "password"))
+        self.assertFalse(User.authenticate("u1", "wrong"))
+
+        checks = hasher.metrics.snapshot()["operations"]["check"]
+        self.assertEqual(checks["count"], 2)
+        self.assertGreater(checks["seconds"], 0)
+        self.assertEqual(checks["buckets"][float('inf')], 2)
+
+    def test_inline_authenticate(self):
+        """Tests hashing with no worker processes."""
+
+        app.config['PASSWORD_HASH_WORKERS'] = 0
+        try:
+            hasher.init_app(app)
+        finally:
+            app.config['PASSWORD_HASH_WORKERS'] = 2
+
+        self.assertTrue(User.authenticate("u1", "password"))
+
+    def test_username_cap(self):
+        """Tests a username already at its limit gets a 429."""
+
+        with app.test_client() as c:
+            with hasher.slot("u1"), hasher.slot("U1"):
+                resp = self.login(c)
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Retry-After", resp.headers)
+            self.assertEqual(
+                hasher.metrics.snapshot()["rejected"], {"username": 1})
+
+            # the slots are released again afterwards
+            self.assertEqual(self.login(c).status_code, 302)
+
+    def test_ip_cap(self):
+        """Tests a client IP already at its limit gets a 429."""
+
+        with app.test_client() as c, ExitStack() as held:
+            with app.test_request_context(
+                    environ_base={"REMOTE_ADDR": "10.0.0.1"}):
+                for _ in range(hasher.max_per_ip):
+                    held.enter_context(hasher.slot())
+
+            resp = self.login(c)
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(hasher.metrics.snapshot()["rejected"], {"ip": 1})
+
+    def test_queue_full(self):
+        """Tests a full queue answers 503 with Retry-After."""
+
+        app.config['PASSWORD_HASH_QUEUE_SIZE'] = 0
+        try:
+            hasher.init_app(app)
+        finally:
+            app.config['PASSWORD_HASH_QUEUE_SIZE'] = 32
+
+        with app.test_client() as c, ExitStack() as held:
+            for _ in range(hasher.workers):
+                held.enter_context(hasher.slot())
+
+            resp = self.login(c)
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers["Retry-After"], "1")
+            self.assertEqual(
+                hasher.metrics.snapshot()["rejected"], {"queue": 1})
+
+
+class AdaptiveCostTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        old_hash = bcrypt.generate_password_hash("password", 4).decode()
+        user = User(
+            username="old",
+            email="old@email.com",
+            password=old_hash,
+            image_url="",
+        )
+        db.session.add(user)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.old_hash = old_hash
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_calibrate_rounds_bounds(self):
+        """Tests calibration stays within the configured bounds."""
+
+        self.assertEqual(calibrate_rounds(bcrypt, 1000, 10, 13), 13)
+        self.assertEqual(calibrate_rounds(bcrypt, 0, 10, 13), 10)
+
+    def test_signup_uses_target_cost(self):
+        """Tests new hashes use the calibrated cost."""
+
+        user = User.signup("new", "new@email.com", "password", None)
+
+        self.assertEqual(bcrypt_cost(user.password), hasher.rounds)
+
+    def test_rehash_on_login(self):
+        """Tests logging in upgrades a hash stored at another cost."""
+
+        self.assertTrue(User.authenticate("old", "password"))
+        hasher.wait_for_rehashes(timeout=30)
+
+        db.session.expire_all()
+        user = db.session.get(User, self.user_id)
+
+        self.assertEqual(bcrypt_cost(user.password), hasher.rounds)
+        self.assertTrue(User.authenticate("old", "password"))
+
+    def test_no_rehash_down(self):
+        """Tests hashes above the target cost (e.g. from a host that
+        calibrated higher) are kept."""
+
+        self.assertTrue(hasher.needs_rehash(f"$2b${hasher.rounds - 1:02}$x"))
+        self.assertFalse(hasher.needs_rehash(f"$2b${hasher.rounds:02}$x"))
+        self.assertFalse(hasher.needs_rehash(f"$2b${hasher.rounds + 1:02}$x"))
+
+    def test_replace_password_is_conditional(self):
+        """Tests a rehash doesn't overwrite a password changed meanwhile."""
+
+        User.replace_password(self.user_id, "stale-hash", "new-hash")
+
+        db.session.expire_all()
+        user = db.session.get(User, self.user_id)
+
+        self.assertEqual(user.password, self.old_hash)
@@ -0,0 +1,213 @@
+"""Query plan tests.
+
+Seeds a few thousand rows, then EXPLAINs the SQL that the home, profile,
+followers, liked and top messages pages actually send, to check each hot
+query is served by an index rather than a sequential scan.
+"""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_query_plans.py
+
+import os
+import re
+from unittest import TestCase
+
+from sqlalchemy import event, text
+
+from models import db, User
+from timeline import rebuild_timelines
+
+# BEFORE we import our app, let's set an environmental variable to use a
+# different database for tests (we need to do this before we import our app,
+# since that will have already connected to the database).
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY, user_cache
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Fail any request sending more SQL statements than this (catches N+1s)
+app.config['MAX_QUERIES_PER_REQUEST'] = 10
+
+NUM_USERS = 2000
+NUM_MESSAGES = 20000
+NUM_FOLLOWS = 10000
+NUM_LIKES = 10000
+
+SEED_SQL = [
+    f"""
+    INSERT INTO users (email, username, password, image_url,
+                       header_image_url, bio, location)
+    SELECT 'plan' || n || '@email.com', 'plan' || n, 'x', '', '', '', ''
+    FROM generate_series(1, {NUM_USERS}) AS n
+    """,
+    f"""
+    INSERT INTO messages (text, timestamp, user_id)
+    SELECT 'message ' || n,
+           now() - n * interval '1 minute',
+           (SELECT min(id) FROM users) + n % {NUM_USERS}
+    FROM generate_series(1, {NUM_MESSAGES}) AS n
+    """,
+    f"""
+    INSERT INTO follows (user_being_followed_id, user_following_id)
+    SELECT DISTINCT
+           (SELECT min(id) FROM users) + (n * 7) % {NUM_USERS},
+           (SELECT min(id) FROM users) + (n * 13 + n / {NUM_USERS}) % {NUM_USERS}
+    FROM generate_series(1, {NUM_FOLLOWS}) AS n
+    ON CONFLICT DO NOTHING
+    """,
+    # the user whose pages are checked follows a quarter of everyone, so
+    # their timeline is long enough that reading it in order beats sorting
+    f"""
+    INSERT INTO follows (user_being_followed_id, user_following_id)
+    SELECT (SELECT min(id) FROM users) + n, (SELECT min(id) FROM users)
+    FROM generate_series(1, {NUM_USERS // 4}) AS n
+    ON CONFLICT DO NOTHING
+    """,
+    f"""
+    INSERT INTO liked_messages (user_id, message_id, liked_at)
+    SELECT (SELECT min(id) FROM users) + n % {NUM_USERS},
+           (SELECT min(id) FROM messages) + (n * 17) % {NUM_MESSAGES},
+           now() - n * interval '5 minutes'
+    FROM generate_series(1, {NUM_LIKES}) AS n
+    ON CONFLICT DO NOTHING
+    """,
+]
+
+
+class QueryPlanTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        User.query.delete()
+
+        for statement in SEED_SQL:
+            db.session.execute(text(statement))
+        rebuild_timelines()
+        db.session.commit()
+
+        # Move the seed out of GIN's pending list, as (auto)vacuum would,
+        # and gather statistics; committed, so the planner sees them no
+        # matter when autovacuum next runs.
+        db.session.execute(text(
+            "SELECT gin_clean_pending_list('ix_messages_search_vector')"))
+        db.session.execute(text("ANALYZE"))
+        db.session.commit()
+
+        cls.user_id = db.session.execute(
+            text("SELECT min(id) FROM users")).scalar()
+
+    @classmethod
+    def tearDownClass(cls):
+        User.query.delete()
+        db.session.commit()
+        user_cache.clear()
+
+    def capture_statements(self, url):
+        """GET `url` as a logged-in user; return the SQL it sent."""
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, many):
+            statements.append((statement, parameters))
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                resp = c.get(url)
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+
+        self.assertEqual(resp.status_code, 200)
+        return statements
+
+    def assert_index_scans(self, url, table, index):
+        """Check `url` reads `table` through `index` and never seq scans it.
+
+        Plans are checked for the named index, since btree indexes can also
+        be walked end to end, which is no better than a sequential scan.
+        """
+
+        statements = [
+            (statement, parameters)
+            for statement, parameters in self.capture_statements(url)
+            if statement.lstrip().startswith("SELECT")
+            and re.search(rf"\b{table}\b", statement)
+        ]
+        self.assertTrue(statements, f"{url} never read {table}")
+
+        with db.engine.connect() as conn:
+            plans = [
+                "\n".join(row[0] for row in conn.exec_driver_sql(
+                    f"EXPLAIN {statement}", parameters))
+                for statement, parameters in statements
+            ]
+
+        for plan in plans:
+            self.assertNotIn(f"Seq Scan on {table}", plan)
+
+        self.assertTrue(
+            any(re.search(rf"(using|Bitmap Index Scan on) {index}\b", plan)
+                for plan in plans),
+            "\n\n".join(plans))
+
+    def test_home_plan(self):
+        """Tests the home timeline reads timeline_entries by index."""
+
+        self.assert_index_scans(
+            "/", "timeline_entries", "ix_timeline_entries_user_timestamp")
+
+    def test_profile_plan(self):
+        """Tests a profile reads the user's messages by index."""
+
+        self.assert_index_scans(
+            f"/users/{self.user_id}", "messages", "ix_messages_user_timestamp")
+
+    def test_followers_plan(self):
+        """Tests the followers page reads follows by index."""
+
+        self.assert_index_scans(
+            f"/users/{self.user_id}/followers", "follows", "follows_pkey")
+
+    def test_following_plan(self):
+        """Tests the following page reads follows by index."""
+
+        self.assert_index_scans(
+            f"/users/{self.user_id}/following",
+            "follows",
+            "ix_follows_user_following_id")
+
+    def test_liked_plan(self):
+        """Tests the liked page reads liked_messages by index."""
+
+        self.assert_index_scans(
+            f"/users/{self.user_id}/liked",
+            "liked_messages",
+            "ix_liked_messages_user_liked_at")
+
+    def test_message_search_plan(self):
+        """Tests message search reads messages through the GIN index."""
+
+        self.assert_index_scans(
+            "/messages/search?q=12345",
+            "messages",
+            "ix_messages_search_vector")
+
+    def test_top_messages_plan(self):
+        """Tests the leaderboard reads only its window of like buckets."""
+
+        self.assert_index_scans(
+            "/messages/top?window=24h",
+            "message_like_buckets",
+            "message_like_buckets_pkey")
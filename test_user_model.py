@@ -6,8 +6,12 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, User, Message, Follow
+import numpy as np
+
+from models import (
+    db, User, Message, Follow, reconcile_counters, following_status)
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
@@ -15,6 +19,11 @@ from models import db, User, Message, Follow
 
 from sqlalchemy.exc import IntegrityError
 
+from search import NgramIndex, trigrams
+from suggestions import (
+    load_follow_edges, refresh_suggestions, score_candidates,
+    suggestions_for)
+
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 from flask import session
@@ -148,4 +157,227 @@ class UserModelTestCase(TestCase):
 
         self.assertEqual(User.authenticate(u1.username, "password"), u1)
         self.assertNotEqual(User.authenticate(u1.username, "NotPassword"), u1)
-        self.assertNotEqual(User.authenticate("NotUsername", "NotPassword"), u1)
\ No newline at end of file
+        self.assertNotEqual(User.authenticate("NotUsername", "NotPassword"), u1)
+
+    def test_counters_follow_writes(self):
+        """Tests that counter columns track follows, messages and likes."""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u1.following.append(u2)
+        message = Message(text="counted", user_id=self.u2_id)
+        db.session.add(message)
+        db.session.flush()
+        u1.liked.append(message)
+        db.session.commit()
+
+        db.session.refresh(u1)
+        db.session.refresh(u2)
+
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u2.followers_count, 1)
+        self.assertEqual(u2.messages_count, 1)
+        self.assertEqual(u1.likes_count, 1)
+
+        db.session.delete(message)
+        u1.following.remove(u2)
+        db.session.commit()
+
+        db.session.refresh(u1)
+        db.session.refresh(u2)
+
+        self.assertEqual(u1.following_count, 0)
+        self.assertEqual(u2.followers_count, 0)
+        self.assertEqual(u2.messages_count, 0)
+        self.assertEqual(u1.likes_count, 0)
+
+    def test_reconcile_counters(self):
+        """Tests that reconcile_counters repairs drifted counters."""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u1.following.append(u2)
+        db.session.commit()
+
+        u1.following_count = 42
+        u2.messages_count = 7
+        db.session.commit()
+
+        self.assertEqual(reconcile_counters(), 2)
+        db.session.commit()
+
+        db.session.refresh(u1)
+        db.session.refresh(u2)
+
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u2.messages_count, 0)
+        self.assertEqual(reconcile_counters(), 0)
+
+    def test_following_status(self):
+        """Tests batched follow lookup for a page of users."""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.assertEqual(
+            following_status(u1, [self.u2_id, u3.id, self.u1_id]),
+            {self.u2_id})
+        self.assertEqual(following_status(u2, [self.u1_id, u3.id]), set())
+        self.assertEqual(following_status(u1, []), set())
+
+
+class NgramIndexTestCase(TestCase):
+    """Tests for the in-process user search index."""
+
+    def setUp(self):
+        self.index = NgramIndex([
+            (1, "alice", "", "Oakland", None),
+            (2, "malice", "likes alice", "", None),
+            (3, "bob", "", "", None),
+        ])
+
+    def test_trigrams_match_pg_trgm(self):
+        """Tests trigram extraction pads and lowercases words."""
+
+        self.assertEqual(
+            trigrams("Cat"), {"  c", " ca", "cat", "at "})
+
+    def test_search_substring(self):
+        """Tests substring matches across fields, exact username first."""
+
+        self.assertEqual(
+            [user_id for _, user_id in self.index.search("alice")], [1, 2])
+        self.assertEqual(
+            [user_id for _, user_id in self.index.search("oak")], [1])
+        self.assertEqual(self.index.search("zzz"), [])
+
+    def test_search_cursor(self):
+        """Tests results resume after a cursor."""
+
+        first = self.index.search("alice", limit=1)
+        rest = self.index.search("alice", cursor=first[0])
+
+        self.assertEqual([user_id for _, user_id in rest], [2])
+
+    def test_autocomplete(self):
+        """Tests prefix lookups are case-insensitive and ordered."""
+
+        self.assertEqual(
+            [user_id for user_id, _, _ in self.index.autocomplete("B")], [3])
+        self.assertEqual(self.index.autocomplete("x"), [])
+
+    def test_update(self):
+        """Tests entries are replaced or dropped in place."""
+
+        self.index.update([1, 3], [(1, "zalice", "", "", None)])
+
+        self.assertEqual(
+            [user_id for _, user_id in self.index.search("oak")], [])
+        self.assertEqual(
+            [user_id for _, user_id in self.index.search("alice")], [2, 1])
+        self.assertEqual(
+            [user_id for user_id, _, _ in self.index.autocomplete("z")], [1])
+        self.assertEqual(self.index.autocomplete("b"), [])
+
+
+class SuggestionsTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        users = [
+            User(username=f"u{i}", email=f"u{i}@email.com",
+                 password=PASSWORD, image_url="")
+            for i in range(5)
+        ]
+        db.session.add_all(users)
+        db.session.flush()
+
+        # u0 follows u1 and u2; both follow u3, only u2 follows u4 (and u2
+        # follows more people, so counts for less)
+        u0, u1, u2, u3, u4 = [user.id for user in users]
+        db.session.add_all([
+            Follow(user_following_id=follower, user_being_followed_id=followed)
+            for follower, followed in [
+                (u0, u1), (u0, u2),
+                (u1, u3), (u1, u0),
+                (u2, u3), (u2, u4), (u2, u0), (u2, u1),
+            ]
+        ])
+        db.session.commit()
+
+        self.user_ids = [u0, u1, u2, u3, u4]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_score_candidates(self):
+        """Tests friends of friends are ranked, skipping existing follows."""
+
+        followers = np.array([1, 1, 2, 2, 3])
+        followed = np.array([2, 3, 4, 1, 4])
+
+        blocks = list(score_candidates(followers, followed, max_paths=1))
+        suggestions = {
+            (int(user_id), int(suggested_id)): int(rank)
+            for block in blocks
+            for user_id, suggested_id, _, rank in zip(*block)
+        }
+
+        # 1 reaches 4 through 2 and 3, 2 reaches 3 through 1; neither is
+        # offered itself, and 3 and 4 have no friends of friends
+        self.assertGreater(len(blocks), 1)
+        self.assertEqual(suggestions, {(1, 4): 1, (2, 3): 1})
+
+    def test_load_follow_edges(self):
+        """Tests the edge list survives rows split across COPY chunks."""
+
+        expected = {
+            (follow.user_following_id, follow.user_being_followed_id)
+            for follow in Follow.query
+        }
+
+        # odd-sized chunks split the header and rows mid-way
+        with patch('suggestions.EDGE_CHUNK_SIZE', 7):
+            followers, followed = load_follow_edges()
+
+        self.assertEqual(followers.dtype, np.int64)
+        self.assertEqual(len(followers), len(expected))
+        self.assertEqual(
+            set(zip(followers.tolist(), followed.tolist())), expected)
+
+    def test_refresh_suggestions(self):
+        """Tests stored suggestions are ranked by weighted shared follows."""
+
+        u0, u1, u2, u3, u4 = self.user_ids
+
+        refresh_suggestions(top_k=5)
+        db.session.commit()
+
+        self.assertEqual(
+            [user.username for user in suggestions_for(
+                db.session.get(User, u0), 5)],
+            ["u3", "u4"])
+        self.assertEqual(
+            [user.username for user in suggestions_for(
+                db.session.get(User, u1), 5)],
+            ["u2"])
+
+    def test_followed_suggestions_skipped(self):
+        """Tests a suggestion followed since the batch ran isn't shown."""
+
+        u0, u1, u2, u3, u4 = self.user_ids
+
+        refresh_suggestions(top_k=5)
+        db.session.add(Follow(user_following_id=u0, user_being_followed_id=u3))
+        db.session.commit()
+
+        self.assertEqual(
+            [user.username for user in suggestions_for(
+                db.session.get(User, u0), 5)],
+            ["u4"])
+
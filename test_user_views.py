@@ -5,11 +5,20 @@
 # FLASK_DEBUG=False python -m unittest test_user_views.py
 
 import os
+import re
+import sys
+from datetime import datetime
+from types import SimpleNamespace
 from unittest import TestCase
+from unittest.mock import patch
 
 from bs4 import BeautifulSoup
+from sqlalchemy import event
 
+from fragments import FragmentCache, RedisStore
 from models import Follow, LikedMessages, Message, User, db
+from search import fallback_index
+from suggestions import refresh_suggestions
 
 # BEFORE we import our app, let's set an environmental variable to use a
 # different database for tests (we need to do this before we import our app,
@@ -19,7 +28,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, fragment_cache, user_cache
 
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
@@ -33,6 +42,9 @@ db.create_all()
 # Don't have WTForms use CSRF at all, since it's a pain to test
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any request sending more SQL statements than this (catches N+1s)
+app.config['MAX_QUERIES_PER_REQUEST'] = 10
+
 
 class UserBaseViewTestCase(TestCase):
     def setUp(self):
@@ -53,6 +65,7 @@ class UserBaseViewTestCase(TestCase):
 
     def tearDown(self):
         db.session.rollback()
+        user_cache.clear()
 
 
 class UserListShowTestCase(UserBaseViewTestCase):
@@ -156,6 +169,289 @@ class UserListShowTestCase(UserBaseViewTestCase):
             self.assertIn("Happening?", str(resp.data))
 
 
+class UserMessagesPaginationTestCase(UserBaseViewTestCase):
+    """Test cases for cursor pagination of a user's messages."""
+
+    def setUp(self):
+        super().setUp()
+
+        for i in range(5):
+            db.session.add(Message(text=f"warble-{i}", user_id=self.u1_id))
+        db.session.commit()
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+    def tearDown(self):
+        app.config['MESSAGES_PER_PAGE'] = 100
+        super().tearDown()
+
+    def test_user_show_pages_with_cursor(self):
+        """Tests that walking the cursors visits every message once."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            seen = []
+            url = f'/users/{self.u1_id}'
+
+            while url:
+                resp = c.get(url, headers={"Accept": "application/json"})
+                self.assertEqual(resp.status_code, 200)
+
+                page = resp.json
+                self.assertLessEqual(len(page["messages"]), 2)
+                seen.extend(m["text"] for m in page["messages"])
+
+                cursor = page["next_cursor"]
+                url = cursor and f'/users/{self.u1_id}?before={cursor}'
+
+            self.assertEqual(
+                sorted(seen), [f"warble-{i}" for i in range(5)])
+
+    def test_user_show_older_link(self):
+        """Tests the HTML page links to the next page of messages."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/users/{self.u1_id}')
+
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            self.assertEqual(len(soup.select("#messages li")), 2)
+            self.assertIn("?before=", soup.find(id="older-messages")["href"])
+
+    def test_user_show_invalid_cursor(self):
+        """Tests that a garbled cursor is a 400, not a 500."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/users/{self.u1_id}?before=nonsense')
+
+            self.assertEqual(resp.status_code, 400)
+
+
+class UserSearchViewTestCase(UserBaseViewTestCase):
+    """Test cases for ranked user search and autocomplete."""
+
+    def setUp(self):
+        super().setUp()
+
+        alice = User.signup("alice", "alice@email.com", "password", None)
+        alicia = User.signup("alicia", "alicia@email.com", "password", None)
+        bob = User.signup("bob", "bob@email.com", "password", None)
+        bob.bio = "Friends with alice"
+        bob.location = "Springfield"
+        db.session.commit()
+
+        self.alice_id = alice.id
+        self.alicia_id = alicia.id
+        self.bob_id = bob.id
+
+    def search(self, c, url):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        resp = c.get(url, headers={"Accept": "application/json"})
+        self.assertEqual(resp.status_code, 200)
+        return resp.json
+
+    def test_search_ranks_username_matches_first(self):
+        """Tests exact, then prefix, then bio matches."""
+
+        with app.test_client() as c:
+            results = self.search(c, '/users?q=alice')
+
+            self.assertEqual(
+                [user["id"] for user in results["users"]],
+                [self.alice_id, self.alicia_id, self.bob_id])
+
+    def test_search_matches_location(self):
+        """Tests searching by location."""
+
+        with app.test_client() as c:
+            results = self.search(c, '/users?q=springf')
+
+            self.assertEqual(
+                [user["username"] for user in results["users"]], ["bob"])
+
+    def test_search_tolerates_typos(self):
+        """Tests a near-miss username still matches."""
+
+        with app.test_client() as c:
+            results = self.search(c, '/users?q=alicea')
+
+            self.assertIn(
+                self.alicia_id, [user["id"] for user in results["users"]])
+
+    def test_search_pages_with_cursor(self):
+        """Tests walking search result pages visits each match once."""
+
+        app.config['USERS_PER_PAGE'] = 1
+
+        try:
+            with app.test_client() as c:
+                seen = []
+                url = '/users?q=ali'
+
+                while url:
+                    results = self.search(c, url)
+                    self.assertLessEqual(len(results["users"]), 1)
+                    seen.extend(user["id"] for user in results["users"])
+
+                    cursor = results["next_cursor"]
+                    url = cursor and f'/users?q=ali&after={cursor}'
+
+            self.assertEqual(seen, [self.alice_id, self.alicia_id, self.bob_id])
+
+        finally:
+            app.config['USERS_PER_PAGE'] = 60
+
+    def test_autocomplete(self):
+        """Tests username prefix autocomplete."""
+
+        with app.test_client() as c:
+            results = self.search(c, '/users/autocomplete?q=AL')
+
+            self.assertEqual(
+                [user["username"] for user in results["users"]],
+                ["alice", "alicia"])
+
+    def test_index_updated_in_place(self):
+        """Tests profile edits reach the search index without rebuilding
+        it, and follows don't touch it."""
+
+        with app.test_client() as c:
+            self.search(c, '/users?q=alice')
+            index = fallback_index._index
+
+            resp = c.post(f"/users/follow/{self.alice_id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertFalse(fallback_index._stale)
+
+            db.session.get(User, self.bob_id).username = "bobby"
+            db.session.commit()
+
+            results = self.search(c, '/users/autocomplete?q=bob')
+
+            self.assertEqual(
+                [user["username"] for user in results["users"]], ["bobby"])
+            self.assertIs(fallback_index._index, index)
+
+
+class SuggestionsViewTestCase(UserBaseViewTestCase):
+    def test_suggestions(self):
+        """Tests the who-to-follow page lists stored suggestions."""
+
+        db.session.add_all([
+            Follow(user_following_id=self.u1_id,
+                   user_being_followed_id=self.u2_id),
+            Follow(user_following_id=self.u2_id,
+                   user_being_followed_id=self.u3_id),
+        ])
+        db.session.commit()
+
+        refresh_suggestions()
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            page = c.get("/users/suggestions")
+            data = c.get("/users/suggestions",
+                         headers={"Accept": "application/json"}).json
+
+        self.assertIn("@u3", page.get_data(as_text=True))
+        self.assertEqual([user["id"] for user in data["users"]], [self.u3_id])
+
+
+class CurrentUserCacheTestCase(UserBaseViewTestCase):
+    """Test cases for caching the logged-in user between requests."""
+
+    def count_user_selects(self, c, url):
+        """GET `url`, returning how many SELECTs loaded u1, who's logged in."""
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, *args):
+            if isinstance(parameters, dict) and \
+                    self.u1_id in parameters.values():
+                statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            c.get(url)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+        return len([s for s in statements
+                    if re.search(r"FROM users\s+WHERE users\.id = ", s)])
+
+    def test_cached_user_skips_select(self):
+        """Tests that a second request renders g.user without a query."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertEqual(self.count_user_selects(c, "/messages/new"), 1)
+            self.assertEqual(self.count_user_selects(c, "/messages/new"), 0)
+
+    def test_cached_user_pages_skip_select(self):
+        """Tests that the counts on the homepage come from the cache, and
+        that ETags read only the viewer's version."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/messages/new")
+
+            self.assertEqual(self.count_user_selects(c, "/"), 0)
+            self.assertEqual(
+                self.count_user_selects(c, f"/users/{self.u2_id}/followers"),
+                1)
+
+    def test_follow_invalidates_cache(self):
+        """Tests that the homepage shows new counts right after a follow."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/")
+            c.post(f"/users/follow/{self.u2_id}")
+
+            html = c.get("/").get_data(as_text=True)
+
+            self.assertRegex(
+                html, rf'href="/users/{self.u1_id}/following">\s*1\s*<')
+
+    def test_edit_profile_invalidates_cache(self):
+        """Tests that the nav shows the new username right after an edit."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/messages/new")
+            c.post(
+                "/users/profile",
+                data={
+                    "username": "renamed",
+                    "email": "u1@email.com",
+                    "password": "password",
+                })
+
+            resp = c.get("/messages/new")
+
+            self.assertIn('alt="renamed"', resp.get_data(as_text=True))
+
+
 class UserProfileViewTestCase(UserBaseViewTestCase):
     """Test cases for user profile features."""
 
@@ -299,6 +595,57 @@ class UserLikeTestCase(UserBaseViewTestCase):
                 LikedMessages.message_id == self.m1_id).all()
             self.assertEqual(len(likes), 0)
 
+    def test_liked_star_on_profile(self):
+        """Tests the filled star shows for messages the viewer has liked."""
+
+        m2 = Message(text="not-liked", user_id=self.u2_id)
+        db.session.add(m2)
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/users/{self.u2_id}')
+
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            stars = {
+                form["action"]: form.find("i")["class"]
+                for form in soup.select("#star-area form")
+            }
+
+            self.assertIn(
+                "bi-star-fill", stars[f"/messages/{self.m1_id}/liked"])
+            self.assertIn("bi-star", stars[f"/messages/{m2.id}/liked"])
+            self.assertNotIn(
+                "bi-star-fill", stars[f"/messages/{m2.id}/liked"])
+
+    def test_show_likes_ordered_by_liked_at(self):
+        """Tests the liked page lists most recently liked messages first."""
+
+        older = Message(
+            text="older-message",
+            user_id=self.u2_id,
+            timestamp=datetime(2020, 1, 1),
+        )
+        db.session.add(older)
+        db.session.flush()
+        db.session.add(LikedMessages(user_id=self.u1_id, message_id=older.id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(
+                f'/users/{self.u1_id}/liked',
+                headers={"Accept": "application/json"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                [m["id"] for m in resp.json["messages"]],
+                [older.id, self.m1_id])
+
 
 class UserFollowingViewTestCase(UserBaseViewTestCase):
     def setUp(self):
@@ -344,4 +691,285 @@ class UserFollowingViewTestCase(UserBaseViewTestCase):
             # Test for a count of 1 following
             self.assertIn("1", found[1].text)
             # Test for a count of 2 followers
-            self.assertIn("2", found[2].text)
\ No newline at end of file
+            self.assertIn("2", found[2].text)
+
+
+class ConditionalGetTestCase(UserBaseViewTestCase):
+    def get(self, c, url, viewer_id=None, etag=None):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = viewer_id or self.u1_id
+
+        headers = {"If-None-Match": etag} if etag else {}
+        return c.get(url, headers=headers)
+
+    def test_unchanged_profile_is_304(self):
+        """Tests a revisited, unchanged profile short-circuits to 304."""
+
+        with app.test_client() as c:
+            first = self.get(c, f"/users/{self.u2_id}")
+            etag = first.headers["ETag"]
+
+            self.assertTrue(etag.startswith('W/"'))
+            self.assertIn("private", first.headers["Cache-Control"])
+            self.assertIn("no-cache", first.headers["Cache-Control"])
+
+            again = self.get(c, f"/users/{self.u2_id}", etag=etag)
+
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again.data, b"")
+            self.assertEqual(again.headers["ETag"], etag)
+
+    def test_profile_changes_after_new_message(self):
+        """Tests a new message by the profile's user changes the ETag."""
+
+        with app.test_client() as c:
+            etag = self.get(c, f"/users/{self.u2_id}").headers["ETag"]
+
+            db.session.add(Message(text="new", user_id=self.u2_id))
+            db.session.commit()
+
+            resp = self.get(c, f"/users/{self.u2_id}", etag=etag)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("new", resp.get_data(as_text=True))
+
+    def test_etag_depends_on_viewer(self):
+        """Tests another viewer doesn't get a 304 for someone else's copy."""
+
+        with app.test_client() as c:
+            etag = self.get(c, f"/users/{self.u2_id}").headers["ETag"]
+            resp = self.get(
+                c, f"/users/{self.u2_id}", viewer_id=self.u3_id, etag=etag)
+
+            self.assertEqual(resp.status_code, 200)
+
+    def test_etag_sees_viewer_changes_from_elsewhere(self):
+        """Tests a like made by another process, which can't clear this
+        one's cached snapshot of the viewer, still changes the ETag."""
+
+        message = Message(text="likeable", user_id=self.u2_id)
+        db.session.add(message)
+        db.session.commit()
+
+        with app.test_client() as c:
+            url = f"/users/{self.u2_id}"
+            etag = self.get(c, url).headers["ETag"]
+
+            LikedMessages.toggle(self.u1_id, message.id)
+            db.session.commit()
+
+            self.assertEqual(self.get(c, url, etag=etag).status_code, 200)
+
+    def test_followers_change_when_follower_edits_profile(self):
+        """Tests follow lists change when a listed user changes."""
+
+        db.session.add(Follow(
+            user_being_followed_id=self.u2_id, user_following_id=self.u3_id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            url = f"/users/{self.u2_id}/followers"
+            etag = self.get(c, url).headers["ETag"]
+
+            self.assertEqual(self.get(c, url, etag=etag).status_code, 304)
+
+            u3 = db.session.get(User, self.u3_id)
+            u3.bio = "new bio"
+            db.session.commit()
+
+            self.assertEqual(self.get(c, url, etag=etag).status_code, 200)
+
+    def test_pending_flash_skips_304(self):
+        """Tests a page with flashed messages waiting is always rendered."""
+
+        with app.test_client() as c:
+            etag = self.get(c, f"/users/{self.u2_id}").headers["ETag"]
+
+            with c.session_transaction() as sess:
+                sess["_flashes"] = [("success", "Hello!")]
+
+            resp = self.get(c, f"/users/{self.u2_id}", etag=etag)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Hello!", resp.get_data(as_text=True))
+
+    def test_other_pages_not_stored(self):
+        """Tests pages without a cache policy stay no-store."""
+
+        with app.test_client() as c:
+            resp = self.get(c, "/users/profile")
+
+            self.assertEqual(resp.headers["Cache-Control"], "no-store")
+            self.assertNotIn("ETag", resp.headers)
+
+    def test_static_urls_are_immutable(self):
+        """Tests static links carry a content hash and cache forever."""
+
+        with app.test_client() as c:
+            html = self.get(c, f"/users/{self.u2_id}").get_data(as_text=True)
+            soup = BeautifulSoup(html, 'html.parser')
+            url = soup.find("link", {"rel": "stylesheet", "href": lambda h:
+                            h.startswith("/static/")})["href"]
+
+            self.assertIn("?v=", url)
+
+            resp = c.get(url)
+            cache_control = resp.headers["Cache-Control"]
+
+            self.assertIn("immutable", cache_control)
+            self.assertIn("max-age=31536000", cache_control)
+            self.assertIn("public", cache_control)
+            resp.close()
+
+
+class FragmentCacheTestCase(UserBaseViewTestCase):
+    def tearDown(self):
+        super().tearDown()
+        fragment_cache.clear()
+
+    def get_profile(self, c, viewer_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = viewer_id
+
+        return c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+
+    def test_profile_fragments_reused(self):
+        """Tests a profile's shared parts are rendered once and reused."""
+
+        with app.test_client() as c:
+            self.get_profile(c, self.u1_id)
+
+            u2 = db.session.get(User, self.u2_id)
+            fragment_cache.set(
+                "user-bio", u2.id, u2.profile_version,
+                "<p>from the cache</p>")
+
+            self.assertIn("from the cache", self.get_profile(c, self.u3_id))
+
+    def test_new_version_rerenders(self):
+        """Tests a changed user is rendered afresh."""
+
+        with app.test_client() as c:
+            self.get_profile(c, self.u1_id)
+
+            u2 = db.session.get(User, self.u2_id)
+            u2.bio = "brand new bio"
+            db.session.commit()
+
+            self.assertIn("brand new bio", self.get_profile(c, self.u1_id))
+
+    def test_message_fragments_outlive_counters(self):
+        """Tests likes and follows leave message fragments in place, and a
+        new username replaces them."""
+
+        message = Message(text="hello", user_id=self.u2_id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+
+        with app.test_client() as c:
+            self.get_profile(c, self.u1_id)
+            u2 = db.session.get(User, self.u2_id)
+            version, profile_version = u2.version, u2.profile_version
+
+            db.session.add(Follow(
+                user_being_followed_id=self.u2_id,
+                user_following_id=self.u3_id))
+            db.session.commit()
+
+            self.assertNotEqual(u2.version, version)
+            self.assertEqual(u2.profile_version, profile_version)
+            self.assertIsNotNone(fragment_cache.get(
+                "profile-message-item", message_id, u2.profile_version))
+
+            u2.username = "renamed"
+            db.session.commit()
+
+            self.assertNotEqual(u2.profile_version, profile_version)
+            self.assertIn("@renamed", self.get_profile(c, self.u1_id))
+
+    def test_follow_button_per_viewer(self):
+        """Tests the follow button isn't shared through the cache."""
+
+        db.session.add(Follow(
+            user_being_followed_id=self.u2_id, user_following_id=self.u1_id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            self.assertIn("Unfollow", self.get_profile(c, self.u1_id))
+
+            html = self.get_profile(c, self.u3_id)
+
+            self.assertNotIn("Unfollow", html)
+            self.assertIn("Follow", html)
+
+    def test_follow_invalidates_fragments(self):
+        """Tests following drops both users' cached fragments."""
+
+        with app.test_client() as c:
+            self.get_profile(c, self.u1_id)
+            u2 = db.session.get(User, self.u2_id)
+            version = u2.version
+
+            self.assertIsNotNone(
+                fragment_cache.get("user-stats", self.u2_id, version))
+
+            c.post(f"/users/follow/{self.u2_id}")
+
+            self.assertIsNone(
+                fragment_cache.get("user-stats", self.u2_id, version))
+
+    def test_shared_store(self):
+        """Tests workers reuse each other's fragments via the shared store."""
+
+        class DictStore(dict):
+            def set(self, key, value):
+                self[key] = value
+
+            def delete(self, key):
+                self.pop(key, None)
+
+        shared = DictStore()
+        worker1 = FragmentCache(shared=shared)
+        worker2 = FragmentCache(shared=shared)
+
+        worker1.set("user-bio", 1, 7, "<p>bio</p>")
+
+        self.assertEqual(worker2.get("user-bio", 1, 7), "<p>bio</p>")
+        self.assertIsNone(worker2.get("user-bio", 1, 8))
+
+        worker1.invalidate_user(1)
+
+        self.assertEqual(shared, {})
+
+    def test_shared_store_down(self):
+        """Tests pages render, uncached, while Redis is down."""
+
+        class RedisError(Exception):
+            pass
+
+        class DownClient:
+            calls = 0
+
+            def __getattr__(self, name):
+                def fail(*args, **kwargs):
+                    DownClient.calls += 1
+                    raise RedisError("Connection refused")
+                return fail
+
+        redis = SimpleNamespace(
+            RedisError=RedisError,
+            Redis=SimpleNamespace(from_url=lambda url, **kwargs: DownClient()))
+
+        with patch.dict(sys.modules, {"redis": redis}):
+            store = RedisStore("redis://nowhere", 60)
+
+        worker = FragmentCache(shared=store)
+
+        with self.assertLogs("fragments", "WARNING"):
+            worker.set("user-bio", 1, 7, "<p>bio</p>")
+
+        self.assertEqual(worker.get("user-bio", 1, 7), "<p>bio</p>")
+        self.assertIsNone(worker.get("user-bio", 2, 7))
+        # left alone after the first failure
+        self.assertEqual(DownClient.calls, 1)
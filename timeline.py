@@ -0,0 +1,277 @@
+"""Materialized home timelines for Warbler.
+
+Every user has a list of `TimelineEntry` rows: their own messages plus the
+messages of everyone they follow. Rows are written when a message is posted
+(fan-out-on-write) and when a follow starts or stops, so reading the home
+page is a single range scan on `(user_id, timestamp)`.
+
+Authors with very many followers would make fan-out-on-write too expensive,
+so once they cross `TIMELINE_FANOUT_MAX_FOLLOWERS` they are flagged with
+`User.fanout_on_read` and their messages are merged in at read time instead.
+"""
+
+from flask import current_app
+from sqlalchemy import delete, literal, select, true, union_all, update
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, Follow, Message, TimelineEntry, User, with_authors
+from pagination import keyset_filter, page_of
+
+DEFAULT_FANOUT_MAX_FOLLOWERS = 10000
+DEFAULT_BACKFILL_LIMIT = 100
+
+
+def _fanout_max_followers():
+    return current_app.config.get(
+        'TIMELINE_FANOUT_MAX_FOLLOWERS', DEFAULT_FANOUT_MAX_FOLLOWERS)
+
+
+def _backfill_limit():
+    return current_app.config.get(
+        'TIMELINE_BACKFILL_LIMIT', DEFAULT_BACKFILL_LIMIT)
+
+
+def add_message(message):
+    """Fan a newly posted `message` out to its author and their followers.
+
+    Message must already be flushed so it has an id.
+    """
+
+    author = db.session.get(User, message.user_id)
+
+    rows = select(
+        literal(message.user_id),
+        literal(message.id),
+        literal(message.user_id),
+        literal(message.timestamp),
+    )
+
+    if not author.fanout_on_read:
+        rows = union_all(rows, select(
+            Follow.user_following_id,
+            literal(message.id),
+            literal(message.user_id),
+            literal(message.timestamp),
+        ).where(Follow.user_being_followed_id == message.user_id))
+
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'message_id', 'author_id', 'timestamp'],
+        rows,
+    ).on_conflict_do_nothing())
+
+
+def add_follow(follower_id, followed_id):
+    """Copy `followed_id`'s recent messages into `follower_id`'s timeline.
+
+    Also switches the followed user to fan-out-on-read once they have grown
+    past the fan-out limit.
+    """
+
+    add_follows(follower_id, [followed_id])
+
+
+def add_follows(follower_id, followed_ids):
+    """`add_follow` for several newly followed users at once.
+
+    One SELECT finds which are still fanned out on write and whether they
+    have grown past the fan-out limit; an UPDATE flags those that have (only
+    when there are any), then one INSERT copies the most recent messages of
+    each of the rest.
+    """
+
+    if not followed_ids:
+        return
+
+    # Reads the counter columns fresh, since the trigger that maintains them
+    # may have fired after the users were loaded into the session.
+    over_limit = User.followers_count > _fanout_max_followers()
+    fanned_out = db.session.execute(
+        select(User.id, over_limit)
+        .where(User.id.in_(followed_ids), User.fanout_on_read.is_(False))
+    ).all()
+
+    flagged = [user_id for user_id, over in fanned_out if over]
+    if flagged:
+        db.session.execute(
+            update(User)
+            .where(User.id.in_(flagged))
+            .values(fanout_on_read=True)
+            .execution_options(synchronize_session='fetch'))
+
+    author_ids = [user_id for user_id, over in fanned_out if not over]
+    if not author_ids:
+        return
+
+    authors = select(User.id).where(User.id.in_(author_ids)).subquery()
+
+    recent = (select(Message.id, Message.user_id, Message.timestamp)
+              .where(Message.user_id == authors.c.id)
+              .order_by(Message.timestamp.desc())
+              .limit(_backfill_limit())
+              .lateral())
+
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'message_id', 'author_id', 'timestamp'],
+        select(literal(follower_id), recent.c.id, recent.c.user_id,
+               recent.c.timestamp)
+        .select_from(authors)
+        .join(recent, true()),
+    ).on_conflict_do_nothing())
+
+
+def add_loaded_messages(messages):
+    """Fan bulk-loaded `messages` (any table or subquery with the columns
+    of messages) out to their authors and followers."""
+
+    own = select(
+        messages.c.user_id,
+        messages.c.id,
+        messages.c.user_id,
+        messages.c.timestamp,
+    )
+
+    followed = (select(
+                    Follow.user_following_id,
+                    messages.c.id,
+                    messages.c.user_id,
+                    messages.c.timestamp)
+                .join(Follow,
+                      Follow.user_being_followed_id == messages.c.user_id)
+                .join(User, User.id == messages.c.user_id)
+                .where(User.fanout_on_read.is_(False)))
+
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'message_id', 'author_id', 'timestamp'],
+        union_all(own, followed),
+    ).on_conflict_do_nothing())
+
+
+def add_loaded_follows(follows):
+    """Give bulk-loaded `follows` (any table or subquery with the columns of
+    follows) every message of the users they follow, as a rebuild would.
+
+    Followed users that have grown past the fan-out limit are switched to
+    fan-out-on-read first, and get nothing copied.
+    """
+
+    followed_ids = select(follows.c.user_being_followed_id)
+
+    db.session.execute(
+        update(User)
+        .where(User.id.in_(followed_ids),
+               User.fanout_on_read.is_(False),
+               User.followers_count > _fanout_max_followers())
+        .values(fanout_on_read=True)
+        .execution_options(synchronize_session='fetch'))
+
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'message_id', 'author_id', 'timestamp'],
+        select(follows.c.user_following_id, Message.id, Message.user_id,
+               Message.timestamp)
+        .join(Message, Message.user_id == follows.c.user_being_followed_id)
+        .join(User, User.id == Message.user_id)
+        .where(User.fanout_on_read.is_(False)),
+    ).on_conflict_do_nothing())
+
+
+def remove_follow(follower_id, followed_id):
+    """Drop `followed_id`'s messages from `follower_id`'s timeline."""
+
+    remove_follows(follower_id, [followed_id])
+
+
+def remove_follows(follower_id, followed_ids):
+    """Drop all of `followed_ids`' messages from `follower_id`'s timeline."""
+
+    if not followed_ids:
+        return
+
+    db.session.execute(delete(TimelineEntry).where(
+        TimelineEntry.user_id == follower_id,
+        TimelineEntry.author_id.in_(followed_ids),
+    ))
+
+
+def home_timeline(user_id, cursor=None, per_page=100, query=None):
+    """Return one page of `user_id`'s home timeline, newest first.
+
+    Reads the materialized timeline and merges in recent messages from any
+    followed fan-out-on-read authors. `cursor` is a decoded `(timestamp, id)`
+    keyset cursor; returns `(messages, next_cursor)`.
+
+    `query` is what to fetch per message; by default `Message` objects with
+    their authors, but e.g. a column-only query over messages works too, as
+    long as its rows have the message's `.id` and `.timestamp`.
+    """
+
+    if query is None:
+        query = with_authors(Message.query)
+
+    messages = (keyset_filter(
+                    query
+                    .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                    .filter(TimelineEntry.user_id == user_id),
+                    TimelineEntry.timestamp,
+                    TimelineEntry.message_id,
+                    cursor)
+                .limit(per_page + 1)
+                .all())
+
+    pulled_author_ids = (select(Follow.user_being_followed_id)
+                         .join(User, User.id == Follow.user_being_followed_id)
+                         .where(Follow.user_following_id == user_id,
+                                User.fanout_on_read.is_(True)))
+
+    pulled = (keyset_filter(
+                query.filter(Message.user_id.in_(pulled_author_ids)),
+                Message.timestamp,
+                Message.id,
+                cursor)
+              .limit(per_page + 1)
+              .all())
+
+    if pulled:
+        # An author may have been fanned out before switching to read-time,
+        # so the same message can come back from both queries.
+        merged = {message.id: message for message in messages + pulled}
+        messages = sorted(
+            merged.values(),
+            key=lambda message: (message.timestamp, message.id),
+            reverse=True,
+        )
+
+    return page_of(messages, per_page)
+
+
+def rebuild_timelines():
+    """Recompute every user's materialized timeline from scratch.
+
+    Used after bulk loads (e.g. seed.py) that bypass the write paths.
+    Follower counters must be up to date (see `reconcile_counters`).
+    """
+
+    db.session.execute(update(User).values(
+        fanout_on_read=User.followers_count > _fanout_max_followers()))
+
+    db.session.execute(delete(TimelineEntry))
+
+    own = select(
+        Message.user_id,
+        Message.id,
+        Message.user_id,
+        Message.timestamp,
+    )
+
+    followed = (select(
+                    Follow.user_following_id,
+                    Message.id,
+                    Message.user_id,
+                    Message.timestamp)
+                .join(Follow, Follow.user_being_followed_id == Message.user_id)
+                .join(User, User.id == Message.user_id)
+                .where(User.fanout_on_read.is_(False)))
+
+    db.session.execute(insert(TimelineEntry).from_select(
+        ['user_id', 'message_id', 'author_id', 'timestamp'],
+        union_all(own, followed),
+    ).on_conflict_do_nothing())